@@ -0,0 +1,2205 @@
+# analytics.py
+"""ส่วนคำนวณของ dashboard ที่ไม่ผูกกับ Streamlit: โหลด → clean → cube → ตารางของแต่ละ section
+
+ใช้ได้ทั้งจาก app.py และจาก command line (precompute ผลลัพธ์ลงไฟล์ parquet):
+
+    python analytics.py precompute --source final_test_data_20250529.parquet --out artifacts/
+"""
+import argparse, glob, logging, multiprocessing, sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+import os, re, json, time, hashlib, tempfile, threading, requests
+from datetime import datetime
+from urllib.parse import urlsplit
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+
+log = logging.getLogger(__name__)
+
+# ================== COLUMNS ==================
+# ชื่อคอลัมน์/alias ที่ clean_dataframe รู้จัก (ใช้ร่วมกับการเลือกคอลัมน์ตอนอ่าน parquet)
+DESC_ALIASES  = ["Description","Dscription","dscription","description"]
+PAYER_ALIASES = ["Customer/Vendor Name", "สิทธิการรักษา", "ผู้ชำระเงิน", "Payer", "Insurance", "สิทธิ์การรักษา"]
+PAYM_ALIASES  = ["Payment Method","วิธีชำระเงิน","ช่องทางชำระเงิน","ประเภทการชำระเงิน","Payment Type","Method"]
+PATIENT_ALIASES = ["Patient ID", "HN", "PatientID", "รหัสผู้ป่วย", "เลขประจำตัวผู้ป่วย"]
+EXTRA_DATE_COLS = ["Payment Date", "Paid Date", "Due Date", "Invoice Date", "Document Date"]
+NUMERIC_COLS  = ["LineTotal","avg_cost","age","Quantity"]
+TEXT_COLS     = ["Branch","เพศ คนไข้","โรงพยาบาล","Customer/Vendor Name","group_disease","Description"]
+KEY_COLS      = ["Document No","Line No"]
+# คีย์ตรวจแถวซ้ำ ไล่จากละเอียดสุด — ใช้คีย์แรกที่พบแถวซ้ำ
+CANDIDATE_KEYS = [
+    ["Branch","Posting Date","Document No","Line No","LineTotal"],
+    ["Branch","Posting Date","Document No","Description","LineTotal"],
+    ["Branch","Posting Date","Description","LineTotal"],
+]
+# คอลัมน์มิติ (cardinality ต่ำ) → category หลัง clean
+DIMENSION_COLS = TEXT_COLS + ["Payment Method","gender_mapped","disease_group_mapped"]
+
+# แคชไฟล์ที่ดาวน์โหลดจาก DATA_URL บนดิสก์ (แชร์ข้าม session/restart; revalidate ด้วย ETag/Last-Modified)
+DATA_CACHE_DIR = os.getenv("DATA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "hospital-analysis-cache"))
+DOWNLOAD_CHUNK = 1 << 20
+DOWNLOAD_TIMEOUT = (30, 180)   # (connect, read) วินาที ตอนยังไม่มีแคช
+REVALIDATE_TIMEOUT = (float(os.getenv("REVALIDATE_TIMEOUT", 3)), 30)  # มีแคชแล้ว: ต้นทางช้า/ล่ม → ใช้แคชเดิมเร็ว ๆ
+_download_lock = threading.Lock()
+
+# ================== INSTRUMENTATION ==================
+def rss_bytes():
+    """RSS ปัจจุบันของ process (Linux: /proc/self/statm) — None ถ้าอ่านไม่ได้"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+STAGE_COLUMNS = ["stage","seconds","rows_in","rows_out","mem_delta_mb"]
+
+class StageLog:
+    """บันทึก wall time / แถวเข้า-ออก / RSS ที่เปลี่ยนไปของแต่ละ stage
+
+    enabled=False → begin/end ไม่ทำอะไร (ใช้ได้ทั้งโค้ดโดยไม่ต้องเช็คเงื่อนไขเอง)
+    ส่ง logger มาจะ log แต่ละ stage เป็น JSON หนึ่งบรรทัด (สำหรับระบบ monitoring)
+    """
+
+    def __init__(self, enabled: bool = True, logger: logging.Logger = None, **context):
+        self.enabled = enabled
+        self.logger = logger
+        self.context = context
+        self.records = []
+        self._open = None
+        self._lock = threading.Lock()
+
+    def begin(self, name: str, rows_in=None):
+        if not self.enabled:
+            return
+        if self._open is not None:
+            self.end()
+        self._open = {"stage": name, "rows_in": rows_in, "_t0": time.perf_counter(), "_rss0": rss_bytes()}
+
+    def end(self, rows_out=None):
+        rec, self._open = self._open, None
+        if rec is None:
+            return
+        rss0, rss1 = rec.pop("_rss0"), rss_bytes()
+        rec["seconds"] = time.perf_counter() - rec.pop("_t0")
+        rec["rows_out"] = rows_out
+        rec["mem_delta_mb"] = (rss1 - rss0) / 2**20 if rss0 is not None and rss1 is not None else None
+        self._record(rec)
+
+    def add(self, name: str, seconds: float, rows_in=None, rows_out=None):
+        """บันทึก stage ที่จับเวลาเองจากที่อื่น (เช่นงานใน thread pool) — เรียกจากหลาย thread ได้; RSS ไม่แยกต่อ thread จึงไม่บันทึก"""
+        if self.enabled:
+            self._record({"stage": name, "rows_in": rows_in, "seconds": seconds, "rows_out": rows_out, "mem_delta_mb": None})
+
+    def _record(self, rec: dict):
+        with self._lock:
+            self.records.append(rec)
+        if self.logger is not None:
+            self.logger.info(json.dumps({"event": "stage", **self.context, **rec}, ensure_ascii=False, default=str))
+
+    @contextmanager
+    def stage(self, name: str, rows_in=None):
+        """with log.stage("clean", len(df)) as out: ... out["rows_out"] = len(result)"""
+        out = {}
+        self.begin(name, rows_in)
+        try:
+            yield out
+        finally:
+            if self.enabled:
+                self.end(out.get("rows_out"))
+
+    def frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(self.records, columns=STAGE_COLUMNS)
+
+# ================== DATA SOURCE ==================
+def _is_http_url(s: str) -> bool:
+    return bool(re.match(r"^https?://", str(s or ""), re.IGNORECASE))
+
+def redact_source(source: str) -> str:
+    """source สำหรับ log/manifest: URL เหลือ scheme://host/path (ตัด user:password, query string ที่อาจมีลายเซ็น/token)"""
+    if not _is_http_url(source):
+        return source
+    parts = urlsplit(source)
+    return f"{parts.scheme}://{parts.hostname or ''}{f':{parts.port}' if parts.port else ''}{parts.path}"
+
+def _cache_paths(url: str):
+    base = os.path.join(DATA_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest()[:20])
+    return base + ".parquet", base + ".json", base + ".part"
+
+def _read_meta(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_meta(path: str, meta: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def fetch_to_cache(url: str, timeout=None) -> str:
+    """ดาวน์โหลด url แบบ stream ลงไฟล์แคช คืน path ในเครื่อง
+
+    - มีไฟล์แคชแล้ว: ส่ง If-None-Match / If-Modified-Since → 304 ไม่ต้องโหลดซ้ำ
+    - มีไฟล์ .part ค้างจากรอบก่อน: ขอ Range ต่อจากเดิม (If-Range กันไฟล์ต้นทางเปลี่ยนกลางทาง)
+    - timeout เริ่มต้น: REVALIDATE_TIMEOUT ถ้ามีแคชแล้ว, DOWNLOAD_TIMEOUT ถ้ายังไม่มี
+    """
+    path, meta_path, part_path = _cache_paths(url)
+    with _download_lock:
+        os.makedirs(DATA_CACHE_DIR, exist_ok=True)
+        meta = _read_meta(meta_path) if os.path.exists(path) else {}
+        if timeout is None:
+            timeout = REVALIDATE_TIMEOUT if os.path.exists(path) else DOWNLOAD_TIMEOUT
+        part_meta = _read_meta(part_path + ".json")
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = part_meta.get("etag") or part_meta.get("last_modified")
+        if part_size and validator:
+            headers["Range"] = f"bytes={part_size}-"
+            headers["If-Range"] = validator
+
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+            if r.status_code == 304:
+                return path
+            r.raise_for_status()
+            new_meta = {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+            }
+            resumed = r.status_code == 206
+            if not resumed:
+                _write_meta(part_path + ".json", new_meta)
+            with open(part_path, "ab" if resumed else "wb") as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                    f.write(chunk)
+        new_meta["size"] = os.path.getsize(part_path)
+        os.replace(part_path, path)
+        _write_meta(meta_path, new_meta)
+        try:
+            os.remove(part_path + ".json")
+        except OSError:
+            pass
+        return path
+
+def source_fingerprint(source: str) -> str:
+    """ลายนิ้วมือของแหล่งข้อมูล (path/URL + mtime/ETag) ใช้เป็น cache key ของ stage ถัดไป"""
+    if _is_http_url(source):
+        # revalidate แบบมีเงื่อนไข (ส่วนใหญ่ได้ 304) แล้วใช้ validator ของไฟล์แคชเป็นลายนิ้วมือ
+        path, meta_path, _ = _cache_paths(source)
+        try:
+            fetch_to_cache(source)
+        except requests.RequestException:
+            if not os.path.exists(path):  # ต้นทางล่มแต่มีแคชเดิม → ใช้แคชไปก่อน
+                raise
+        meta = _read_meta(meta_path)
+        tag = meta.get("etag") or meta.get("last_modified") or meta.get("size") or ""
+        return f"{source}|{tag}"
+    if is_partitioned(source):
+        listing = "\n".join(f"{name}|{fp}" for name, fp in list_partitions(source))
+        return f"{os.path.abspath(source)}|{hashlib.sha1(listing.encode('utf-8')).hexdigest()}"
+    fs = os.stat(source)
+    return f"{os.path.abspath(source)}|{fs.st_mtime_ns}|{fs.st_size}"
+
+def is_partitioned(source: str) -> bool:
+    """โฟลเดอร์ หรือ glob (เช่น data/branch_*.parquet) → หลายไฟล์ (shard)"""
+    return not _is_http_url(source) and (os.path.isdir(source) or glob.has_magic(source))
+
+def partition_root(source: str) -> str:
+    """โฟลเดอร์ฐานของ shard: ตัวโฟลเดอร์เอง หรือส่วนหน้าของ glob ที่ไม่มีอักขระพิเศษ"""
+    if not glob.has_magic(source):
+        return source
+    head = []
+    for part in source.replace(os.sep, "/").split("/"):
+        if glob.has_magic(part):
+            break
+        head.append(part)
+    return "/".join(head) or "."
+
+def list_partitions(source: str) -> list:
+    """[(relpath, "mtime|size")] ของไฟล์ parquet ทุกไฟล์ใต้โฟลเดอร์/ที่ตรง glob เรียงตามชื่อ (เช่น 1 ไฟล์ต่อเดือน)"""
+    root = partition_root(source)
+    if glob.has_magic(source):
+        paths = [p for p in glob.glob(source, recursive=True) if os.path.isfile(p)]
+    else:
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith((".", "_"))]
+            paths += [os.path.join(dirpath, n) for n in filenames
+                      if n.endswith(".parquet") and not n.startswith((".", "_"))]
+    out = []
+    for path in paths:
+        fs = os.stat(path)
+        out.append((os.path.relpath(path, root), f"{fs.st_mtime_ns}|{fs.st_size}"))
+    return sorted(out)
+
+def _open_source(source: str) -> str:
+    # URL → ไฟล์แคชในเครื่อง (source_fingerprint revalidate ให้แล้ว) เพื่อให้ pyarrow memory-map ได้
+    if _is_http_url(source):
+        path = _cache_paths(source)[0]
+        return path if os.path.exists(path) else fetch_to_cache(source)
+    return source
+
+def read_parquet(source: str, columns=None, filters=None) -> pd.DataFrame:
+    return pd.read_parquet(_open_source(source), columns=columns, filters=filters, memory_map=True)
+
+def resolve_columns(names) -> list:
+    """คอลัมน์ใน schema ที่ dashboard ใช้จริง (alias แรกที่พบ เหมือนลำดับใน clean_dataframe)"""
+    wanted = {"Posting Date", *EXTRA_DATE_COLS, *NUMERIC_COLS, *TEXT_COLS, *KEY_COLS}
+    for aliases in (DESC_ALIASES, PAYER_ALIASES, PAYM_ALIASES, PATIENT_ALIASES):
+        hit = next((c for c in aliases if c in names), None)
+        if hit:
+            wanted.add(hit)
+    return [c for c in names if c in wanted]
+
+def scan_dedup_key(pf: pq.ParquetFile, batch_rows: int = None):
+    """คีย์ de-dup ที่ clean_dataframe เลือกเมื่อโหลดทั้งไฟล์ (อ่านเฉพาะคอลัมน์ใน CANDIDATE_KEYS ทีละ batch)
+
+    โหมด pushdown ส่งคีย์นี้ให้ load_clean → แถวที่ถูกตัดเท่ากับโหมด full (ถ้าเลือกคีย์จากแถวที่กรองแล้ว
+    ช่วงที่ไม่มีแถวซ้ำตามคีย์ละเอียดอาจไปตกคีย์ที่หยาบกว่า แล้วตัดแถวที่โหมด full เก็บไว้)
+    hash ของคีย์ผ่าน spill_dedup_plan เหมือนโหมด stream → หน่วยความจำไม่โตตามไฟล์
+    """
+    batch_rows = batch_rows or STREAM_BATCH_ROWS
+    names = pf.schema_arrow.names
+    wanted = {k for ks in CANDIDATE_KEYS for k in ks} | {next((c for c in DESC_ALIASES if c in names), None)}
+    columns = [c for c in names if c in wanted]
+    batches = lambda: (clean_dataframe(b.to_pandas(), strict_dedup=False)
+                       for b in pf.iter_batches(batch_size=batch_rows, columns=columns))
+    return spill_dedup_plan(batches, pf.metadata.num_rows, batch_rows)["used_key"]
+
+def scan_path(fingerprint: str) -> str:
+    """ผล scan_parquet บนดิสก์ (ข้าง snapshot) ต่อลายนิ้วมือแหล่งข้อมูล"""
+    key = json.dumps([CLEANING_VERSION, fingerprint])
+    return os.path.join(SNAPSHOT_DIR, f"scan-v{CLEANING_VERSION}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]}.json")
+
+def scan_parquet(source: str, fingerprint: str = None) -> dict:
+    """อ่าน schema + ช่วงวันที่ + รายชื่อสาขา + คีย์ de-dup ของทั้งไฟล์ สำหรับสร้าง sidebar ก่อนโหลดจริง
+
+    ส่ง fingerprint มา → ผลถูกเก็บใน SNAPSHOT_DIR: รอบถัดไปของไฟล์เดิมไม่อ่านไฟล์ต้นทางเลย
+    (เหลือแค่ row group ที่ผ่านตัวกรองตอน load_clean)
+    """
+    path = scan_path(fingerprint) if SNAPSHOT_DIR and fingerprint else None
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                scan = json.load(f)
+            scan["min_date"], scan["max_date"] = (pd.Timestamp(scan[k]).date() for k in ("min_date", "max_date"))
+            return scan
+        except (OSError, KeyError, ValueError) as e:
+            log.warning("อ่านผล scan %s ไม่ได้ (%s) — scan ใหม่", path, e)
+    pf = pq.ParquetFile(_open_source(source), memory_map=True)
+    schema = pf.schema_arrow
+    names = schema.names
+    posting = pd.to_datetime(pf.read(columns=["Posting Date"]).column(0).to_pandas(), errors="coerce")
+    branch_raw = pf.read(columns=["Branch"]).column(0).unique().to_pylist() if "Branch" in names else []
+    date_type = schema.field("Posting Date").type
+    scan = {
+        "columns": resolve_columns(names),
+        "min_date": posting.min().date(),
+        "max_date": posting.max().date(),
+        # สาขาหลัง strip → ค่าดิบใน parquet (ใช้ทำ filter ให้ตรงกับค่าจริงในไฟล์)
+        "branch_raw": {b: sorted({r for r in branch_raw if r is not None and str(r).strip() == b})
+                       for b in {str(r).strip() for r in branch_raw if r is not None}},
+        "date_pushdown": ("date" if pa.types.is_date(date_type)
+                          else "timestamp" if pa.types.is_timestamp(date_type) and date_type.tz is None
+                          else None),
+        "dedup_key": scan_dedup_key(pf),
+    }
+    if path:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(scan, f, ensure_ascii=False, default=str)
+        os.replace(tmp, path)
+        prune_snapshots(".json")
+    return scan
+
+def build_pushdown_filters(scan: dict, start_date, end_date, branches) -> list:
+    """แปลงตัวกรอง sidebar เป็น pyarrow filters (row-group pruning + row filter ตอนอ่าน)"""
+    filters = []
+    if scan["date_pushdown"] == "date":
+        filters += [("Posting Date", ">=", start_date.date()), ("Posting Date", "<=", end_date.date())]
+    elif scan["date_pushdown"] == "timestamp":
+        end_excl = end_date + pd.Timedelta(days=1)  # รวมทั้งวันสุดท้าย
+        filters += [("Posting Date", ">=", start_date.to_datetime64()), ("Posting Date", "<", end_excl.to_datetime64())]
+    if set(branches) != set(scan["branch_raw"]):
+        filters.append(("Branch", "in", sorted(r for b in branches for r in scan["branch_raw"].get(b, []))))
+    return filters
+
+# ================== DE-DUP ENGINE ==================
+# hash คีย์เป็น uint64 ทีละ chunk (ไม่สร้าง tuple ของ object ทั้งก้อน) แล้วนับ/ตัดแถวซ้ำจาก hash เดียว
+DEDUP_CHUNK_ROWS = int(os.getenv("DEDUP_CHUNK_ROWS", 1_000_000))
+
+def key_hashes(df: pd.DataFrame, cols, chunk_rows: int = DEDUP_CHUNK_ROWS) -> np.ndarray:
+    """uint64 ต่อแถวจากค่าในคอลัมน์ cols (category ถูก hash ด้วยค่า ไม่ใช่ code จึงเทียบข้าม partition ได้)"""
+    cols = list(cols)
+    out = np.empty(len(df), dtype=np.uint64)
+    for i in range(0, len(df), chunk_rows):
+        chunk = df.iloc[i:i + chunk_rows][cols]
+        out[i:i + len(chunk)] = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    return out
+
+def duplicate_stats(hashes: np.ndarray):
+    """(จำนวนแถวที่ซ้ำแบบ keep=False, mask เก็บแถวแรกของแต่ละค่า) จาก hash table รอบเดียว"""
+    if len(hashes) == 0:
+        return 0, np.ones(0, dtype=bool)
+    codes, uniques = pd.factorize(hashes)
+    counts = np.bincount(codes, minlength=len(uniques))
+    dup = int(counts[counts > 1].sum())
+    # factorize ให้ code ตามลำดับที่พบครั้งแรก → แถวแรกของค่าคือแถวที่ code ใหม่กว่าทุกแถวก่อนหน้า
+    keep = np.empty(len(codes), dtype=bool)
+    keep[0] = True
+    keep[1:] = codes[1:] > np.maximum.accumulate(codes)[:-1]
+    return dup, keep
+
+def dedup_plan(columns, hash_for, dup_stats=duplicate_stats, keys=CANDIDATE_KEYS) -> dict:
+    """ไล่ keys (ค่าเริ่มต้น CANDIDATE_KEYS): นับแถวซ้ำของทุกคีย์ แล้วเลือกคีย์แรกที่พบแถวซ้ำ
+
+    hash_for(cols) → uint64 ต่อแถว (frame เดียวหรือหลาย partition ต่อกัน) แล้วส่งต่อให้ dup_stats
+    คืน {"counts": {คีย์: แถวซ้ำ}, "used_key", "keep", "dup_any"}
+    """
+    plan = {"counts": {}, "used_key": None, "keep": None, "dup_any": 0}
+    for ks in keys:
+        ks = [k for k in ks if k in columns]
+        if len(ks) < 3:
+            continue
+        dup, keep = dup_stats(hash_for(ks))
+        plan["counts"][" + ".join(ks)] = dup
+        if plan["used_key"] is None and dup > 0:
+            plan["used_key"], plan["keep"] = ks, keep
+    if plan["used_key"] is None:
+        plan["dup_any"], _ = dup_stats(hash_for(list(columns)))
+    return plan
+
+# de-dup ของข้อมูลที่ใหญ่กว่าหน่วยความจำ (stream / scan ของ pushdown): (hash, index แถว) 16 ไบต์ต่อแถวต่อคีย์
+# ถูก spill ลงไฟล์ชั่วคราวทีละ batch แบ่ง P ก้อนตาม hash % P → แถวที่ hash เท่ากันอยู่ก้อนเดียวกันเสมอ
+# จึงหาแถวซ้ำทีละก้อนได้ หน่วยความจำสูงสุด ≈ 1 batch + 1 ก้อน (≈ batch_rows ระเบียน) + 8 ไบต์ต่อแถวที่ถูกตัด
+DEDUP_SPILL_DIR = os.getenv("DEDUP_SPILL_DIR") or None  # ว่าง = temp ของระบบ
+_SPILL_DTYPE = np.dtype([("h", "<u8"), ("i", "<i8")])
+
+class HashSpill:
+    """hash ของคีย์หนึ่งบนดิสก์: 1 ไฟล์ .npy ต่อ batch เรียงตามก้อน + ขอบเขตของแต่ละก้อน"""
+
+    def __init__(self, root: str, parts: int):
+        self.root, self.parts, self.files = root, parts, []
+        os.makedirs(root, exist_ok=True)
+
+    def add(self, hashes: np.ndarray, start: int):
+        """เพิ่ม hash ของแถว start, start+1, ... (เรียงตามก้อนแบบ stable → index ในแต่ละก้อนเรียงจากน้อยไปมาก)"""
+        part = hashes % np.uint64(self.parts)
+        order = np.argsort(part, kind="stable")
+        rec = np.empty(len(hashes), dtype=_SPILL_DTYPE)
+        rec["h"], rec["i"] = hashes[order], start + order
+        path = os.path.join(self.root, f"{len(self.files)}.npy")
+        np.save(path, rec)
+        self.files.append((path, np.searchsorted(part[order], np.arange(self.parts + 1, dtype=np.uint64))))
+
+    def partitions(self):
+        """ระเบียนของแต่ละก้อนตามลำดับ (อ่านเฉพาะช่วงของก้อนนั้นจากทุกไฟล์)"""
+        maps = [(np.load(path, mmap_mode="r"), bounds) for path, bounds in self.files]
+        for p in range(self.parts):
+            yield np.concatenate([m[b[p]:b[p + 1]] for m, b in maps] or [np.empty(0, dtype=_SPILL_DTYPE)])
+
+def spill_duplicate_stats(spill: HashSpill):
+    """duplicate_stats ทีละก้อน คืน (จำนวนแถวซ้ำแบบ keep=False, index ของแถวที่ตัดเรียงจากน้อยไปมาก)"""
+    dup, drops = 0, [np.empty(0, dtype=np.int64)]
+    for rec in spill.partitions():
+        d, keep = duplicate_stats(rec["h"])
+        dup += d
+        drops.append(rec["i"][~keep])
+    return dup, np.sort(np.concatenate(drops))
+
+def spill_dedup_plan(batches, num_rows: int, batch_rows: int, keys=CANDIDATE_KEYS) -> dict:
+    """dedup_plan ของ frame ที่ clean แล้วทีละ batch (batches() คืน iterator ใหม่ทุกครั้งที่ต้องอ่านอีกรอบ)
+
+    ผลเท่ากับ dedup_plan บนแถวทั้งหมดต่อกัน แต่ plan["keep"] = index ของแถวที่ถูกตัด (ไม่ใช่ mask ทั้งไฟล์)
+    """
+    parts = max(1, -(-num_rows // batch_rows))
+    spills, columns = {}, None
+    with tempfile.TemporaryDirectory(prefix="dedup-spill-", dir=DEDUP_SPILL_DIR) as root:
+        def spill_pass(select):
+            # อ่าน batches() หนึ่งรอบ แล้ว spill ทุกคีย์ที่ select(columns) คืน
+            nonlocal columns
+            out, start = None, 0
+            for batch in batches():
+                if out is None:
+                    columns = columns or list(batch.columns)
+                    out = {ks: HashSpill(os.path.join(root, str(len(spills) + j)), parts)
+                           for j, ks in enumerate(select(columns))}
+                for ks, spill in out.items():
+                    spill.add(key_hashes(batch, list(ks)), start)
+                start += len(batch)
+            spills.update(out or {})
+
+        spill_pass(lambda cols: list(dict.fromkeys(
+            ks for ks in (tuple(k for k in ks if k in cols) for ks in keys) if len(ks) >= 3)))
+
+        def hash_for(ks):
+            ks = tuple(ks)
+            if ks not in spills:  # คีย์ทุกคอลัมน์ (ใช้เมื่อไม่มีคีย์ไหนพบแถวซ้ำ) → อ่านอีกรอบ
+                spill_pass(lambda cols: [ks])
+            return spills.get(ks) or HashSpill(os.path.join(root, "empty"), parts)
+        return dedup_plan(columns or [], hash_for, spill_duplicate_stats, keys)
+
+# ================== CLEANING ==================
+# รายงานหน่วยความจำ/เวลา groupby ก่อน-หลัง compact dtypes (groupby ทั้งชุดข้อมูลหลายรอบ — เปิดเฉพาะตอนต้องการวัด)
+COMPACT_REPORT = os.getenv("COMPACT_REPORT", os.getenv("PROFILE_STAGES", "")).strip().lower() in ("1", "true", "yes")
+
+def _aggregation_timings(df: pd.DataFrame) -> dict:
+    """จับเวลา groupby หลักของ dashboard (ใช้เทียบก่อน/หลังแปลง dtype)"""
+    jobs = {
+        "Top branches": lambda: df.groupby("Branch", observed=True)["LineTotal"].sum(),
+        "Payer KPI": lambda: df.groupby("Customer/Vendor Name", observed=True)["LineTotal"].agg(["sum","size"]),
+        "Hospital × Payer": lambda: df.groupby(["โรงพยาบาล","Customer/Vendor Name"], observed=True)["LineTotal"].agg(["sum","size"]),
+        "Disease × Age": lambda: df.groupby("disease_group_mapped", observed=True)["age"].agg(["mean","size"]),
+        "Monthly trend": lambda: df.groupby(["YM","Customer/Vendor Name"], observed=True)["LineTotal"].sum(),
+        "Payment mix": lambda: df.groupby("Payment Method", observed=True)["LineTotal"].agg(["sum","size"]),
+    }
+    out = {}
+    for name, job in jobs.items():
+        try:
+            t0 = time.perf_counter()
+            job()
+            out[name] = time.perf_counter() - t0
+        except KeyError:
+            pass
+    return out
+
+def map_unique(s: pd.Series, fn) -> pd.Series:
+    """ใช้ fn กับค่าที่ไม่ซ้ำของ s (Series → Series ความยาวเท่ากัน) แล้วกระจายกลับด้วย codes → category
+
+    งานเป็นสัดส่วนกับ cardinality แทนจำนวนแถว; categories เรียงตามค่าเหมือน astype("category")
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    mapped = fn(pd.Series(uniques)).to_numpy()
+    new_codes, cats = pd.factorize(mapped, sort=True)  # ค่าต่างกันอาจ map เป็นค่าเดียวกัน (" A" กับ "A")
+    return pd.Series(pd.Categorical.from_codes(new_codes[codes], cats), index=s.index, name=s.name)
+
+def _strip_text(u: pd.Series) -> pd.Series:
+    """strip ข้อความ — ค่าว่าง/None/NaN เป็น NA (pandas < 3 แปลง None/NaN เป็น "None"/"nan" ตอน astype(str))"""
+    out = u.astype(str).str.strip()
+    return out.mask(u.isna() | out.isin(["", "nan", "None"]))
+
+def compact_dtypes(df: pd.DataFrame, stats: dict = None, report: bool = None) -> pd.DataFrame:
+    """category สำหรับคอลัมน์มิติ, float32/int32 สำหรับ age/Quantity, Int16 สำหรับ Year
+
+    LineTotal / avg_cost คงเป็น float64 — ยอดรวมหลักล้านบาทใน float32 คลาดเคลื่อนระดับหลักหน่วย
+    report (ค่าเริ่มต้น COMPACT_REPORT) + stats → บันทึกหน่วยความจำและเวลา groupby ก่อน/หลังไว้ใน stats["compact"]
+    ฐาน "ก่อน" = คอลัมน์มิติเป็นข้อความ (str) แบบก่อน normalize — map_unique ทำให้เป็น category ตั้งแต่ตอนนั้นแล้ว
+    """
+    report = COMPACT_REPORT if report is None else report
+    if stats is not None and report:
+        raw = df.assign(**{c: df[c].astype(str) for c in DIMENSION_COLS if c in df.columns})
+        mem_before = int(raw.memory_usage(deep=True).sum())
+        t_before = _aggregation_timings(raw)
+        del raw
+
+    for c in DIMENSION_COLS:
+        if c in df.columns:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].cat.remove_unused_categories()  # หลังตัดแถวไม่มีวันที่
+            else:
+                df[c] = df[c].astype("category")
+    if "age" in df.columns:
+        df["age"] = df["age"].astype("float32")
+    if "Quantity" in df.columns:
+        q = df["Quantity"]
+        if (q % 1 == 0).all() and q.abs().max() < 2**31:
+            df["Quantity"] = q.astype("int32")
+        else:
+            df["Quantity"] = q.astype("float32")
+    if "Year" in df.columns:
+        df["Year"] = df["Year"].astype("Int16")
+
+    if stats is not None and report:
+        t_after = _aggregation_timings(df)
+        stats["compact"] = {
+            "mem_before": mem_before,
+            "mem_after": int(df.memory_usage(deep=True).sum()),
+            "timings": pd.DataFrame({"before_s": t_before, "after_s": t_after}),
+        }
+    return df
+
+def clean_dataframe(df: pd.DataFrame, strict_dedup: bool = True, warn=log.warning, stats: dict = None,
+                    dedup_key=None) -> pd.DataFrame:
+    """dedup_key: ใช้คีย์นี้แทนการไล่ CANDIDATE_KEYS (คีย์ที่เลือกจากทั้งไฟล์ เมื่อ df เป็นแค่ส่วนที่กรองแล้ว)"""
+    df = df.copy()
+
+    # --- unify description
+    desc_alias = [c for c in DESC_ALIASES if c in df.columns]
+    if desc_alias:
+        if desc_alias[0] != "Description":
+            df.rename(columns={desc_alias[0]: "Description"}, inplace=True)
+
+    # --- normalize "สิทธิการรักษา / ผู้ชำระเงิน / Payer" (ก่อน normalize ข้อความ — alias ก็ผ่าน map_unique)
+    payer_col = next((c for c in PAYER_ALIASES if c in df.columns), None)
+    if payer_col and payer_col != "Customer/Vendor Name":
+        df.rename(columns={payer_col: "Customer/Vendor Name"}, inplace=True)
+
+    # --- common types
+    if "Posting Date" in df.columns:
+        df["Posting Date"] = pd.to_datetime(df["Posting Date"], errors="coerce")
+
+    # try to parse Payment/Due/Invoice related dates if exist
+    for dcol in EXTRA_DATE_COLS:
+        if dcol in df.columns:
+            df[dcol] = pd.to_datetime(df[dcol], errors="coerce")
+
+    for c in NUMERIC_COLS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+
+    # ข้อความ: strip บนค่าที่ไม่ซ้ำแล้วกระจายกลับ (ได้ category)
+    for c in TEXT_COLS:
+        if c in df.columns:
+            df[c] = map_unique(df[c], _strip_text)
+
+    # fill numeric nans
+    for c in NUMERIC_COLS:
+        if c in df.columns:
+            df[c] = df[c].fillna(0)
+
+    # drop rows with missing date
+    if "Posting Date" in df.columns:
+        df = df[~df["Posting Date"].isna()].copy()
+        df["Year"] = df["Posting Date"].dt.year
+        df["YM"]   = (df["Posting Date"].dt.year * 100 + df["Posting Date"].dt.month).astype("int32")  # yyyymm
+
+    # gender / age group / disease
+    gender_mapping = {"M":"Male","F":"Female","W":"Female","ชาย":"Male","หญิง":"Female"}
+    if "เพศ คนไข้" in df.columns:
+        df["gender_mapped"] = map_unique(df["เพศ คนไข้"], lambda u: u.map(gender_mapping).fillna("Other"))
+
+    if "age" in df.columns:
+        bins   = [0,17,35,55,200]
+        labels = ["0–17","18–35","36–55","56+"]
+        df["age_group"] = pd.cut(df["age"], bins=bins, labels=labels, right=True)
+
+    disease_mapping = {
+        "กล้ามเนื้อเคล็ด":"Muscle Strain",
+        "โรคทางเดินปัสสาวะ":"Urinary Tract Disease",
+        "ปัจจัยที่มีผลต่อสถานะสุขภาพ":"Factors Affecting Health Status",
+        "ความผิดปกติจากทางคลินิกและห้องปฏิบัติการ":"Abnormalities from Clinical",
+        "โรคทางเดินอาหาร":"Gastrointestinal Disease",
+        "URI":"Upper Respiratory Infection (URI)",
+        "การติดเชื้อไวรัส":"Viral Infection",
+        "การบาดเจ็บ การเป็นพิษ และอุบัติเหตุ":"Injury, Poisoning, and Accidents",
+    }
+    if "group_disease" in df.columns:
+        df["disease_group_mapped"] = map_unique(df["group_disease"], lambda u: u.map(disease_mapping).fillna(u))
+
+    # --- normalize "รหัสผู้ป่วย / HN" (ใช้เป็นคีย์ผู้ป่วยของ patient ledger)
+    patient_col = next((c for c in PATIENT_ALIASES if c in df.columns), None)
+    if patient_col and patient_col != "Patient ID":
+        df.rename(columns={patient_col: "Patient ID"}, inplace=True)
+
+    # --- normalize "วิธีจ่ายเงิน / Payment Method"
+    paym_col = next((c for c in PAYM_ALIASES if c in df.columns), None)
+    if paym_col:
+        if paym_col != "Payment Method":
+            df.rename(columns={paym_col: "Payment Method"}, inplace=True)
+        df["Payment Method"] = map_unique(df["Payment Method"], _strip_text)
+
+    # --- compact dtypes (ก่อน de-dup: df[keep] ด้านล่าง copy ทั้งตารางอีกรอบ — copy ตอน dtype เล็กแล้วถูกกว่า
+    #     ค่า hash ของคีย์ไม่เปลี่ยน: category ถูก hash ด้วยค่า ไม่ใช่ code — ดู key_hashes)
+    df = compact_dtypes(df, stats=stats)
+
+    # --- strict de-dup
+    if strict_dedup:
+        plan = dedup_plan(list(df.columns), lambda ks: key_hashes(df, ks),
+                          keys=[dedup_key] if dedup_key else CANDIDATE_KEYS)
+        if stats is not None:
+            stats["dedup"] = plan["counts"]
+        before = len(df)
+        if plan["used_key"] is not None:
+            df = df[plan["keep"]]
+            warn(f"🧹 ลบข้อมูลซ้ำ {before-len(df):,} แถว ด้วยคีย์ {plan['used_key']}")
+        elif plan["dup_any"] > 0:
+            warn(f"พบรูปแบบซ้ำ {plan['dup_any']:,} แถว แต่ไม่มีคีย์ที่เหมาะสม — กรุณาตรวจคีย์เอกลักษณ์")
+
+    return df
+
+# ================== PROFIT ==================
+# สูตรกำไร → คอลัมน์ที่คำนวณไว้ล่วงหน้าใน stage ที่ cache (selectbox แค่เลือกคอลัมน์)
+PROFIT_FORMULAS = {
+    "Per-Unit Cost: LineTotal - (avg_cost × Quantity)": "Profit_PerUnit",
+    "Current: LineTotal - avg_cost": "Profit_Current",
+    "Fixed 40% Margin: LineTotal × 0.40": "Profit_Fixed40",
+}
+PROFIT_SHORT = {"Profit_PerUnit": "Per-Unit", "Profit_Current": "Current", "Profit_Fixed40": "Fixed 40%"}
+
+def compute_profit(df: pd.DataFrame, profit_formula: str) -> pd.Series:
+    if profit_formula.startswith("Per-Unit"):
+        if {"avg_cost","Quantity"}.issubset(df.columns):
+            return df["LineTotal"] - (df["avg_cost"] * df["Quantity"])
+        return pd.Series(0.0, index=df.index)
+    if profit_formula.startswith("Current"):
+        return df["LineTotal"] - df.get("avg_cost", 0)
+    return df["LineTotal"] * 0.40
+
+def add_profit_columns(df: pd.DataFrame) -> pd.DataFrame:
+    # float64 เหมือน LineTotal — เป็นยอดเงินที่ถูก sum ต่อ
+    for formula, col in PROFIT_FORMULAS.items():
+        df[col] = compute_profit(df, formula).astype("float64")
+    return df
+
+# ================== SORTED BRANCH/DATE INDEX ==================
+# เก็บข้อมูลเรียงตาม (Branch, วันที่) + ช่วง offset ของแต่ละสาขา → กรองด้วย searchsorted + slice แทน boolean mask
+def sort_by_branch_date(df: pd.DataFrame, date_col: str) -> pd.DataFrame:
+    return df.sort_values(["Branch", date_col], kind="stable", ignore_index=True)
+
+def is_branch_date_sorted(df: pd.DataFrame, date_col: str) -> bool:
+    """True ถ้า df เรียงตาม sort_by_branch_date อยู่แล้ว (ตรวจ O(n) แทนการเรียงใหม่ + copy)"""
+    if len(df) < 2:
+        return True
+    b = pd.Categorical(df["Branch"]).codes.astype(np.int64)
+    d = df[date_col].to_numpy().astype("datetime64[ns]").astype(np.int64)
+    db, dd = np.diff(b), np.diff(d)
+    return bool(((db > 0) | ((db == 0) & (dd >= 0))).all()) and (b >= 0).all()
+
+def branch_offsets(df: pd.DataFrame) -> dict:
+    """{branch: (start, stop)} ตำแหน่งแถวของแต่ละสาขาใน frame ที่เรียงด้วย sort_by_branch_date แล้ว
+
+    แถวที่ไม่มี Branch (code -1) ถูกเรียงไว้ท้ายสุด → ค้นเฉพาะช่วงแรกที่มีสาขา (codes ในช่วงนี้เรียงจากน้อยไปมาก)
+    """
+    cat = pd.Categorical(df["Branch"])
+    codes = cat.codes[:int((cat.codes >= 0).sum())]
+    bounds = np.searchsorted(codes, np.arange(len(cat.categories) + 1))
+    return {b: (int(bounds[i]), int(bounds[i + 1]))
+            for i, b in enumerate(cat.categories) if bounds[i] < bounds[i + 1]}
+
+def slice_branch_dates(df: pd.DataFrame, offsets: dict, date_col: str, start, end_excl, branches) -> pd.DataFrame:
+    """แถวของ branches ที่ start <= date_col < end_excl; ช่วงติดกันรวมเป็น slice เดียว (ไม่ copy)"""
+    dates = df[date_col].to_numpy()
+    lo_key, hi_key = np.datetime64(start, "ns"), np.datetime64(end_excl, "ns")
+    ranges = []
+    for b in sorted(set(branches), key=lambda b: offsets.get(b, (-1,))[0]):
+        if b not in offsets:
+            continue
+        lo, hi = offsets[b]
+        i = lo + int(np.searchsorted(dates[lo:hi], lo_key, side="left"))
+        j = lo + int(np.searchsorted(dates[lo:hi], hi_key, side="left"))
+        if i >= j:
+            continue
+        if ranges and ranges[-1][1] == i:
+            ranges[-1] = (ranges[-1][0], j)
+        else:
+            ranges.append((i, j))
+    if not ranges:
+        return df.iloc[0:0]
+    if len(ranges) == 1:
+        return df.iloc[ranges[0][0]:ranges[0][1]]
+    return df.iloc[np.concatenate([np.arange(i, j) for i, j in ranges])]
+
+# ================== CLEANED SNAPSHOT ==================
+# ผลของ load_clean บนดิสก์เป็น Arrow IPC (Feather v2, ไม่บีบอัด → memory-map ได้) ใช้ข้าม restart/replica/worker
+# คีย์ = ลายนิ้วมือแหล่งข้อมูล + CLEANING_VERSION + ตัวเลือกการโหลด — แก้ตรรกะ clean/กำไร/เรียง ให้เพิ่ม CLEANING_VERSION
+CLEANING_VERSION = 5  # 2: รวม alias รหัสผู้ป่วย (HN ฯลฯ) เป็น "Patient ID", 3: strip ชื่อสิทธิที่มาจาก alias,
+                      # 4: cube แยกตาม section (ผล precompute รุ่นก่อนใช้ไม่ได้)
+                      # 5: ข้อความว่าง/"nan"/"None" ในคอลัมน์มิติเป็น NA (pandas 2.x)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(DATA_CACHE_DIR, "snapshots"))  # "" = ปิด
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", 4))
+
+def snapshot_path(fingerprint: str, strict_dedup: bool, columns=None) -> str:
+    key = json.dumps([CLEANING_VERSION, fingerprint, strict_dedup, columns], default=str)
+    return os.path.join(SNAPSHOT_DIR, f"clean-v{CLEANING_VERSION}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]}.arrow")
+
+def _snapshot_meta(notes, stats) -> dict:
+    meta = {"cleaning_version": CLEANING_VERSION, "notes": list(notes), "dedup": stats.get("dedup", {})}
+    if "compact" in stats:
+        cp = stats["compact"]
+        meta["compact"] = {"mem_before": cp["mem_before"], "mem_after": cp["mem_after"],
+                           "timings": cp["timings"].to_dict(orient="index")}
+    return meta
+
+def write_snapshot(path: str, df: pd.DataFrame, notes, stats):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = {**(table.schema.metadata or {}), b"hospital_analysis": json.dumps(_snapshot_meta(notes, stats)).encode("utf-8")}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table.replace_schema_metadata(meta), tmp, compression="uncompressed")
+    os.replace(tmp, path)
+    prune_snapshots(".arrow")
+
+def prune_snapshots(suffix: str):
+    """เก็บไฟล์นามสกุล suffix ใน SNAPSHOT_DIR ไว้แค่ SNAPSHOT_KEEP ไฟล์ล่าสุด"""
+    old = sorted((os.path.join(SNAPSHOT_DIR, f) for f in os.listdir(SNAPSHOT_DIR) if f.endswith(suffix)),
+                 key=os.path.getmtime, reverse=True)[SNAPSHOT_KEEP:]
+    for f in old:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+def read_snapshot(path: str):
+    """(df, notes, stats) จาก snapshot แบบ memory-map (คอลัมน์ตัวเลขไม่มี null ใช้หน้าไฟล์ตรงๆ ไม่ copy)
+
+    snapshot จาก CLEANING_VERSION อื่น → ValueError (ชื่อไฟล์มีเวอร์ชันอยู่แล้ว — กันไฟล์ที่ถูกคัดลอก/เปลี่ยนชื่อมา)
+    """
+    table = feather.read_table(path, memory_map=True)
+    meta = json.loads(table.schema.metadata[b"hospital_analysis"])
+    if meta.get("cleaning_version") != CLEANING_VERSION:
+        raise ValueError(f"snapshot {path} เป็น CLEANING_VERSION {meta.get('cleaning_version')} (ต้องการ {CLEANING_VERSION})")
+    stats = {"dedup": meta["dedup"]}
+    if "compact" in meta:
+        cp = meta["compact"]
+        stats["compact"] = {**cp, "timings": pd.DataFrame.from_dict(cp["timings"], orient="index")}
+    return table.to_pandas(split_blocks=True), tuple(meta["notes"]), stats
+
+def load_clean(source: str, strict_dedup: bool = True, columns=None, filters=None, fingerprint: str = None,
+               dedup_key=None):
+    """อ่าน + clean + เรียง (Branch, วันที่) + คอลัมน์กำไรทุกสูตร คืน (df, notes, stats)
+
+    เวลาของแต่ละขั้นอยู่ใน stats["stages"] (บันทึกทุกครั้ง — ค่าใช้จ่ายต่ำเทียบกับงานเอง)
+    ส่ง fingerprint มา (และไม่มี filters) → อ่าน/เขียน snapshot บนดิสก์ใน SNAPSHOT_DIR
+    dedup_key: คีย์ de-dup จาก scan_parquet (โหมด pushdown) — ผลเท่ากับที่ clean ทั้งไฟล์จะเลือก
+    """
+    notes, stats, stages = [], {}, StageLog()
+    snap = snapshot_path(fingerprint, strict_dedup, columns) if SNAPSHOT_DIR and fingerprint and not filters else None
+    if snap and os.path.exists(snap):
+        with stages.stage("read_snapshot") as out:
+            try:
+                df, notes, stats = read_snapshot(snap)
+            except (OSError, KeyError, ValueError, pa.ArrowException) as e:
+                log.warning("อ่าน snapshot %s ไม่ได้ (%s) — clean ใหม่", snap, e)
+                df = None
+            out["rows_out"] = None if df is None else len(df)
+        if df is not None:
+            stats["stages"] = stages.records
+            stats["snapshot"] = {"path": snap, "hit": True}
+            return df, notes, stats
+    with stages.stage("read_parquet") as out:
+        df = read_parquet(source, columns=columns, filters=filters)
+        out["rows_out"] = len(df)
+    with stages.stage("clean_dataframe", len(df)) as out:
+        df = clean_dataframe(df, strict_dedup=strict_dedup, warn=notes.append, stats=stats, dedup_key=dedup_key)
+        out["rows_out"] = len(df)
+    with stages.stage("sort_by_branch_date", len(df)) as out:
+        df = sort_by_branch_date(df, "Posting Date")
+        out["rows_out"] = len(df)
+    with stages.stage("add_profit_columns", len(df)) as out:
+        df = add_profit_columns(df)
+        out["rows_out"] = len(df)
+    if snap:
+        with stages.stage("write_snapshot", len(df)):
+            try:
+                write_snapshot(snap, df, notes, stats)
+                stats["snapshot"] = {"path": snap, "hit": False}
+            except (OSError, pa.ArrowException) as e:
+                log.warning("เขียน snapshot %s ไม่ได้: %s", snap, e)
+    stats["stages"] = stages.records
+    return df, tuple(notes), stats
+
+# ================== AGGREGATE CUBES ==================
+# cube แยกตาม section (marginal) แทน cube กว้างก้อนเดียว — แต่ละก้อนมีแถวเท่าจำนวนกลุ่มของมิติที่ section นั้นใช้
+# "daily" ละเอียดระดับวัน (KPI, สาขา, ช่วงวันที่); ก้อนอื่นระดับเดือน (Month/YM) — ช่วงวันที่ที่ไม่ตรงต้น/ท้ายเดือน
+# นับทั้งเดือน (month_span) ทุกก้อนมี Branch ให้กรองสาขาได้ ยกเว้น "hospital" (โรงพยาบาล × สิทธิ ใหญ่เกินถ้าแยกสาขา)
+# ซึ่งเป็นยอดรวมทุกสาขา — เลือกบางสาขาแล้วมีแถวรายการ → PandasSections รวมฮีตแมปจากแถวแทน
+CUBES = {
+    # ชื่อ → (มิติ, คอลัมน์เวลา)
+    "daily":    (["Branch"], "Day"),
+    "product":  (["Branch","Description"], "Month"),
+    "payer":    (["Branch","Customer/Vendor Name"], "Month"),
+    "payment":  (["Branch","Payment Method"], "Month"),
+    "disease":  (["Branch","disease_group_mapped"], "Month"),
+    "hospital": (["โรงพยาบาล","Customer/Vendor Name"], "Month"),
+}
+
+def _period(dates: pd.Series, time_col: str) -> pd.Series:
+    if time_col == "Day":
+        return dates.dt.normalize()
+    return pd.Series(dates.to_numpy().astype("datetime64[M]").astype("datetime64[ns]"), index=dates.index)
+
+def _sort_cube(cube: pd.DataFrame, time_col: str) -> pd.DataFrame:
+    cube["YM"] = (cube[time_col].dt.year * 100 + cube[time_col].dt.month).astype("int32")
+    if "Branch" in cube.columns:
+        return sort_by_branch_date(cube, time_col)
+    return cube.sort_values(time_col, kind="stable", ignore_index=True)
+
+def build_cube(df: pd.DataFrame, name: str = "daily") -> pd.DataFrame:
+    """รวมรายการเป็น cube ของ CUBES[name]: sum LineTotal, sum Profit ทุกสูตร, Cases, sum/count age (None ถ้าขาดมิติ)"""
+    dims, time_col = CUBES[name]
+    if not set(dims) <= set(df.columns):
+        return None
+    profit_cols = list(PROFIT_FORMULAS.values())
+    src = pd.DataFrame({
+        time_col: _period(df["Posting Date"], time_col),
+        **{c: df[c] for c in dims},
+        "LineTotal": df["LineTotal"],
+        **{c: df[c] for c in profit_cols},
+    })
+    aggs = {
+        "LineTotal": ("LineTotal","sum"),
+        **{c: (c,"sum") for c in profit_cols},
+        "Cases": ("LineTotal","size"),
+    }
+    if "age" in df.columns:
+        src["age"] = df["age"].astype("float64")
+        aggs.update(age_sum=("age","sum"), age_cnt=("age","count"))
+    cube = src.groupby([time_col, *dims], observed=True, dropna=False, sort=False).agg(**aggs).reset_index()
+    return _sort_cube(cube, time_col)
+
+def build_cubes(df: pd.DataFrame) -> dict:
+    """{ชื่อ: cube} ของทุก CUBES ที่ df มีมิติครบ"""
+    cubes = {name: build_cube(df, name) for name in CUBES}
+    return {name: cube for name, cube in cubes.items() if cube is not None}
+
+def cube_columns(cubes: dict) -> list:
+    """คอลัมน์ของทุก cube รวมกัน (ใช้เช็คว่า section ไหนมีข้อมูลพอ)"""
+    return list(dict.fromkeys(c for cube in cubes.values() for c in cube.columns))
+
+def month_span(start, end_excl):
+    """ช่วง [ต้นเดือนของ start, ต้นเดือนถัดจากวันสุดท้าย) ที่ cube รายเดือนใช้กรอง"""
+    last = pd.Timestamp(end_excl) - pd.Timedelta(days=1)
+    return pd.Timestamp(start).to_period("M").to_timestamp(), (last.to_period("M") + 1).to_timestamp()
+
+def cube_offsets(cubes: dict) -> dict:
+    """{ชื่อ: branch_offsets} ของ cube ที่มี Branch (None สำหรับ cube ที่ไม่มี)"""
+    return {name: branch_offsets(cube) if "Branch" in cube.columns else None for name, cube in cubes.items()}
+
+def slice_cubes(cubes: dict, offsets: dict, start, end_excl, branches) -> dict:
+    """cube ทุกก้อนที่กรองสาขา + ช่วงวันที่แล้ว (daily ตรงวัน, ก้อนรายเดือนตาม month_span) — slice ไม่ copy"""
+    m_start, m_end = month_span(start, end_excl)
+    out = {}
+    for name, cube in cubes.items():
+        time_col = CUBES[name][1]
+        lo, hi = (start, end_excl) if time_col == "Day" else (m_start, m_end)
+        if offsets.get(name) is not None:
+            out[name] = slice_branch_dates(cube, offsets[name], time_col, lo, hi, branches)
+        else:
+            t = cube[time_col].to_numpy()
+            i, j = np.searchsorted(t, [np.datetime64(lo, "ns"), np.datetime64(hi, "ns")])
+            out[name] = cube.iloc[i:j]
+    return out
+
+# ================== INCREMENTAL PARTITIONS ==================
+# DATA_URL เป็นโฟลเดอร์หรือ glob (เช่น 1 parquet ต่อเดือน/ต่อสาขา): clean เฉพาะไฟล์ใหม่/เปลี่ยน แล้วรวม cube เข้ากับของเดิม
+# ไฟล์ที่ต้อง clean หลายไฟล์ทำขนานกันใน process pool (INGEST_WORKERS, ค่าเริ่มต้น = จำนวน core)
+# de-dup ทำบน hash ของคีย์จากทุก partition รวมกัน → ผลเท่ากับโหลดทุกไฟล์ต่อกันแล้ว clean ใหม่
+# ถ้า shard ไม่ทับกันทั้งสาขาหรือช่วงวันที่ (ทุกคีย์มี Branch + Posting Date) แถวซ้ำอยู่ใน shard เดียวกันเสมอ → de-dup ราย shard
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 0)) or (os.cpu_count() or 1)
+# ไฟล์ที่ต้อง clean รวมกันเล็กกว่านี้ทำใน process เดียว (เริ่ม worker แบบ spawn ใช้เวลาราว 1–2 วินาที)
+INGEST_PARALLEL_MIN_MB = float(os.getenv("INGEST_PARALLEL_MIN_MB", 64))
+
+def _clean_shard(path: str):
+    """งานของ worker: อ่าน + clean (ไม่ de-dup) + กำไร + hash ของ CANDIDATE_KEYS (คำนวณหนักทั้งหมดอยู่ฝั่ง worker)"""
+    df = add_profit_columns(clean_dataframe(read_parquet(path), strict_dedup=False))
+    hashes = {}
+    for ks in CANDIDATE_KEYS:
+        ks = tuple(k for k in ks if k in df.columns)
+        if len(ks) >= 3:
+            hashes[ks] = key_hashes(df, ks)
+    return df, hashes
+
+def shards_disjoint(parts: list) -> bool:
+    """True ถ้าไม่มีคู่ shard ไหนมีสาขาร่วมกัน หรือช่วง Posting Date ไม่ซ้อนกันเลย"""
+    if len(parts) < 2:
+        return True
+    branches = [p["branches"] for p in parts]
+    if sum(len(b) for b in branches) == len(set().union(*branches)):
+        return True
+    spans = sorted(p["span"] for p in parts if p["span"] is not None)
+    return len(spans) == len(parts) and all(a[1] < b[0] for a, b in zip(spans, spans[1:]))
+
+def _local_dup_stats(per_part: list):
+    """duplicate_stats ราย shard แล้วรวมจำนวน (ใช้เมื่อ shards_disjoint) คืน (dup, [keep ต่อ shard])"""
+    stats = [duplicate_stats(h) for h in per_part]
+    return sum(d for d, _ in stats), [k for _, k in stats]
+
+
+def concat_frames(frames: list) -> pd.DataFrame:
+    """ต่อ frame โดยรวม categories ของคอลัมน์ category ให้ยังเป็น category (ไม่หลุดเป็น object)"""
+    frames = [f for f in frames if len(f)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    frames = [f.copy(deep=False) for f in frames]
+    for c in frames[0].columns:
+        if all(c in f.columns and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames):
+            cats = pd.api.types.union_categoricals([f[c].array for f in frames]).categories
+            for f in frames:
+                f[c] = f[c].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+def merge_cubes(cubes: list) -> dict:
+    """รวม cube หลายชุด ({ชื่อ: cube} ต่อ partition/batch — ช่วงเวลาซ้อนกันได้) เป็นชุดเดียว"""
+    out = {}
+    for name, (dims, time_col) in CUBES.items():
+        parts = [c[name] for c in cubes if name in c]
+        if not parts:
+            continue
+        cube = concat_frames(parts)
+        keys = [time_col, *dims]
+        measures = [c for c in cube.columns if c not in keys and c != "YM"]
+        cube = cube.groupby(keys, observed=True, dropna=False, sort=False)[measures].sum().reset_index()
+        out[name] = _sort_cube(cube, time_col)
+    return out
+
+class PartitionStore:
+    """สถานะ ingest ต่อโฟลเดอร์/glob: hash คีย์ + cube/sketch ต่อ partition + frame รวมที่ de-dup แล้ว
+
+    แถวของ partition ไม่เก็บซ้ำกับ frame รวม: หลัง refresh เหลือแค่แถวที่ถูก de-dup ตัดทิ้ง + รหัสแถวต้นทาง
+    (uid ของ partition << 32 | ลำดับแถว) ของทุกแถวใน frame รวม → refresh รอบถัดไปประกอบ partition เดิมกลับได้ตรงทุกแถว
+    """
+
+    def __init__(self, source: str, strict_dedup: bool, workers: int = INGEST_WORKERS):
+        self.source = source
+        self.root = partition_root(source)
+        self.strict_dedup = strict_dedup
+        self.workers = workers
+        self.parts = {}      # relpath -> {"uid", "fp", "df"/"dropped", "hashes", "keep", "cubes", "sketch", "branches", "span"}
+        self.version = None
+        self.snapshot = None
+        self._row_src = None  # รหัสแถวต้นทางของแต่ละแถวใน snapshot df
+        self._next_uid = 0
+        self.dedup_counts = {}
+        self.last_workers = 1
+        self._lock = threading.Lock()
+
+    def _load_parts(self, names: list) -> list:
+        """[(df, hashes)] ของแต่ละไฟล์ — หลายไฟล์ใช้ process pool (spawn: ไม่ fork thread ของ Streamlit ติดไปด้วย)
+
+        ผลของ worker ถูก pickle กลับมาทาง pipe (ฝั่งนี้ได้สำเนาใหม่ของทุก shard) — worker ที่ล้มส่ง exception กลับมาที่นี่
+        """
+        paths = [os.path.join(self.root, n) for n in names]
+        workers = min(self.workers, len(paths))
+        if workers <= 1 or sum(os.path.getsize(p) for p in paths) < INGEST_PARALLEL_MIN_MB * 2**20:
+            self.last_workers = 1
+            return [_clean_shard(p) for p in paths]
+        self.last_workers = workers
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return list(pool.map(_clean_shard, paths))
+
+    def _restore_parts(self, names: list):
+        """ประกอบ frame ของ partition (ลำดับแถวเดิม) จาก frame รวมของรอบก่อน + แถวที่ถูกตัดทิ้ง"""
+        names = [n for n in names if "df" not in self.parts[n]]
+        if not names:
+            return
+        df, order = self.snapshot[0], np.argsort(self._row_src, kind="stable")
+        src = self._row_src[order]
+        for n in names:
+            part = self.parts[n]
+            lo, hi = np.searchsorted(src, [part["uid"] << 32, (part["uid"] + 1) << 32])
+            rows, pos = df.take(order[lo:hi]), src[lo:hi] & 0xFFFFFFFF
+            dropped, dropped_pos = part.pop("dropped")
+            if len(dropped):
+                rows = concat_frames([rows[dropped.columns], dropped])
+                rows = rows.take(np.argsort(np.concatenate([pos, dropped_pos]), kind="stable"))
+            part["df"] = rows[part["columns"]].reset_index(drop=True)
+
+    def _release_parts(self, names: list):
+        """หลังสร้าง frame รวม: เก็บไว้เฉพาะแถวที่ถูกตัดทิ้ง (ปกติไม่กี่ %) แทน frame ทั้ง partition"""
+        for n in names:
+            part = self.parts[n]
+            df, drop = part.pop("df"), ~part["keep"]
+            part["dropped"] = (df[drop], np.flatnonzero(drop))
+
+    def _hashes(self, part: dict, cols) -> np.ndarray:
+        key = tuple(cols)
+        if key not in part["hashes"]:
+            part["hashes"][key] = key_hashes(part["df"], cols)
+        return part["hashes"][key]
+
+    def _dedup(self, names: list, notes: list) -> list:
+        """mask แถวที่เก็บไว้ของแต่ละ partition ตามกติกาเดียวกับ clean_dataframe(strict_dedup=True)"""
+        parts = [self.parts[n] for n in names]
+        keep_all = [np.ones(len(p["df"]), dtype=bool) for p in parts]
+        if not self.strict_dedup or not parts:
+            return keep_all
+        common = [c for c in parts[0]["df"].columns if all(c in p["df"].columns for p in parts)]
+        if shards_disjoint(parts) and {"Branch","Posting Date"} <= set(common):
+            plan = dedup_plan(common, lambda ks: [self._hashes(p, ks) for p in parts], _local_dup_stats)
+            split = lambda keep: keep
+        else:
+            plan = dedup_plan(common, lambda ks: np.concatenate([self._hashes(p, ks) for p in parts]))
+            bounds = np.cumsum([0] + [len(p["df"]) for p in parts])
+            split = lambda keep: [keep[bounds[i]:bounds[i + 1]] for i in range(len(parts))]
+        self.dedup_counts = plan["counts"]
+        if plan["used_key"] is not None:
+            keeps = split(plan["keep"])
+            removed = sum(len(k) - int(k.sum()) for k in keeps)
+            notes.append(f"🧹 ลบข้อมูลซ้ำ {removed:,} แถว ด้วยคีย์ {plan['used_key']}")
+            return keeps
+        if plan["dup_any"] > 0:
+            notes.append(f"พบรูปแบบซ้ำ {plan['dup_any']:,} แถว แต่ไม่มีคีย์ที่เหมาะสม — กรุณาตรวจคีย์เอกลักษณ์")
+        return keep_all
+
+    def refresh(self, fingerprint: str):
+        """อัปเดตเฉพาะ partition ใหม่/เปลี่ยน คืน (df, cubes, sketch, notes, stats)"""
+        with self._lock:
+            if fingerprint == self.version and self.snapshot is not None:
+                return self.snapshot
+            t0 = time.perf_counter()
+            listing = list_partitions(self.source)
+            if not listing:
+                raise FileNotFoundError(f"ไม่พบไฟล์ parquet ใน {self.source}")
+            names = [n for n, _ in listing]
+            changed = [(n, fp) for n, fp in listing if self.parts.get(n, {}).get("fp") != fp]
+            stale = set(self.parts) - set(names) | {n for n, _ in changed}
+            self._restore_parts([n for n in self.parts if n not in stale])
+            self.snapshot = self._row_src = None
+            for n in stale:
+                self.parts.pop(n, None)
+            for (n, fp), (df, hashes) in zip(changed, self._load_parts([n for n, _ in changed])):
+                dates = df["Posting Date"]
+                self._next_uid += 1
+                self.parts[n] = {
+                    "uid": self._next_uid, "fp": fp, "df": df, "columns": list(df.columns), "hashes": hashes,
+                    "keep": None, "cubes": None, "sketch": None,
+                    "branches": set(df["Branch"].unique()) if "Branch" in df.columns else set(),
+                    "span": (dates.min(), dates.max()) if len(df) else None,
+                }
+            t_load = time.perf_counter() - t0
+
+            notes = []
+            for n, keep in zip(names, self._dedup(names, notes)):
+                part = self.parts[n]
+                if part["cubes"] is None or not np.array_equal(part["keep"], keep):
+                    part["keep"] = keep
+                    kept = part["df"] if keep.all() else part["df"][keep]
+                    part["cubes"] = build_cubes(kept)
+                    part["sketch"] = collection_sketch(collection_rows(kept))
+
+            # shard ที่ไม่มีแถวซ้ำไม่ผ่าน boolean mask (ตัด copy รอบนั้น) — concat_frames ยัง copy ทุก shard ลง frame รวมหนึ่งรอบ
+            # (frame จาก worker เป็นสำเนาที่ unpickle มาแล้ว); เรียงใหม่เฉพาะเมื่อต่อกันแล้วยังไม่เรียง
+            parts = [self.parts[n] for n in names]
+            kept = [p["df"] if p["keep"].all() else p["df"][p["keep"]] for p in parts]
+            row_src = np.concatenate([(p["uid"] << 32) | np.flatnonzero(p["keep"]) for p in parts])
+            df = concat_frames(kept)
+            del kept
+            if not is_branch_date_sorted(df, "Posting Date"):
+                order = df[["Branch", "Posting Date"]].sort_values(["Branch", "Posting Date"], kind="stable").index.to_numpy()
+                df, row_src = df.take(order).reset_index(drop=True), row_src[order]
+            cubes = merge_cubes([self.parts[n]["cubes"] for n in names])
+            sketch = merge_sketches([self.parts[n]["sketch"] for n in names])
+            stats = {"ingest": {
+                "partitions": len(names),
+                "refreshed": len(changed),
+                "workers": self.last_workers,
+                "load_seconds": t_load,
+                "seconds": time.perf_counter() - t0,
+            }, "dedup": self.dedup_counts}
+            self.version = fingerprint
+            self.snapshot = (df, cubes, sketch, tuple(notes), stats)
+            self._row_src = row_src
+            self._release_parts(names)
+            return self.snapshot
+
+def prepare(source: str, strict_dedup: bool = True, stream: bool = False):
+    """โหลดแหล่งข้อมูล (ไฟล์/URL/โฟลเดอร์ partition) ครั้งเดียว คืน (df, cubes, sketch, notes, stats)
+
+    stream=True → อ่านทีละ batch (stream_aggregates) ไม่มีแถวดิบ: df = None
+    """
+    if stream:
+        return (None, *stream_aggregates(source, strict_dedup))
+    if is_partitioned(source):
+        return PartitionStore(source, strict_dedup).refresh(source_fingerprint(source))
+    df, notes, stats = load_clean(source, strict_dedup, fingerprint=source_fingerprint(source))
+    return df, build_cubes(df), collection_sketch(collection_rows(df)), notes, stats
+
+# ================== SECTIONS ==================
+# ตารางของแต่ละ section คำนวณจาก cube ของ section นั้นที่กรองแล้ว (หรือ sketch สำหรับ DTP/Overdue) — ไม่มีส่วน UI
+DEFAULT_PROFIT_COL = next(iter(PROFIT_FORMULAS.values()))
+MARGIN_LABELS = {c: f"Margin% ({PROFIT_SHORT[c]})" for c in PROFIT_FORMULAS.values()}
+OVERDUE_BINS   = [-9999, -1, 0, 7, 30, 60, 90, 9999]
+OVERDUE_LABELS = ["Early","On time","1–7d","8–30d","31–60d","61–90d",">90d"]
+
+# ส่วน "ปิดท้าย" (ARPC/Margin%/Percent/เดือน) แยกจากการรวมยอด ใช้ร่วมกันระหว่าง pandas กับ DuckDB
+def _kpi(revenue, profit, branches, year_min, year_max) -> dict:
+    return {
+        "revenue": revenue,
+        "profit": profit,
+        "margin": (profit / revenue * 100) if revenue else 0,
+        "branches": branches,
+        "year_range": f"{year_min}–{year_max}",
+    }
+
+def _finish_product(prod: pd.DataFrame) -> pd.DataFrame:
+    total_sum = prod["LineTotal"].sum()
+    prod["Percent"] = (prod["LineTotal"]/total_sum)*100 if total_sum>0 else 0
+    return prod
+
+def _finish_payer_kpi(payer_agg: pd.DataFrame) -> pd.DataFrame:
+    payer_agg["ARPC"] = payer_agg["Revenue"] / payer_agg["Cases"]  # Avg revenue per case
+    payer_agg["Margin%"] = np.where(payer_agg["Revenue"]>0, payer_agg["Profit"]/payer_agg["Revenue"]*100, 0.0)
+    # margin ของทุกสูตรเทียบกัน (กำไรทุกสูตรอยู่ใน cube แล้ว ไม่ต้องคำนวณใหม่)
+    for c, label in MARGIN_LABELS.items():
+        payer_agg[label] = np.where(payer_agg["Revenue"]>0, payer_agg[c]/payer_agg["Revenue"]*100, 0.0)
+    return payer_agg.drop(columns=list(MARGIN_LABELS))
+
+def _finish_trend(trend: pd.DataFrame) -> pd.DataFrame:
+    # YM เป็น int yyyymm → แปลงเป็นวันที่ต้นเดือนเพื่อให้แกนเวลาเรียงถูก
+    trend["YM_ord"] = pd.to_datetime(trend["YM"].astype(str), format="%Y%m")
+    trend["Month"] = trend["YM_ord"].dt.strftime("%Y-%m")
+    return trend
+
+def _finish_payment_mix(paym: pd.DataFrame) -> pd.DataFrame:
+    paym["ARPC"] = np.where(paym["Cases"]>0, paym["Revenue"]/paym["Cases"], 0)
+    paym = paym.sort_values("Revenue", ascending=False)
+    total_rev = paym["Revenue"].sum()
+    paym["Percent"] = np.where(total_rev>0, paym["Revenue"]/total_rev*100, 0.0)
+    return paym
+
+def kpi_summary(cube: pd.DataFrame, profit_col: str = DEFAULT_PROFIT_COL) -> dict:
+    years = cube["Day"].dt.year
+    return _kpi(cube["LineTotal"].sum(), cube[profit_col].sum(), cube["Branch"].nunique(), years.min(), years.max())
+
+def top_branches(cube: pd.DataFrame, profit_col: str = DEFAULT_PROFIT_COL, n: int = 5) -> pd.DataFrame:
+    return (
+        cube.groupby("Branch", observed=True)[ ["LineTotal",profit_col] ].sum()
+          .rename(columns={profit_col: "Profit"})
+          .sort_values("LineTotal", ascending=False)
+          .head(n)
+          .reset_index()
+    )
+
+def product_contribution(cube: pd.DataFrame, n: int = 10) -> pd.DataFrame:
+    return _finish_product(cube.groupby("Description", observed=True)["LineTotal"].sum()
+                           .reset_index()
+                           .sort_values("LineTotal", ascending=False).head(n))
+
+def disease_age(cube: pd.DataFrame) -> pd.DataFrame:
+    """อายุเฉลี่ย + จำนวนเคสต่อกลุ่มโรค เรียงตามจำนวนเคส"""
+    return (
+        cube.groupby("disease_group_mapped", as_index=False, observed=True)
+        .agg(age_sum=("age_sum","sum"), age_cnt=("age_cnt","sum"), Cases=("Cases","sum"))
+        .assign(AverageAge=lambda d: d["age_sum"] / d["age_cnt"])
+        [["disease_group_mapped","AverageAge","Cases"]]
+        .sort_values(["Cases","AverageAge"], ascending=[False, False])
+    )
+
+def payer_kpi(cube: pd.DataFrame, profit_col: str = DEFAULT_PROFIT_COL) -> pd.DataFrame:
+    """Revenue / Profit / Cases / ARPC / Margin% ต่อสิทธิการรักษา + Margin% ของทุกสูตร (MARGIN_LABELS)"""
+    payer_agg = (
+        cube.groupby("Customer/Vendor Name", as_index=False, observed=True)
+        .agg(
+            Revenue=("LineTotal","sum"),
+            Profit=(profit_col,"sum"),
+            Cases=("Cases","sum"),
+            **{c: (c,"sum") for c in PROFIT_FORMULAS.values()},
+        )
+        .sort_values("Revenue", ascending=False)
+    )
+    return _finish_payer_kpi(payer_agg)
+
+def hospital_payer_cross(cube: pd.DataFrame) -> pd.DataFrame:
+    return (cube.groupby(["โรงพยาบาล","Customer/Vendor Name"], observed=True)
+            .agg(Cases=("Cases","sum"), Revenue=("LineTotal","sum"))
+            .reset_index())
+
+def top_cross(cross: pd.DataFrame, metric: str, top_h: int, top_p: int):
+    """ตัด cross เหลือ top_h โรงพยาบาล × top_p สิทธิ (จัดอันดับตาม metric) คืน (cross_f, hosp_order, payer_order)"""
+    hosp_order = cross.groupby("โรงพยาบาล", observed=True)[metric].sum().sort_values(ascending=False).head(top_h).index.tolist()
+    payer_order = cross.groupby("Customer/Vendor Name", observed=True)[metric].sum().sort_values(ascending=False).head(top_p).index.tolist()
+    cross_f = cross[cross["โรงพยาบาล"].isin(hosp_order) & cross["Customer/Vendor Name"].isin(payer_order)].copy()
+    cross_f["โรงพยาบาล"] = cross_f["โรงพยาบาล"].astype(pd.CategoricalDtype(hosp_order, ordered=True))
+    cross_f["Customer/Vendor Name"] = cross_f["Customer/Vendor Name"].astype(pd.CategoricalDtype(payer_order, ordered=True))
+    return cross_f, hosp_order, payer_order
+
+def payer_revenue(cube: pd.DataFrame) -> pd.Series:
+    return (
+        cube.groupby("Customer/Vendor Name", observed=True)["LineTotal"].sum()
+        .sort_values(ascending=False)
+    )
+
+def monthly_trend(cube: pd.DataFrame, payers=None) -> pd.DataFrame:
+    """รายได้รายเดือน × สิทธิการรักษา (payers=None → ทุกสิทธิ)"""
+    if payers is not None:
+        cube = cube[cube["Customer/Vendor Name"].isin(payers)]
+    return _finish_trend(cube.groupby(["YM","Customer/Vendor Name"], as_index=False, observed=True)["LineTotal"].sum())
+
+def payment_mix(cube: pd.DataFrame) -> pd.DataFrame:
+    return _finish_payment_mix(cube.groupby("Payment Method", as_index=False, observed=True)
+                               .agg(Revenue=("LineTotal","sum"), Cases=("Cases","sum")))
+
+def branch_totals(cube: pd.DataFrame) -> pd.DataFrame:
+    return (cube.groupby("Branch", as_index=False, observed=True)["LineTotal"].sum()
+            .sort_values("LineTotal", ascending=False))
+
+def collection_rows(df: pd.DataFrame):
+    """แถวสำหรับ DTP/Overdue: Branch, Posting Date, สิทธิ, LineTotal + DaysToPay/DaysOverdue
+    (None ถ้าไม่มี Posting Date หรือไม่มีทั้งวันจ่ายและวันครบกำหนด)"""
+    pay_date_col = "Payment Date" if "Payment Date" in df.columns else ("Paid Date" if "Paid Date" in df.columns else None)
+    has_due = "Due Date" in df.columns
+    if "Posting Date" not in df.columns or not (pay_date_col or has_due):
+        return None
+    out = df[[c for c in ["Branch","Posting Date","Customer/Vendor Name","LineTotal"] if c in df.columns]].copy()
+    # Days to Pay (DTP) และ Days Overdue (ถ้ามี Due Date)
+    if pay_date_col:
+        out["DaysToPay"] = (df[pay_date_col] - df["Posting Date"]).dt.days
+    if has_due:
+        out["DaysOverdue"] = (df.get(pay_date_col, df["Due Date"]) - df["Due Date"]).dt.days
+    return out
+
+def dtp_by_payer(rows: pd.DataFrame) -> pd.DataFrame:
+    """median Days to Pay ต่อสิทธิการรักษา (เฉพาะบรรทัดที่มีค่า)"""
+    return (rows.dropna(subset=["DaysToPay"])
+            .groupby("Customer/Vendor Name", as_index=False, observed=True)["DaysToPay"].median()
+            .sort_values("DaysToPay"))
+
+def overdue_buckets(rows: pd.DataFrame) -> pd.DataFrame:
+    """สัดส่วนยอดเงินตามช่วงวันที่ค้างชำระ (OVERDUE_LABELS)"""
+    dov = rows.dropna(subset=["DaysOverdue"]).copy()
+    dov["OverdueBucket"] = pd.cut(dov["DaysOverdue"], bins=OVERDUE_BINS, labels=OVERDUE_LABELS)
+    dist = dov.groupby("OverdueBucket", as_index=False)["LineTotal"].sum()
+    total = dist["LineTotal"].sum()
+    dist["Percent"] = np.where(total>0, dist["LineTotal"]/total*100, 0.0)
+    return dist
+
+def section_tables(cubes: dict, sketch: dict = None, profit_col: str = DEFAULT_PROFIT_COL) -> dict:
+    """ตารางของทุก section สำหรับมุมมองที่ส่งมา (ใช้ตอน precompute มุมมองเริ่มต้น: ทุกสาขา ทุกช่วงวันที่)"""
+    q = PandasSections(cubes)
+    tables = {
+        "kpi": pd.DataFrame([q.kpi_summary(profit_col)]),
+        "top_branches": q.top_branches(profit_col),
+        "branch_totals": q.branch_totals(),
+    }
+    if "product" in cubes:
+        tables["product_contribution"] = q.product_contribution()
+    if "disease" in cubes and "age_sum" in cubes["disease"].columns:
+        tables["disease_age"] = q.disease_age()
+    if "payer" in cubes:
+        tables["payer_kpi"] = q.payer_kpi(profit_col)
+        tables["monthly_trend"] = q.monthly_trend()
+    if "hospital" in cubes:
+        tables["hospital_payer"] = q.hospital_payer_cross()
+    if "payment" in cubes:
+        tables["payment_mix"] = q.payment_mix()
+    if sketch:
+        if "dtp" in sketch:
+            tables["dtp_by_payer"] = dtp_quantiles(sketch["dtp"])
+        if "overdue" in sketch:
+            tables["overdue_buckets"] = sketch_overdue_buckets(sketch["overdue"])
+    return tables
+
+class PandasSections:
+    """section ทั้งหมดบน cube (pandas) ที่กรองแล้ว — interface เดียวกับ DuckDBSections
+
+    แต่ละ section อ่านเฉพาะ cube ของตัวเอง (CUBES); rows = callable คืนแถวรายการของสาขาที่เลือกใน month_span
+    (ส่งมาเมื่อเลือกบางสาขา) → ฮีตแมปรวมจากแถวแทน cube "hospital" ที่เป็นยอดทุกสาขา
+    """
+
+    def __init__(self, cubes: dict, rows=None):
+        self.cubes = cubes
+        self.rows = rows
+        self.columns = cube_columns(cubes)
+        self.empty = cubes["daily"].empty
+
+    def __len__(self):
+        return sum(len(c) for c in self.cubes.values())
+
+    def kpi_summary(self, profit_col=DEFAULT_PROFIT_COL):  return kpi_summary(self.cubes["daily"], profit_col)
+    def top_branches(self, profit_col=DEFAULT_PROFIT_COL, n=5):  return top_branches(self.cubes["daily"], profit_col, n)
+    def product_contribution(self, n=10):  return product_contribution(self.cubes["product"], n)
+    def disease_age(self):  return disease_age(self.cubes["disease"])
+    def payer_kpi(self, profit_col=DEFAULT_PROFIT_COL):  return payer_kpi(self.cubes["payer"], profit_col)
+    def payer_revenue(self):  return payer_revenue(self.cubes["payer"])
+    def monthly_trend(self, payers=None):  return monthly_trend(self.cubes["payer"], payers)
+    def payment_mix(self):  return payment_mix(self.cubes["payment"])
+    def branch_totals(self):  return branch_totals(self.cubes["daily"])
+
+    def hospital_payer_cross(self):
+        if self.rows is None:
+            return hospital_payer_cross(self.cubes["hospital"])
+        return (self.rows().groupby(["โรงพยาบาล","Customer/Vendor Name"], observed=True)
+                .agg(Cases=("LineTotal","size"), Revenue=("LineTotal","sum"))
+                .reset_index())
+
+# ================== STREAMING (OUT-OF-CORE) ==================
+# ไฟล์ใหญ่กว่าหน่วยความจำ: อ่าน parquet ทีละ record batch → clean + กำไร ราย batch → พับเข้า cube ของทุก section + sketch การรับชำระ
+# ไม่มีแถวดิบค้างในหน่วยความจำ: สูงสุด ≈ 1 batch + cube + sketch (+ strict de-dup: 1 ก้อนของ HashSpill
+# + 8 ไบต์ต่อแถวที่ถูกตัด — hash ทั้งไฟล์อยู่บนดิสก์ 16 ไบต์/แถวต่อคีย์ ใน DEDUP_SPILL_DIR)
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", 500_000))
+STREAM_FOLD_EVERY = 8  # รวม cube/sketch ย่อยทุก n batch (จำนวนก้อนที่ค้างไม่โตตามไฟล์)
+
+def _source_paths(source: str) -> list:
+    """ไฟล์ parquet ของ source ตามลำดับ (ไฟล์/URL ที่แคชแล้ว → 1 ไฟล์, โฟลเดอร์/glob → ทุก partition)"""
+    if is_partitioned(source):
+        root = partition_root(source)
+        return [os.path.join(root, name) for name, _ in list_partitions(source)]
+    return [_open_source(source)]
+
+def source_rows(source: str) -> int:
+    """จำนวนแถวทั้งหมดจาก metadata ของ parquet (ไม่อ่านข้อมูล)"""
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in _source_paths(source))
+
+def iter_batches(source: str, batch_rows: int = STREAM_BATCH_ROWS):
+    """DataFrame ดิบทีละ batch (เฉพาะคอลัมน์ที่ dashboard ใช้) จากไฟล์/URL/โฟลเดอร์/glob ตามลำดับไฟล์"""
+    for path in _source_paths(source):
+        pf = pq.ParquetFile(path, memory_map=True)
+        for batch in pf.iter_batches(batch_size=batch_rows, columns=resolve_columns(pf.schema_arrow.names)):
+            yield batch.to_pandas()
+
+def iter_clean_batches(source: str, batch_rows: int = STREAM_BATCH_ROWS):
+    """clean (ไม่ de-dup) + คอลัมน์กำไร ทีละ batch"""
+    for raw in iter_batches(source, batch_rows):
+        yield add_profit_columns(clean_dataframe(raw, strict_dedup=False))
+
+def _stream_dedup_plan(source: str, batch_rows: int) -> dict:
+    """รอบแรก: dedup_plan เดียวกับ clean_dataframe จาก hash ที่ spill ลงดิสก์ (keep = index แถวที่ตัดของทั้งไฟล์)"""
+    batches = lambda: (clean_dataframe(raw, strict_dedup=False) for raw in iter_batches(source, batch_rows))
+    return spill_dedup_plan(batches, source_rows(source), batch_rows)
+
+def stream_aggregates(source: str, strict_dedup: bool = True, batch_rows: int = STREAM_BATCH_ROWS):
+    """ทางเลือก out-of-core ของ load_clean + build_cubes คืน (cubes, sketch, notes, stats)
+
+    ผลเท่ากับ build_cubes(load_clean(...)) และ collection_sketch ของแถวรับชำระ แต่อ่านไฟล์ทีละ batch
+    (strict de-dup อ่าน 2 รอบ: รอบแรกหาแถวซ้ำจาก hash ที่ spill ลงดิสก์, รอบสองพับ batch ที่ตัดแถวซ้ำแล้ว)
+    """
+    notes, stats, stages = [], {}, StageLog()
+    drop = None
+    if strict_dedup:
+        with stages.stage("stream: hash keys (pass 1)"):
+            plan = _stream_dedup_plan(source, batch_rows)
+        stats["dedup"] = plan["counts"]
+        if plan["used_key"] is not None:
+            drop = plan["keep"]
+            notes.append(f"🧹 ลบข้อมูลซ้ำ {len(drop):,} แถว ด้วยคีย์ {plan['used_key']}")
+        elif plan["dup_any"] > 0:
+            notes.append(f"พบรูปแบบซ้ำ {plan['dup_any']:,} แถว แต่ไม่มีคีย์ที่เหมาะสม — กรุณาตรวจคีย์เอกลักษณ์")
+
+    cubes, sketches = [], []
+    offset = batches = rows_kept = 0
+    with stages.stage("stream: clean + fold") as out:
+        for batch in iter_clean_batches(source, batch_rows):
+            n = len(batch)
+            lo, hi = np.searchsorted(drop, [offset, offset + n]) if drop is not None else (0, 0)
+            if hi > lo:
+                keep = np.ones(n, dtype=bool)
+                keep[drop[lo:hi] - offset] = False
+                batch = batch[keep]
+            offset += n
+            batches += 1
+            rows_kept += len(batch)
+            cubes.append(build_cubes(batch))
+            sketches.append(collection_sketch(collection_rows(batch)))
+            del batch
+            if len(cubes) >= STREAM_FOLD_EVERY:
+                cubes, sketches = [merge_cubes(cubes)], [merge_sketches(sketches)]
+        cubes, sketch = merge_cubes(cubes), merge_sketches(sketches)
+        out["rows_in"], out["rows_out"] = offset, sum(len(c) for c in cubes.values())
+    stats["stream"] = {"batches": batches, "batch_rows": batch_rows, "rows": offset, "rows_kept": rows_kept,
+                       "passes": 2 if strict_dedup else 1}
+    stats["stages"] = stages.records
+    return cubes, sketch, tuple(notes), stats
+
+# ================== COLLECTION SKETCH ==================
+# แถวรับชำระย่อเป็นฮิสโตแกรมที่รวมกันได้ต่อ (สาขา, เดือน, สิทธิ) — DaysToPay เป็นจำนวนเต็มวัน
+# จึงนับจำนวนบรรทัดต่อค่าได้ตรง ๆ (quantile ที่ได้เท่ากับคำนวณจากแถวจริง) และยอดเงินต่อช่วง OVERDUE_LABELS
+# เป็นส่วนหนึ่งของสถานะที่คำนวณไว้ทุกโหมด (cache/partition/stream/artifacts) → section 5 ไม่แตะแถวดิบ
+SKETCH_DIMS = ["Branch","YM","Customer/Vendor Name"]
+DTP_QUANTILES = {0.5: "DaysToPay", 0.9: "p90", 0.99: "p99"}  # DaysToPay = median (ชื่อเดียวกับ dtp_by_payer)
+
+def collection_sketch(rows) -> dict:
+    """{"dtp": dims + DaysToPay → Count, "overdue": dims + OverdueBucket → LineTotal} (ไม่มีคอลัมน์ → ไม่มี key)"""
+    if rows is None or rows.empty:
+        return {}
+    base = pd.DataFrame({c: rows[c] for c in SKETCH_DIMS if c in rows.columns})
+    base["YM"] = (rows["Posting Date"].dt.year * 100 + rows["Posting Date"].dt.month).astype("int32")
+    dims = [c for c in SKETCH_DIMS if c in base.columns]
+    out = {}
+    if "DaysToPay" in rows.columns:
+        has = rows["DaysToPay"].notna()
+        out["dtp"] = (base[has].assign(DaysToPay=rows.loc[has, "DaysToPay"].astype("int32"))
+                      .groupby([*dims, "DaysToPay"], observed=True, dropna=False).size()
+                      .rename("Count").reset_index())
+    if "DaysOverdue" in rows.columns:
+        bucket = pd.cut(rows["DaysOverdue"], bins=OVERDUE_BINS, labels=OVERDUE_LABELS)
+        has = bucket.notna()
+        out["overdue"] = (base[has].assign(OverdueBucket=bucket[has], LineTotal=rows.loc[has, "LineTotal"])
+                          .groupby([*dims, "OverdueBucket"], observed=True, dropna=False)["LineTotal"].sum()
+                          .reset_index())
+    return out
+
+def merge_sketches(sketches: list) -> dict:
+    """รวม sketch หลายก้อน (ช่วงซ้อนกันได้) — บวกค่าของ key เดียวกัน"""
+    out = {}
+    for kind, measure in (("dtp","Count"), ("overdue","LineTotal")):
+        parts = [sk[kind] for sk in sketches if kind in sk]
+        if parts:
+            merged = concat_frames(parts)
+            keys = [c for c in merged.columns if c != measure]
+            out[kind] = merged.groupby(keys, observed=True, dropna=False)[measure].sum().reset_index()
+    return out
+
+def filter_sketch(sketch: dict, start, end_excl, branches) -> dict:
+    """sketch ของสาขาที่เลือกในเดือนที่ทับช่วง [start, end_excl) (ละเอียดระดับเดือน: เดือนต้น/ท้ายนับทั้งเดือน)"""
+    last = pd.Timestamp(end_excl) - pd.Timedelta(days=1)
+    ym_lo, ym_hi = start.year * 100 + start.month, last.year * 100 + last.month
+    out = {}
+    for kind, t in sketch.items():
+        mask = t["YM"].between(ym_lo, ym_hi)
+        if "Branch" in t.columns:
+            mask &= t["Branch"].isin(branches)
+        out[kind] = t[mask]
+    return out
+
+def _hist_quantiles(hist: pd.DataFrame, by: str, value: str, qs) -> pd.DataFrame:
+    """quantile (interpolation แบบ linear เหมือน pandas) ของ value ต่อกลุ่ม by จากตาราง value → Count"""
+    h = hist.groupby([by, value], observed=True)["Count"].sum()
+    h = h[h > 0]
+    counts, vals = h.to_numpy(), h.index.get_level_values(value).to_numpy(dtype="float64")
+    codes, groups = pd.factorize(h.index.get_level_values(by))  # เรียงตาม by แล้ว → กลุ่มติดกัน
+    n = np.bincount(codes, weights=counts, minlength=len(groups))
+    cum = np.cumsum(counts)
+    base = np.concatenate(([0], np.cumsum(n)[:-1]))
+    out = {by: groups}
+    for q, label in qs.items():
+        pos = q * (n - 1)
+        lo, hi = np.floor(pos), np.ceil(pos)
+        v_lo = vals[np.searchsorted(cum, base + lo, side="right")]
+        v_hi = vals[np.searchsorted(cum, base + hi, side="right")]
+        out[label] = v_lo + (v_hi - v_lo) * (pos - lo)
+    return pd.DataFrame(out)
+
+def dtp_quantiles(dtp: pd.DataFrame, qs: dict = DTP_QUANTILES) -> pd.DataFrame:
+    """median (DaysToPay) + p90/p99 ของ Days to Pay ต่อสิทธิการรักษา รวมจาก sketch — ค่าตรงกับคำนวณจากแถว"""
+    return _hist_quantiles(dtp, "Customer/Vendor Name", "DaysToPay", qs).sort_values("DaysToPay")
+
+def sketch_overdue_buckets(overdue: pd.DataFrame) -> pd.DataFrame:
+    """เหมือน overdue_buckets แต่รวมจาก sketch"""
+    dist = overdue.groupby("OverdueBucket", as_index=False, observed=True)["LineTotal"].sum()
+    total = dist["LineTotal"].sum()
+    dist["Percent"] = np.where(total>0, dist["LineTotal"]/total*100, 0.0)
+    return dist
+
+# ================== PATIENT COHORTS ==================
+# มุมมองรายผู้ป่วย: ledger หนึ่งแถวต่อ (ผู้ป่วย, วัน, สาขา, สิทธิ) เรียงตามผู้ป่วย → วัน สร้างครั้งเดียวต่อชุดข้อมูล
+# ด้วย sort + np.add.reduceat บน code จำนวนเต็ม (ไม่มี groupby ระดับ Python) แล้วทุกตัวชี้วัดคิดจาก ledger ที่กรองแล้ว
+# ต้องมีรหัสผู้ป่วยจริง (alias ใน PATIENT_ALIASES → "Patient ID") — Document No ไม่ใช่ผู้ป่วย (ทุกเอกสารจะเป็นผู้ป่วยใหม่
+# ที่มาครั้งเดียว) จึงไม่ใช้แทน: ไม่มีคอลัมน์ → ไม่มี ledger และ dashboard ซ่อน section รายผู้ป่วย
+PATIENT_KEYS = ["Patient ID"]
+VISIT_BUCKETS = ["1","2","3","4","5+"]
+REVISIT_BINS = [0, 7, 30, 90, 180, 365]
+REVISIT_LABELS = ["1–7 วัน","8–30 วัน","31–90 วัน","91–180 วัน","181–365 วัน",">365 วัน"]
+COHORT_MAX_MONTHS = 12
+
+def patient_key(columns):
+    """คอลัมน์คีย์ผู้ป่วยตัวแรกที่มี (None ถ้าไม่มีเลย)"""
+    return next((c for c in PATIENT_KEYS if c in columns), None)
+
+def _group_starts(codes: list, sizes: list):
+    """เรียงแถวตามคีย์หลายคอลัมน์ (ตัวแรกสำคัญสุด) คืน (order, starts) — starts = ตำแหน่งแรกของแต่ละกลุ่มใน order
+
+    ถ้าผลคูณขนาดของทุกคีย์พอดี int64 รวมเป็นคีย์เดียวแล้ว argsort ครั้งเดียว (เร็วกว่า lexsort หลายคีย์)
+    """
+    n = len(codes[0])
+    if n == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    if np.prod([float(s) for s in sizes]) < 2**62:
+        key = np.zeros(n, np.int64)
+        for c, s in zip(codes, sizes):
+            key *= s
+            key += c
+        order = np.argsort(key)  # ลำดับภายในกลุ่มไม่มีผล (reduceat รวมทั้งกลุ่ม)
+        k = key[order]
+        change = k[1:] != k[:-1]
+    else:
+        order = np.lexsort(codes[::-1])
+        change = np.zeros(n - 1, dtype=bool)
+        for c in codes:
+            cs = c[order]
+            change |= cs[1:] != cs[:-1]
+    return order, np.flatnonzero(np.concatenate(([True], change)))
+
+def _distinct(a: np.ndarray, counts: bool = False):
+    """ค่าไม่ซ้ำแบบ sort (np.unique ของ NumPy 2 ใช้ hash ซึ่งช้ากว่ามากบน int64 หลายสิบล้านค่า)"""
+    s = np.sort(a)
+    first = np.flatnonzero(np.concatenate(([True], s[1:] != s[:-1]))) if len(s) else np.zeros(0, np.int64)
+    return (s[first], np.diff(np.append(first, len(s)))) if counts else s[first]
+
+def patient_ledger(df: pd.DataFrame, key: str = None) -> pd.DataFrame:
+    """ledger รายผู้ป่วยจากแถวที่ clean แล้ว: Patient (code int32), Day, Branch, Customer/Vendor Name, LineTotal, Lines
+
+    เรียงตาม (Patient, Day, Branch, สิทธิ); แถวที่ไม่มีคีย์ผู้ป่วยถูกตัดทิ้ง — คืน None ถ้าไม่มีคอลัมน์คีย์
+    """
+    key = key or patient_key(df.columns)
+    if key is None:
+        return None
+    pid, _ = pd.factorize(df[key])
+    has = slice(None) if (pid >= 0).all() else pid >= 0  # ทุกแถวมีคีย์ → view ไม่ต้อง copy
+    day = df["Posting Date"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    day0 = int(day.min()) if len(day) else 0
+    codes = [pid[has].astype(np.int64), day[has] - day0]
+    sizes, dims = [int(pid.max()) + 1 if len(pid) else 1, int(codes[1].max()) + 1 if len(codes[1]) else 1], []
+    for c in ("Branch", "Customer/Vendor Name"):
+        if c in df.columns:
+            cat = pd.Categorical(df[c])
+            codes.append(cat.codes[has].astype(np.int64) + 1)  # NA = -1 → 0
+            sizes.append(len(cat.categories) + 1)
+            dims.append((c, cat.categories))
+    order, starts = _group_starts(codes, sizes)
+    first = order[starts]
+    out = {
+        "Patient": codes[0][first].astype(np.int32),
+        "Day": (codes[1][first] + day0).astype("datetime64[D]").astype("datetime64[ns]"),
+    }
+    for (c, cats), cs in zip(dims, codes[2:]):
+        out[c] = pd.Categorical.from_codes(cs[first] - 1, categories=cats)
+    out["LineTotal"] = np.add.reduceat(df["LineTotal"].to_numpy(dtype="float64")[has][order], starts) \
+        if len(starts) else np.zeros(0)
+    out["Lines"] = np.diff(np.append(starts, len(order))).astype(np.int32)
+    return pd.DataFrame(out)
+
+def filter_ledger(ledger: pd.DataFrame, start, end_excl, branches) -> pd.DataFrame:
+    """แถวของ ledger ในสาขาที่เลือก และ start <= Day < end_excl (คงลำดับผู้ป่วย → วัน)"""
+    day = ledger["Day"].to_numpy()
+    mask = (day >= np.datetime64(start, "ns")) & (day < np.datetime64(end_excl, "ns"))
+    if "Branch" in ledger.columns:
+        mask &= ledger["Branch"].isin(branches).to_numpy()
+    return ledger[mask]
+
+def _visits(ledger: pd.DataFrame):
+    """ตัวแปรระดับการมา (ผู้ป่วย, วัน) จาก ledger ที่เรียงแล้ว: (ตำแหน่งแถวแรกของแต่ละ visit, ตำแหน่ง visit แรกของแต่ละผู้ป่วย)"""
+    p = ledger["Patient"].to_numpy()
+    d = ledger["Day"].to_numpy()
+    new_patient = np.concatenate(([True], p[1:] != p[:-1])) if len(p) else np.zeros(0, bool)
+    new_visit = new_patient.copy()
+    new_visit[1:] |= d[1:] != d[:-1]
+    v_rows = np.flatnonzero(new_visit)
+    v_first = np.flatnonzero(new_patient[v_rows])
+    return v_rows, v_first
+
+def _bucket_table(counts: np.ndarray, labels: list, name: str, count_col: str) -> pd.DataFrame:
+    total = counts.sum()
+    return pd.DataFrame({name: labels, count_col: counts,
+                         "Percent": counts / total * 100 if total else np.zeros(len(labels))})
+
+def patient_tables(ledger: pd.DataFrame, max_months: int = COHORT_MAX_MONTHS) -> dict:
+    """ตัวชี้วัดรายผู้ป่วยของ ledger ที่กรองแล้ว (ทุกตารางคำนวณจาก sort ครั้งเดียวของ ledger)
+
+    summary: patients / visits / revisit_rate (% ผู้ป่วยที่มา ≥ 2 ครั้ง) / visits_per_patient / revenue_per_patient / median_revisit_days
+    visits: จำนวนผู้ป่วยตามจำนวนครั้งที่มา • revisits: ระยะห่างระหว่างการมาครั้งถัดไปของผู้ป่วยคนเดิม
+    cohorts: retention ตามเดือนที่มาครั้งแรก × สาขาแรก (Cohort, Branch, MonthsSince, Patients, Retention%)
+    payers: รายได้ต่อผู้ป่วยตามสิทธิการรักษา
+    """
+    v_rows, v_first = _visits(ledger)
+    n_pat, n_vis = len(v_first), len(v_rows)
+    visits = np.diff(np.append(v_first, n_vis))                     # จำนวนครั้งที่มาต่อผู้ป่วย
+    v_pat = np.repeat(np.arange(n_pat), visits)                     # ผู้ป่วย (ลำดับ 0..n_pat-1) ของแต่ละ visit
+    v_day = ledger["Day"].to_numpy()[v_rows].astype("datetime64[D]").astype(np.int64)
+
+    # ระยะห่างระหว่าง visit ติดกันของผู้ป่วยคนเดียวกัน
+    same = v_pat[1:] == v_pat[:-1]
+    gaps = np.diff(v_day)[same]
+    revisit_counts = np.bincount(np.searchsorted(REVISIT_BINS, gaps, side="left") - 1,
+                                 minlength=len(REVISIT_LABELS))[:len(REVISIT_LABELS)]
+
+    # cohort: เดือนที่มาครั้งแรก × สาขาของ visit แรก; นับผู้ป่วยที่ยังมาในเดือนที่ k หลังเดือนแรก (ไม่ซ้ำต่อเดือน)
+    v_month = v_day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    m0 = v_month[v_first]
+    m_lo = int(m0.min()) if n_pat else 0
+    since = v_month - np.repeat(m0, visits)
+    keep = (since <= max_months)
+    keep[1:] &= (v_pat[1:] != v_pat[:-1]) | (since[1:] != since[:-1])  # ผู้ป่วยนับครั้งเดียวต่อเดือน
+    has_branch = "Branch" in ledger.columns
+    b_codes = (ledger["Branch"].cat.codes.to_numpy()[v_rows][v_first].astype(np.int64) + 1
+               if has_branch else np.zeros(n_pat, np.int64))
+    b_cats = ledger["Branch"].cat.categories if has_branch else pd.Index([])
+    c_month = np.repeat(m0 - m_lo, visits)[keep]
+    c_branch = np.repeat(b_codes, visits)[keep]
+    n_b, n_k = len(b_cats) + 1, max_months + 1
+    cell = (c_month * n_b + c_branch) * n_k + since[keep]
+    uniq, cnt = _distinct(cell, counts=True)
+    k, rest = uniq % n_k, uniq // n_k
+    month_idx, b_idx = rest // n_b, rest % n_b
+    cohorts = pd.DataFrame({
+        "Cohort": (month_idx + m_lo).astype("datetime64[M]").astype("datetime64[ns]"),
+        "Branch": pd.Categorical.from_codes(b_idx - 1, categories=b_cats),
+        "MonthsSince": k.astype(np.int16),
+        "Patients": cnt,
+    })
+    first_cell = np.flatnonzero(k == 0)                               # แต่ละ cohort มีเดือน 0 เสมอ และเรียงมาก่อน
+    size = np.repeat(cnt[first_cell], np.diff(np.append(first_cell, len(uniq))))
+    cohorts["Retention%"] = cnt / size * 100
+
+    # รายได้ต่อผู้ป่วยตามสิทธิ: คู่ (สิทธิ, ผู้ป่วย) และ (สิทธิ, ผู้ป่วย, วัน) ที่ไม่ซ้ำ
+    payers = None
+    if "Customer/Vendor Name" in ledger.columns and len(ledger):
+        pay = ledger["Customer/Vendor Name"].cat
+        pc = pay.codes.to_numpy().astype(np.int64) + 1
+        row_pat = np.repeat(v_pat, np.diff(np.append(v_rows, len(ledger))))
+        row_day = ledger["Day"].to_numpy().astype("datetime64[D]").astype(np.int64)
+        row_day -= row_day.min()
+        n_p, n_d = len(pay.categories) + 1, int(row_day.max()) + 1
+        pair = pc * n_pat + row_pat
+        pair_p = _distinct(pair) // n_pat
+        trip_p = _distinct(pair * n_d + row_day) // (n_d * n_pat)
+        rev = np.bincount(pc, weights=ledger["LineTotal"].to_numpy(dtype="float64"), minlength=n_p)
+        pts = np.bincount(pair_p, minlength=n_p)
+        vis = np.bincount(trip_p, minlength=n_p)
+        ok = np.flatnonzero(pts[1:] > 0) + 1  # ไม่รวมแถวที่ไม่มีสิทธิ (code 0)
+        payers = pd.DataFrame({
+            "Customer/Vendor Name": pay.categories[ok - 1],
+            "Patients": pts[ok], "Visits": vis[ok], "Revenue": rev[ok],
+            "RevenuePerPatient": rev[ok] / pts[ok], "VisitsPerPatient": vis[ok] / pts[ok],
+        }).sort_values("Revenue", ascending=False, ignore_index=True)
+
+    revenue = float(ledger["LineTotal"].sum())
+    summary = {
+        "patients": n_pat, "visits": n_vis,
+        "revisit_rate": float((visits >= 2).mean() * 100) if n_pat else 0.0,
+        "visits_per_patient": n_vis / n_pat if n_pat else 0.0,
+        "revenue_per_patient": revenue / n_pat if n_pat else 0.0,
+        "median_revisit_days": float(np.median(gaps)) if len(gaps) else None,
+    }
+    return {
+        "summary": summary,
+        "visits": _bucket_table(np.bincount(np.minimum(visits, len(VISIT_BUCKETS)), minlength=len(VISIT_BUCKETS) + 1)[1:],
+                                VISIT_BUCKETS, "Visits", "Patients"),
+        "revisits": _bucket_table(revisit_counts, REVISIT_LABELS, "Interval", "Revisits"),
+        "cohorts": cohorts,
+        "payers": payers,
+    }
+
+def retention_matrix(cohorts: pd.DataFrame, branches=None) -> pd.DataFrame:
+    """retention รวมทุกสาขา (หรือเฉพาะ branches) ต่อ (Cohort, MonthsSince) — Retention% เทียบขนาด cohort เดือน 0"""
+    c = cohorts if branches is None else cohorts[cohorts["Branch"].isin(branches)]
+    m = c.groupby(["Cohort","MonthsSince"], observed=True)["Patients"].sum().reset_index()
+    size = m.loc[m["MonthsSince"] == 0].set_index("Cohort")["Patients"]
+    m["CohortSize"] = m["Cohort"].map(size)
+    m["Retention%"] = m["Patients"] / m["CohortSize"] * 100
+    return m
+
+# ================== RESULT CACHE ==================
+# ผล section ใช้ร่วมกันทุก session ในโปรเซส: คีย์ = (มุมมอง: ชุดข้อมูล + ช่วงวันที่ + hash ชุดสาขา, เมธอด, อาร์กิวเมนต์)
+# ไล่ออกแบบ LRU เมื่อขนาดรวมเกินงบ — ผลที่คืนเป็นของกลาง ห้ามแก้ไข in-place
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", 256))
+
+def result_nbytes(obj) -> int:
+    """ขนาดโดยประมาณของผล (DataFrame/Series แบบ deep, tuple/list/dict รวมสมาชิก)"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(result_nbytes(x) for x in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(result_nbytes(k) + result_nbytes(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+def view_key(dataset_key: str, start, end, branches) -> tuple:
+    """คีย์ของมุมมองที่กรองแล้ว: ชุดข้อมูล + ช่วงวันที่ + hash ของชุดสาขา (ไม่ขึ้นกับลำดับที่เลือก)"""
+    branch_hash = hashlib.sha1("\n".join(sorted(map(str, set(branches)))).encode("utf-8")).hexdigest()[:16]
+    return (dataset_key, str(pd.Timestamp(start).date()), str(pd.Timestamp(end).date()), branch_hash)
+
+class ResultCache:
+    """LRU ของผลคำนวณ จำกัดด้วย max_bytes; นับ hit/miss/eviction — thread-safe
+
+    คีย์เดียวกันที่กำลังคำนวณอยู่ใน thread อื่น → รอผลนั้นแทนการคำนวณซ้ำ
+    """
+
+    def __init__(self, max_bytes: float = RESULT_CACHE_MB * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items = OrderedDict()   # key -> (value, nbytes)
+        self._pending = {}            # key -> threading.Event ของการคำนวณที่ยังไม่เสร็จ
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get_or_compute(self, key, compute):
+        while True:
+            with self._lock:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return self._items[key][0]
+                pending = self._pending.get(key)
+                if pending is None:
+                    self.misses += 1
+                    pending = self._pending[key] = threading.Event()
+                    break
+            pending.wait()  # thread อื่นคำนวณคีย์นี้อยู่ — ถ้าล้มเหลวจะวนมาคำนวณเอง
+        try:
+            value = compute()
+            self._put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.set()
+
+    def _put(self, key, value):
+        size = result_nbytes(value)
+        with self._lock:
+            if size > self.max_bytes:
+                return  # ใหญ่เกินงบทั้งก้อน — ไม่เก็บ
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, old) = self._items.popitem(last=False)
+                self.nbytes -= old
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._items), "bytes": self.nbytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+class MemoSections:
+    """ห่อ sections ให้ผลของแต่ละ (เมธอด, อาร์กิวเมนต์) ผ่าน ResultCache ภายใต้คีย์มุมมอง key
+
+    cache=None → cache ส่วนตัวไม่จำกัดขนาด; ผลที่คืนห้ามแก้ in-place
+    """
+
+    def __init__(self, sections, cache: ResultCache = None, key=()):
+        self.inner = sections
+        self.columns = sections.columns
+        self.empty = sections.empty
+        self.cache = cache if cache is not None else ResultCache(max_bytes=float("inf"))
+        self.key = key
+
+    def __len__(self):
+        return len(self.inner)
+
+    def _key(self, name, args, kwargs):
+        return (self.key, name, repr(args), repr(sorted(kwargs.items())))
+
+    def has(self, name, *args, **kwargs) -> bool:
+        return self._key(name, args, kwargs) in self.cache
+
+    def cached(self, name, compute, *args):
+        """ผลของงานนอก sections (เช่น top_cross, sketch) ภายใต้คีย์มุมมองเดียวกัน"""
+        return self.cache.get_or_compute(self._key(name, args, {}), compute)
+
+    def __getattr__(self, name):
+        fn = getattr(self.inner, name)
+
+        def call(*args, **kwargs):
+            return self.cache.get_or_compute(self._key(name, args, kwargs), lambda: fn(*args, **kwargs))
+        return call
+
+# ================== SAMPLED PREVIEW ==================
+# ช่วงเลือกใหญ่มาก: วาดทุก section จากตัวอย่างแบบแบ่งชั้น (Branch × เดือน) ของแต่ละ cube ก่อน แล้วค่อยแทนด้วยค่าจริง
+# ค่าบวกได้ (ยอดเงิน/กำไร/เคส/อายุ) คูณน้ำหนัก _w = N_h/n_h → section เดิมใช้ได้ทันที (ผลรวม = ตัวประมาณ Horvitz–Thompson)
+PREVIEW_SAMPLE_ROWS = int(os.getenv("PREVIEW_SAMPLE_ROWS", 200_000))
+PREVIEW_MIN_PER_STRATUM = 30
+PREVIEW_Z = 1.96  # ช่วงความเชื่อมั่น 95%
+SAMPLE_ADDITIVE = ["LineTotal", *PROFIT_FORMULAS.values(), "Cases", "age_sum", "age_cnt"]
+
+def stratified_sample(cube: pd.DataFrame, target_rows: int = PREVIEW_SAMPLE_ROWS,
+                      min_per_stratum: int = PREVIEW_MIN_PER_STRATUM, seed: int = 0) -> pd.DataFrame:
+    """สุ่มแถวของ cube แบบ SRS ในแต่ละชั้น Branch × YM (จัดสรรตามสัดส่วน อย่างน้อย min_per_stratum แถวต่อชั้น)
+
+    เพิ่มคอลัมน์ _stratum และ _w = N_h/n_h; คงลำดับแถวเดิม (เรียงสาขา/เวลา) → slice_cubes ใช้กับตัวอย่างได้
+    cube ที่ไม่มี Branch (hospital) แบ่งชั้นตาม YM อย่างเดียว
+    """
+    keys = [c for c in ("Branch","YM") if c in cube.columns]
+    strata = cube.groupby(keys, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+    N = np.bincount(strata)
+    frac = min(1.0, target_rows / max(len(cube), 1))
+    n = np.minimum(N, np.maximum(np.ceil(N * frac), min_per_stratum)).astype(np.int64)
+    # ลำดับสุ่มภายในชั้น: เรียงตาม (ชั้น, เลขสุ่ม) แล้วเก็บ n_h ตัวแรกของแต่ละชั้น
+    order = np.lexsort((np.random.default_rng(seed).random(len(cube)), strata))
+    starts = np.concatenate(([0], np.cumsum(N)[:-1]))
+    rank = np.empty(len(cube), dtype=np.int64)
+    rank[order] = np.arange(len(cube)) - starts[strata[order]]
+    keep = np.flatnonzero(rank < n[strata])
+    return cube.take(keep).assign(_stratum=strata[keep], _w=(N / n)[strata[keep]])
+
+def _ht_variance(frame: pd.DataFrame, keys: list, cols: list) -> pd.DataFrame:
+    """ความแปรปรวนของยอดรวมประมาณ Σ w·y ต่อกลุ่ม keys (stratified SRS: Σ_h w_h² n_h (1 − 1/w_h) s_h²)
+
+    กลุ่มเป็น domain ของชั้น: s_h² คิดบน y·[อยู่ในกลุ่ม] ของตัวอย่างทั้งชั้น (n_h = ทุกแถวของชั้นใน frame)
+    """
+    sq = [f"{c}__sq" for c in cols]
+    g = (frame[keys + ["_stratum","_w", *cols]]
+         .assign(**{q: frame[c] ** 2 for q, c in zip(sq, cols)})
+         .groupby(keys + ["_stratum"], observed=True, dropna=False))
+    w = g["_w"].first()
+    n = frame["_stratum"].value_counts().reindex(w.index.get_level_values("_stratum")).to_numpy()
+    total, total_sq = g[cols].sum(), g[sq].sum().set_axis(cols, axis=1)
+    s2 = ((total_sq - total ** 2 / n[:, None]) / np.maximum(n - 1, 1)[:, None]).clip(lower=0)
+    var = s2.mul((w ** 2 * n * (1 - 1 / w)).to_numpy(), axis=0)  # ชั้นที่มีแถวเดียว: s² = 0
+    return var.groupby(level=keys, observed=True, dropna=False).sum() if keys else var.sum().to_frame().T
+
+def sample_intervals(sample: pd.DataFrame, profit_col: str = DEFAULT_PROFIT_COL, by: str = None,
+                     z: float = PREVIEW_Z) -> pd.DataFrame:
+    """Revenue / Margin% / ARPC ประมาณจากตัวอย่าง พร้อมครึ่งความกว้างช่วงความเชื่อมั่น (คอลัมน์ *_ci)
+
+    by=None → แถวเดียวของทั้งช่วง; ratio ใช้ความแปรปรวนแบบ linearization (ส่วนเหลือ y − R·x)
+    """
+    keys = [by] if by else []
+    w = sample["_w"]
+    est = (sample[keys].assign(Y=sample["LineTotal"] * w, P=sample[profit_col] * w, C=sample["Cases"] * w)
+           .groupby(keys, observed=True, dropna=False).sum() if keys else
+           pd.DataFrame({"Y": [(sample["LineTotal"] * w).sum()], "P": [(sample[profit_col] * w).sum()],
+                         "C": [(sample["Cases"] * w).sum()]}))
+    margin = est["P"] / est["Y"].where(est["Y"] != 0)
+    arpc = est["Y"] / est["C"].where(est["C"] != 0)
+    if keys:
+        row_m = sample[by].map(margin).astype("float64")
+        row_a = sample[by].map(arpc).astype("float64")
+    else:
+        row_m, row_a = float(margin.iloc[0]), float(arpc.iloc[0])
+    resid = sample[keys + ["_stratum","_w"]].assign(
+        y=sample["LineTotal"],
+        e_m=sample[profit_col] - row_m * sample["LineTotal"],
+        e_a=sample["LineTotal"] - row_a * sample["Cases"],
+    )
+    var = _ht_variance(resid, keys, ["y","e_m","e_a"]).set_axis(est.index)
+    out = pd.DataFrame({
+        "Revenue": est["Y"],
+        "Revenue_ci": z * np.sqrt(var["y"]),
+        "Margin%": margin * 100,
+        "Margin%_ci": z * np.sqrt(var["e_m"]) / est["Y"].abs() * 100,
+        "ARPC": arpc,
+        "ARPC_ci": z * np.sqrt(var["e_a"]) / est["C"],
+    })
+    return out.reset_index() if keys else out
+
+class SampledSections(PandasSections):
+    """section เดียวกับ PandasSections บนตัวอย่างที่ถ่วงน้ำหนักแล้ว + intervals() สำหรับตัวบ่งชี้ความคลาดเคลื่อน"""
+
+    def __init__(self, samples: dict, rows=None):
+        scaled = {}
+        for name, sample in samples.items():
+            w = sample["_w"]
+            scaled[name] = (sample.assign(**{c: sample[c] * w for c in SAMPLE_ADDITIVE if c in sample.columns})
+                            .drop(columns=["_stratum","_w"]))
+        super().__init__(scaled, rows)
+        self.samples = samples
+
+    def intervals(self, profit_col=DEFAULT_PROFIT_COL, by=None):
+        """by=None → จากตัวอย่างของ cube daily, by=สิทธิการรักษา → จาก cube payer"""
+        return sample_intervals(self.samples["daily" if by is None else "payer"], profit_col, by)
+
+# ================== SECTION JOBS ==================
+# section ของหน้า dashboard คำนวณพร้อมกันใน thread pool (groupby/sort ของ pandas/numpy และ query ของ DuckDB ปล่อย GIL
+# ช่วงงานหนักส่วนใหญ่) — ผลเข้า result cache ของ MemoSections: ตอนวาด q.<section>() ได้ผลทันทีหรือรองานที่คำนวณคีย์เดียวกันอยู่
+SECTION_WORKERS = int(os.getenv("SECTION_WORKERS", 0)) or min(8, os.cpu_count() or 1)
+
+def _top_payer_trend(q, profit_col, n=8):
+    payers = q.payer_revenue()
+    return q.monthly_trend(payers.head(min(n, len(payers))).index.tolist())
+
+# ชื่องาน → (คอลัมน์ที่ต้องมี, งานตามค่าเริ่มต้นของ dashboard) เรียงตามลำดับบนหน้า (งานแรกเริ่มก่อน)
+SECTION_JOBS = {
+    "kpi":          (set(), lambda q, p: q.kpi_summary(p)),
+    "top_branches": (set(), lambda q, p: q.top_branches(p, n=5)),
+    "product":      ({"Description"}, lambda q, p: q.product_contribution(n=10)),
+    "disease":      ({"disease_group_mapped","age_sum"}, lambda q, p: q.disease_age()),
+    "payer":        ({"Customer/Vendor Name"}, lambda q, p: q.payer_kpi(p)),
+    "heatmap":      ({"Customer/Vendor Name","โรงพยาบาล"}, lambda q, p: q.hospital_payer_cross()),
+    "trend":        ({"Customer/Vendor Name","YM","LineTotal"}, _top_payer_trend),
+    "payment":      ({"Payment Method"}, lambda q, p: q.payment_mix()),
+}
+
+def section_pool(workers: int = SECTION_WORKERS) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="section")
+
+def section_jobs(q, profit_col: str = DEFAULT_PROFIT_COL, names=None) -> dict:
+    """{ชื่อ: callable} ของ section ที่ q มีคอลัมน์ครบ (names=None → ทุก section)"""
+    cols = set(q.columns)
+    return {name: partial(fn, q, profit_col) for name, (need, fn) in SECTION_JOBS.items()
+            if need <= cols and (names is None or name in names)}
+
+def _timed_job(name: str, fn, log: StageLog):
+    def run():
+        t0 = time.perf_counter()
+        out = fn()
+        log.add(f"{name} (pool job)", time.perf_counter() - t0,
+                rows_out=len(out) if isinstance(out, (pd.DataFrame, pd.Series)) else None)
+        return out
+    return run
+
+def submit_sections(pool: ThreadPoolExecutor, jobs: dict, log: StageLog = None) -> dict:
+    """ส่งทุกงานเข้า pool ตามลำดับ คืน {ชื่อ: Future}
+
+    log → เวลาคำนวณจริงของแต่ละงาน (ใน thread ของ pool; รวมเวลารองานอื่นที่คำนวณคีย์เดียวกัน) บันทึกเป็น stage "<ชื่อ> (pool job)"
+    """
+    if log is not None and log.enabled:
+        jobs = {name: _timed_job(name, fn, log) for name, fn in jobs.items()}
+    return {name: pool.submit(fn) for name, fn in jobs.items()}
+
+def cancel_sections(futures: dict) -> int:
+    """ยกเลิกงานที่ยังไม่เริ่ม (งานที่รันอยู่ปล่อยให้จบ — ผลยังเข้า cache ใช้ซ้ำได้) คืนจำนวนที่ยกเลิกได้ในครั้งนี้
+
+    Future.cancel() คืน True กับงานที่ถูกยกเลิกไปแล้วด้วย จึงข้ามงานพวกนั้น (ไม่นับซ้ำ)
+    """
+    return sum(f.cancel() for f in futures.values() if not f.cancelled())
+
+def wait_sections(futures: dict, timeout: float = None) -> bool:
+    """รอทุกงานไม่เกิน timeout วินาที คืน True ถ้าเสร็จครบ"""
+    return not wait(list(futures.values()), timeout=timeout).not_done
+
+# ================== DUCKDB ENGINE ==================
+# ทางเลือก (QUERY_ENGINE=duckdb): ลงทะเบียนตารางที่ clean แล้วกับ DuckDB ในหน่วยความจำ แล้วตอบทุก section ด้วย SQL
+# (หลาย core, aggregation ที่เกินหน่วยความจำ spill ลง temp_directory) — ผลลัพธ์รูปแบบเดียวกับ PandasSections
+def _q(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class DuckDBEngine:
+    """connection เดียวต่อชุดข้อมูล แชร์ข้าม session ได้
+
+    DataFrame ที่ register ไว้มองเห็นเฉพาะใน connection นี้ (cursor ใหม่มองไม่เห็น) → query ทีละคำสั่งด้วย lock
+    แต่ละคำสั่ง DuckDB ยังกระจายงานหลาย thread ภายในเอง
+    """
+
+    def __init__(self, df: pd.DataFrame, threads: int = None, memory_limit: str = None, temp_directory: str = None):
+        import duckdb  # optional dependency — นำเข้าเมื่อเลือก engine นี้เท่านั้น
+        self.con = duckdb.connect()
+        self._lock = threading.Lock()
+        for key, val in (("threads", threads), ("memory_limit", memory_limit), ("temp_directory", temp_directory)):
+            if val:
+                self.con.execute(f"SET {key} = '{val}'")
+        self.con.register("tx", df)
+        cols = set(df.columns)
+        # ชื่อคอลัมน์เทียบเท่า cube ทุกก้อน (ให้โค้ดเช็คคอลัมน์ฝั่ง UI ใช้ร่วมกันได้)
+        dims = [c for ds, _ in CUBES.values() for c in ds if set(ds) <= cols]
+        self.columns = ["Day", "Month", *dict.fromkeys(dims), "LineTotal",
+                        *[c for c in PROFIT_FORMULAS.values() if c in cols], "Cases",
+                        *(["age_sum","age_cnt"] if "age" in cols else []), "YM"]
+
+    def query(self, sql: str, params=None) -> pd.DataFrame:
+        with self._lock:
+            return self.con.execute(sql, params or []).df()
+
+    def sections(self, start, end_excl, branches) -> "DuckDBSections":
+        return DuckDBSections(self, start, end_excl, branches)
+
+class DuckDBSections:
+    """section ทั้งหมดเป็น SQL บนแถวที่ผ่านตัวกรอง sidebar (สาขา + start <= Posting Date < end_excl)
+
+    ช่วงวันที่เหมือน PandasSections: KPI/สาขาตรงวัน, section ที่ฝั่ง pandas อ่านจาก cube รายเดือนใช้ month_span
+    """
+
+    def __init__(self, engine: DuckDBEngine, start, end_excl, branches):
+        self.engine = engine
+        self.columns = engine.columns
+        self.where = 'WHERE "Posting Date" >= ? AND "Posting Date" < ? AND list_contains(?, CAST("Branch" AS VARCHAR))'
+        branches = [str(b) for b in branches]
+        self.params = [pd.Timestamp(start).to_pydatetime(), pd.Timestamp(end_excl).to_pydatetime(), branches]
+        self.params_m = [t.to_pydatetime() for t in month_span(start, end_excl)] + [branches]
+        self.rows = int(self._sql("SELECT count(*) AS n FROM tx {where}", monthly=False)["n"].iloc[0])
+        self.empty = self.rows == 0
+
+    def __len__(self):
+        return self.rows
+
+    def _sql(self, sql: str, extra=(), monthly: bool = True) -> pd.DataFrame:
+        return self.engine.query(sql.format(where=self.where), (self.params_m if monthly else self.params) + list(extra))
+
+    def _group(self, dim: str, select: str, order: str, limit: int = None, monthly: bool = True) -> pd.DataFrame:
+        # groupby ของ pandas ตัดค่าว่างของมิติทิ้ง (dropna) — ทำเหมือนกันด้วย IS NOT NULL
+        return self._sql(f"SELECT {_q(dim)}, {select} FROM tx {{where}} AND {_q(dim)} IS NOT NULL "
+                         f"GROUP BY {_q(dim)} ORDER BY {order}, {_q(dim)}" + (f" LIMIT {int(limit)}" if limit else ""),
+                         monthly=monthly)
+
+    def kpi_summary(self, profit_col=DEFAULT_PROFIT_COL):
+        r = self._sql(f'SELECT sum("LineTotal") AS revenue, sum({_q(profit_col)}) AS profit, '
+                      'count(DISTINCT "Branch") AS branches, min(year("Posting Date")) AS y0, '
+                      'max(year("Posting Date")) AS y1 FROM tx {where}', monthly=False).iloc[0]
+        return _kpi(r["revenue"], r["profit"], int(r["branches"]), int(r["y0"]), int(r["y1"]))
+
+    def top_branches(self, profit_col=DEFAULT_PROFIT_COL, n=5):
+        return self._group("Branch", f'sum("LineTotal") AS "LineTotal", sum({_q(profit_col)}) AS "Profit"',
+                           '"LineTotal" DESC', n, monthly=False)
+
+    def product_contribution(self, n=10):
+        return _finish_product(self._group("Description", 'sum("LineTotal") AS "LineTotal"', '"LineTotal" DESC', n))
+
+    def disease_age(self):
+        return self._group("disease_group_mapped",
+                           'sum(CAST("age" AS DOUBLE)) / count("age") AS "AverageAge", count(*) AS "Cases"',
+                           '"Cases" DESC, "AverageAge" DESC')
+
+    def payer_kpi(self, profit_col=DEFAULT_PROFIT_COL):
+        sums = ", ".join(f"sum({_q(c)}) AS {_q(c)}" for c in PROFIT_FORMULAS.values())
+        return _finish_payer_kpi(self._group(
+            "Customer/Vendor Name",
+            f'sum("LineTotal") AS "Revenue", sum({_q(profit_col)}) AS "Profit", count(*) AS "Cases", {sums}',
+            '"Revenue" DESC'))
+
+    def hospital_payer_cross(self):
+        return self._sql('SELECT "โรงพยาบาล", "Customer/Vendor Name", count(*) AS "Cases", sum("LineTotal") AS "Revenue" '
+                         'FROM tx {where} AND "โรงพยาบาล" IS NOT NULL AND "Customer/Vendor Name" IS NOT NULL '
+                         'GROUP BY 1, 2 ORDER BY 1, 2')
+
+    def payer_revenue(self):
+        return self._group("Customer/Vendor Name", 'sum("LineTotal") AS "LineTotal"', '"LineTotal" DESC') \
+                   .set_index("Customer/Vendor Name")["LineTotal"]
+
+    def monthly_trend(self, payers=None):
+        extra, params = "", []
+        if payers is not None:
+            extra, params = ' AND list_contains(?, CAST("Customer/Vendor Name" AS VARCHAR))', [[str(p) for p in payers]]
+        return _finish_trend(self._sql('SELECT "YM", "Customer/Vendor Name", sum("LineTotal") AS "LineTotal" '
+                                       'FROM tx {where} AND "Customer/Vendor Name" IS NOT NULL' + extra +
+                                       ' GROUP BY 1, 2 ORDER BY 1, 2', params))
+
+    def payment_mix(self):
+        return _finish_payment_mix(self._group("Payment Method", 'sum("LineTotal") AS "Revenue", count(*) AS "Cases"',
+                                               '"Payment Method"'))
+
+    def branch_totals(self):
+        return self._group("Branch", 'sum("LineTotal") AS "LineTotal"', '"LineTotal" DESC', monthly=False)
+
+# ================== CHART PAYLOAD ==================
+# Streamlit ส่งข้อมูล chart เป็น Arrow ทั้ง DataFrame → ตัดให้เหลือเฉพาะคอลัมน์ที่ encode + dtype เล็ก + จำกัดจำนวนจุด
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", 500))   # จุดต่อ series ของกราฟเวลา
+CHART_MAX_ROWS   = int(os.getenv("CHART_MAX_ROWS", 5000))    # แถวสูงสุดต่อ chart (เท่า max_rows เริ่มต้นของ Altair)
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: index ของ n_out จุดที่คงรูปกราฟ (x เรียงจากน้อยไปมาก)"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)  # n_out-2 bucket ระหว่างจุดแรก/สุดท้าย
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()  # ค่าเฉลี่ยของ bucket ถัดไป
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+def downsample_stacked(df: pd.DataFrame, x: str, y: str, max_points: int = CHART_MAX_POINTS,
+                       max_rows: int = None) -> pd.DataFrame:
+    """เลือกค่า x ร่วมกันทุก series ด้วย LTTB บนผลรวม (กราฟซ้อนยังเรียงตรงกัน) ถ้าจำนวน x เกิน max_points
+
+    max_rows: จำกัดจุดต่อ series อีกชั้นให้ (จำนวน x × จำนวน series) ไม่เกิน max_rows → compact_frame ไม่ตัดท้ายกราฟ
+    """
+    g = df.groupby(x, observed=True)[y]
+    if max_rows is not None and len(df):
+        max_points = max(3, min(max_points, max_rows // int(g.size().max())))  # แถวต่อค่า x สูงสุด = จำนวน series
+    total = g.sum().sort_index()
+    if len(total) <= max_points:
+        return df
+    keep = total.index[lttb(total.index.to_numpy().astype("int64"), total.to_numpy(), max_points)]
+    return df[df[x].isin(keep)]
+
+def compact_frame(df: pd.DataFrame, cols, max_rows: int = CHART_MAX_ROWS) -> pd.DataFrame:
+    """เฉพาะคอลัมน์ cols (ที่ chart encode/tooltip), ข้อความ→category, int เล็กสุด,
+    float→float32 เมื่อคลาดเคลื่อนไม่เกินสตางค์ และไม่เกิน max_rows แถวแรก (ผู้เรียกลดจุดหรือบอกผู้ใช้เองถ้าเกิน)"""
+    out = df.loc[:, list(cols)].head(max_rows).copy()
+    for c in out.columns:
+        s = out[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_object_dtype(s.dtype) or pd.api.types.is_string_dtype(s.dtype):
+            out[c] = s.astype("category")
+        elif pd.api.types.is_integer_dtype(s.dtype) and not pd.api.types.is_extension_array_dtype(s.dtype):
+            out[c] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s.dtype) and s.dtype != np.float32:
+            f32 = s.astype("float32")
+            if np.allclose(f32.to_numpy(dtype="float64"), s.to_numpy(), rtol=0, atol=0.005, equal_nan=True):
+                out[c] = f32
+    return out
+
+# ================== ARTIFACTS ==================
+# ผล precompute บนดิสก์: cube_<ชื่อ>.parquet ต่อ section + sketch_<kind>.parquet (กรองสาขา/วันที่ได้เหมือนเดิม)
+# + ตารางมุมมองเริ่มต้นใน tables/ + manifest.json — เขียนไฟล์ชั่วคราวแล้ว os.replace ให้ผู้อ่านไม่เห็นไฟล์ครึ่งๆ
+MANIFEST = "manifest.json"
+
+def _write_parquet(df: pd.DataFrame, path: str):
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+def write_artifacts(out_dir: str, source: str, strict_dedup: bool = True, profit_col: str = DEFAULT_PROFIT_COL,
+                    stream: bool = False) -> dict:
+    """โหลด + clean + สรุปครั้งเดียว แล้วเขียนผลลง out_dir คืน manifest (stream=True → อ่านทีละ batch)"""
+    t0 = time.perf_counter()
+    fingerprint = source_fingerprint(source)
+    df, cubes, sketch, notes, stats = prepare(source, strict_dedup, stream=stream)
+
+    os.makedirs(os.path.join(out_dir, "tables"), exist_ok=True)
+    for name, cube in cubes.items():
+        _write_parquet(cube, os.path.join(out_dir, f"cube_{name}.parquet"))
+    for kind, table in sketch.items():
+        _write_parquet(table, os.path.join(out_dir, f"sketch_{kind}.parquet"))
+    tables = section_tables(cubes, sketch, profit_col)
+    for name, table in tables.items():
+        _write_parquet(table, os.path.join(out_dir, "tables", f"{name}.parquet"))
+
+    manifest = {
+        "source": redact_source(source),
+        "fingerprint": hashlib.sha1(fingerprint.encode("utf-8")).hexdigest(),  # ลายนิ้วมือของ URL มี query string
+        "strict_dedup": strict_dedup,
+        "cleaning_version": CLEANING_VERSION,
+        "profit_col": profit_col,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "rows": int(cubes["daily"]["Cases"].sum()),
+        "cube_rows": {name: len(cube) for name, cube in cubes.items()},
+        "min_date": str(cubes["daily"]["Day"].min().date()),
+        "max_date": str(cubes["daily"]["Day"].max().date()),
+        "notes": list(notes),
+        "dedup": stats.get("dedup", {}),
+        "sketch": sorted(sketch),
+        "tables": sorted(tables),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    _write_meta(os.path.join(out_dir, MANIFEST), manifest)
+    return manifest
+
+def read_artifacts(out_dir: str):
+    """(manifest, cubes, sketch) จากผลของ write_artifacts — ผลจาก CLEANING_VERSION อื่นใช้ไม่ได้ (ต้อง precompute ใหม่)"""
+    manifest = _read_meta(os.path.join(out_dir, MANIFEST))
+    if not manifest:
+        raise FileNotFoundError(f"ไม่พบ {MANIFEST} ใน {out_dir}")
+    if manifest.get("cleaning_version") != CLEANING_VERSION:
+        raise ValueError(f"ผล precompute ใน {out_dir} เป็น CLEANING_VERSION {manifest.get('cleaning_version')} "
+                         f"(ต้องการ {CLEANING_VERSION}) — รัน python analytics.py precompute ใหม่")
+    cubes = {name: pd.read_parquet(os.path.join(out_dir, f"cube_{name}.parquet"), memory_map=True)
+             for name in manifest["cube_rows"]}
+    sketch = {kind: pd.read_parquet(os.path.join(out_dir, f"sketch_{kind}.parquet"), memory_map=True)
+              for kind in manifest["sketch"]}
+    return manifest, cubes, sketch
+
+def read_table(out_dir: str, name: str) -> pd.DataFrame:
+    return pd.read_parquet(os.path.join(out_dir, "tables", f"{name}.parquet"))
+
+# ================== CLI ==================
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="analytics.py", description="Hospital analytics: precompute dashboard artifacts")
+    sub = parser.add_subparsers(dest="command", required=True)
+    pre = sub.add_parser("precompute", help="โหลด + clean + สรุป แล้วเขียน parquet ลงโฟลเดอร์ปลายทาง")
+    pre.add_argument("--source", default=os.getenv("DATA_URL", "final_test_data_20250529.parquet"),
+                     help="ไฟล์ parquet, URL หรือโฟลเดอร์ partition (ค่าเริ่มต้น: $DATA_URL)")
+    pre.add_argument("--out", required=True, help="โฟลเดอร์ปลายทาง (ใช้เป็น ARTIFACTS_DIR ของ dashboard)")
+    pre.add_argument("--no-strict-dedup", dest="strict_dedup", action="store_false", help="ไม่ตัดแถวซ้ำ")
+    pre.add_argument("--stream", action="store_true",
+                     help="อ่านทีละ record batch (ข้อมูลใหญ่กว่าหน่วยความจำ; ขนาด batch: $STREAM_BATCH_ROWS)")
+    pre.add_argument("--profit", choices=list(PROFIT_FORMULAS.values()), default=DEFAULT_PROFIT_COL,
+                     help="สูตรกำไรของตารางมุมมองเริ่มต้น (cube เก็บทุกสูตรอยู่แล้ว)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    manifest = write_artifacts(args.out, args.source, args.strict_dedup, args.profit, stream=args.stream)
+    for msg in manifest["notes"]:
+        log.info(msg)
+    log.info("wrote %s: %s rows → cube rows %s, %s tables in %.2f s", args.out, f"{manifest['rows']:,}",
+             ", ".join(f"{name} {n:,}" for name, n in manifest["cube_rows"].items()), len(manifest["tables"]),
+             manifest["seconds"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
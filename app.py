@@ -1,10 +1,13 @@
 # app.py
 import streamlit as st
 import pandas as pd
-import numpy as np
 import altair as alt
 from datetime import datetime
-import os, io, re, requests
+import os, logging, inspect
+from concurrent.futures import as_completed
+
+import analytics as an
+from analytics import PROFIT_FORMULAS, slice_branch_dates
 
 # ================== PAGE CONFIG ==================
 st.set_page_config(layout="wide", page_title="Business & Medical Analytics Dashboard")
@@ -12,164 +15,186 @@ st.title("📊 Business & Medical Analytics Dashboard")
 
 # ================== DATA SOURCE ==================
 DATA_PATH = os.getenv("DATA_URL", "final_test_data_20250529.parquet")
+# "full" = อ่านทั้งไฟล์แล้วกรองในหน่วยความจำ, "pushdown" = อ่านเฉพาะคอลัมน์ที่ใช้ + กรองวันที่/สาขาตั้งแต่ตอนอ่าน parquet
+# "stream" = อ่านทีละ batch แล้วเก็บแค่ cube ของแต่ละ section + sketch การรับชำระ (ข้อมูลใหญ่กว่าหน่วยความจำ; ไม่มีแถวดิบ)
+LOAD_MODE = os.getenv("LOAD_MODE", "full").strip().lower()
+# โฟลเดอร์ผล precompute (python analytics.py precompute --out DIR) — ถ้าตั้งไว้ dashboard เริ่มจาก cube บนดิสก์แทนการ clean
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "")
+# จับเวลา/หน่วยความจำแต่ละขั้น: PROFILE_STAGES=1 เปิด toggle ไว้ตั้งแต่ต้น, PROFILE_LOG=1 ส่งออกเป็น JSON log ด้วย
+# (stderr หรือไฟล์ PROFILE_LOG_FILE)
+PROFILE_STAGES = os.getenv("PROFILE_STAGES", "").strip().lower() in ("1", "true", "yes")
+PROFILE_LOG = os.getenv("PROFILE_LOG", "").strip().lower() in ("1", "true", "yes")
+PROFILE_LOG_FILE = os.getenv("PROFILE_LOG_FILE", "")  # ว่าง = stderr
+# "pandas" = ตอบ section จาก cube ของ section นั้นในหน่วยความจำ, "duckdb" = SQL บนตารางที่ clean แล้วด้วย DuckDB (ต้องติดตั้ง duckdb)
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "pandas").strip().lower()
+# cube ทุกก้อนหลังกรองรวมกันมีแถวตั้งแต่เท่านี้ → วาดจากตัวอย่างแบบแบ่งชั้นก่อน แล้วแทนด้วยค่าจริงเมื่อคำนวณเสร็จ (โหมด pandas)
+PREVIEW_MIN_ROWS = int(os.getenv("PREVIEW_MIN_ROWS", 1_000_000))
+# ...และค่าจริงยังไม่เสร็จภายในเวลานี้ (วินาที) — มุมมองที่อยู่ใน result cache แล้วไม่ต้องพรีวิว
+PREVIEW_WAIT_S = float(os.getenv("PREVIEW_WAIT_S", 0.3))
+
+TABS = ["📈 Business","🩺 Medical"]
+# st.tabs(key=, on_change="rerun") (Streamlit รุ่นใหม่) → คำนวณเฉพาะแท็บที่เปิดอยู่; รุ่นเก่ากว่าไม่มี → คำนวณ/วาดทุกแท็บ
+LAZY_TABS = {"key", "on_change"} <= set(inspect.signature(st.tabs).parameters)
+# section ของแต่ละแท็บ (ชื่องานใน an.SECTION_JOBS) — ส่งเข้า thread pool เฉพาะแท็บที่เปิดอยู่
+TAB_SECTIONS = {TABS[0]: ["kpi","top_branches","product"],
+                TABS[1]: ["disease","payer","heatmap","trend","payment"]}
+
+# การคำนวณทั้งหมดอยู่ใน analytics.py — ที่นี่เหลือแค่ชั้น cache ของ Streamlit
+@st.cache_data(ttl=60, show_spinner=False)
+def source_fingerprint(source: str) -> str:
+    return an.source_fingerprint(source)
+
+@st.cache_data(max_entries=4, show_spinner="กำลังอ่าน schema...")
+def scan_parquet(source: str, fingerprint: str) -> dict:
+    # scan ใหม่เมื่อไฟล์ต้นทางเปลี่ยน (fingerprint) — ผลถูกเก็บข้าง snapshot บนดิสก์ด้วย (ไม่ต้อง scan ซ้ำหลัง restart)
+    return an.scan_parquet(source, fingerprint)
+
+# cache_resource: เก็บผลลัพธ์ชุดเดียวใช้ร่วมกันทุก session (ไม่ copy ต่อผู้ใช้) — ห้ามแก้ไข df ที่ได้คืนแบบ in-place
+@st.cache_resource(max_entries=4, show_spinner="กำลังเตรียมข้อมูล...")
+def load_clean_dataframe(source: str, fingerprint: str, strict_dedup: bool = True, columns=None, filters=None,
+                         dedup_key=None):
+    # fingerprint อยู่ใน cache key เพื่อให้โหลดใหม่เมื่อไฟล์ต้นทางเปลี่ยน
+    return an.load_clean(source, strict_dedup, columns=columns, filters=filters, fingerprint=fingerprint,
+                         dedup_key=dedup_key)
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def load_branch_offsets(_df: pd.DataFrame, frame_key: str) -> dict:
+    return an.branch_offsets(_df)
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def load_cube_offsets(_cubes: dict, frame_key: str) -> dict:
+    return an.cube_offsets(_cubes)
+
+@st.cache_resource(max_entries=8, show_spinner="กำลังสรุปข้อมูล...")
+def load_cubes(_df: pd.DataFrame, dataset_key: str) -> dict:
+    # _df ไม่ถูก hash (ใหญ่) — dataset_key ระบุชุดข้อมูลแทน
+    return an.build_cubes(_df)
+
+@st.cache_resource(show_spinner=False)
+def partition_store(root: str, strict_dedup: bool) -> an.PartitionStore:
+    # ไม่ผูกกับ fingerprint — อยู่ข้ามการเปลี่ยนไฟล์เพื่อให้ refresh ทำเฉพาะส่วนที่เปลี่ยน
+    return an.PartitionStore(root, strict_dedup)
+
+@st.cache_resource(max_entries=4, show_spinner="กำลังเตรียม DuckDB...")
+def load_duckdb(_df: pd.DataFrame, dataset_key: str) -> an.DuckDBEngine:
+    return an.DuckDBEngine(_df, threads=os.getenv("DUCKDB_THREADS"), memory_limit=os.getenv("DUCKDB_MEMORY_LIMIT"),
+                           temp_directory=os.getenv("DUCKDB_TEMP_DIR"))
+
+@st.cache_resource(max_entries=8, show_spinner="กำลังสรุปข้อมูลการรับชำระ...")
+def load_sketch(_df: pd.DataFrame, dataset_key: str) -> dict:
+    return an.collection_sketch(an.collection_rows(_df))
+
+@st.cache_resource(max_entries=8, show_spinner="กำลังสร้างข้อมูลรายผู้ป่วย...")
+def load_patient_ledger(_df: pd.DataFrame, dataset_key: str):
+    return an.patient_ledger(_df)
+
+@st.cache_resource(max_entries=2, show_spinner="กำลังประมวลผลทีละ batch (streaming)...")
+def load_stream(source: str, fingerprint: str, strict_dedup: bool = True):
+    return an.stream_aggregates(source, strict_dedup)
+
+@st.cache_resource(max_entries=4, show_spinner="กำลังสุ่มตัวอย่างสำหรับพรีวิว...")
+def load_preview_sample(_cubes: dict, dataset_key: str):
+    samples = {name: an.stratified_sample(cube) for name, cube in _cubes.items()}
+    return samples, an.cube_offsets(samples)
+
+@st.cache_resource(show_spinner=False)
+def section_pool():
+    # thread pool เดียวของโปรเซส (ทุก session ส่งงาน section เข้าที่นี่)
+    return an.section_pool()
+
+@st.cache_resource(show_spinner=False)
+def result_cache() -> an.ResultCache:
+    # ก้อนเดียวต่อโปรเซส: ผล section ของมุมมองเดียวกันใช้ร่วมทุก session (งบ RESULT_CACHE_MB, LRU)
+    return an.ResultCache(an.RESULT_CACHE_MB * 2**20)
+
+@st.cache_resource(max_entries=2, show_spinner="กำลังอ่านผล precompute...")
+def load_artifacts(out_dir: str, fingerprint: str):
+    return an.read_artifacts(out_dir)
+
+@st.cache_resource(show_spinner=False)
+def stage_logger() -> logging.Logger:
+    # ตั้งค่าครั้งเดียวต่อโปรเซส (rerun ไม่ต่อ handler ซ้ำ): JSON หนึ่งบรรทัดต่อ stage ระดับ INFO
+    logger = logging.getLogger("hospital.stages")
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(PROFILE_LOG_FILE, encoding="utf-8") if PROFILE_LOG_FILE else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False  # ไม่ให้ root logger พิมพ์ซ้ำ
+    return logger
+
+def chart_frame(df: pd.DataFrame, cols) -> pd.DataFrame:
+    """an.compact_frame ของ chart — ถ้าเกิน CHART_MAX_ROWS แถว บอกใต้หัวข้อว่าแสดงกี่แถวจากทั้งหมด (ไม่ตัดเงียบ)"""
+    if len(df) > an.CHART_MAX_ROWS:
+        st.caption(f"ℹ️ กราฟแสดง {an.CHART_MAX_ROWS:,} จาก {len(df):,} แถวแรก (ตามลำดับของตาราง)")
+    return an.compact_frame(df, cols)
 
-def _is_http_url(s: str) -> bool:
-    return bool(re.match(r"^https?://", str(s or ""), re.IGNORECASE))
-
-@st.cache_data(ttl=3600, show_spinner="กำลังโหลดข้อมูล...")
-def load_parquet(source: str) -> pd.DataFrame:
-    if _is_http_url(source):
-        r = requests.get(source, timeout=180)
-        r.raise_for_status()
-        return pd.read_parquet(io.BytesIO(r.content))
-    return pd.read_parquet(source)
-
+# เปิด/ปิด strict de-dup ใน sidebar
+st.sidebar.header("⚙️ Filters")
+strict_dedup = st.sidebar.checkbox("Strict de-dup (ตัดแถวซ้ำอัตโนมัติ)", value=True)
+profile_on = st.sidebar.checkbox("⏱️ จับเวลาแต่ละขั้น (profiling)", value=PROFILE_STAGES or PROFILE_LOG,
+                                 help="แสดงเวลา/จำนวนแถว/หน่วยความจำของแต่ละขั้นใน Data Quality")
+preview_on = st.sidebar.checkbox("⚡ พรีวิวจากตัวอย่างก่อน (ช่วงข้อมูลใหญ่)", value=True,
+                                 help="ช่วงที่เลือกใหญ่มาก: แสดงค่าประมาณ ± ช่วงความเชื่อมั่นก่อน แล้วแทนด้วยค่าจริงอัตโนมัติ")
+prof = an.StageLog(enabled=profile_on, logger=stage_logger() if PROFILE_LOG else None,
+                   source=an.redact_source(DATA_PATH))  # URL ที่มีลายเซ็น/token ห้ามลง log
+
+prof.begin("source_fingerprint (download/revalidate)")
 try:
-    df_raw = load_parquet(DATA_PATH)
+    source_fp = source_fingerprint(os.path.join(ARTIFACTS_DIR, an.MANIFEST) if ARTIFACTS_DIR else DATA_PATH)
 except Exception as e:
     st.error(f"โหลดข้อมูลไม่สำเร็จ: {e}")
     st.stop()
-
-# ================== CLEANING ==================
-def clean_dataframe(df: pd.DataFrame, strict_dedup: bool = True) -> pd.DataFrame:
-    df = df.copy()
-
-    # --- unify description
-    desc_alias = [c for c in ["Description","Dscription","dscription","description"] if c in df.columns]
-    if desc_alias:
-        if desc_alias[0] != "Description":
-            df.rename(columns={desc_alias[0]: "Description"}, inplace=True)
-
-    # --- common types
-    if "Posting Date" in df.columns:
-        df["Posting Date"] = pd.to_datetime(df["Posting Date"], errors="coerce")
-
-    # try to parse Payment/Due/Invoice related dates if exist
-    for dcol in ["Payment Date", "Paid Date", "Due Date", "Invoice Date", "Document Date"]:
-        if dcol in df.columns:
-            df[dcol] = pd.to_datetime(df[dcol], errors="coerce")
-
-    for c in ["LineTotal","avg_cost","age","Quantity"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-
-    for c in ["Branch","เพศ คนไข้","โรงพยาบาล","Customer/Vendor Name","group_disease","Description"]:
-        if c in df.columns:
-            df[c] = df[c].astype(str).str.strip()
-
-    # fill numeric nans
-    for c in ["LineTotal","avg_cost","age","Quantity"]:
-        if c in df.columns:
-            df[c] = df[c].fillna(0)
-
-    # drop rows with missing date
-    if "Posting Date" in df.columns:
-        df = df[~df["Posting Date"].isna()].copy()
-        df["Year"] = df["Posting Date"].dt.year
-        df["YM"]   = df["Posting Date"].dt.to_period("M").astype(str)
-
-    # gender / age group / disease
-    gender_mapping = {"M":"Male","F":"Female","W":"Female","ชาย":"Male","หญิง":"Female"}
-    if "เพศ คนไข้" in df.columns:
-        df["gender_mapped"] = df["เพศ คนไข้"].map(gender_mapping).fillna("Other")
-
-    if "age" in df.columns:
-        bins   = [0,17,35,55,200]
-        labels = ["0–17","18–35","36–55","56+"]
-        df["age_group"] = pd.cut(df["age"], bins=bins, labels=labels, right=True)
-
-    disease_mapping = {
-        "กล้ามเนื้อเคล็ด":"Muscle Strain",
-        "โรคทางเดินปัสสาวะ":"Urinary Tract Disease",
-        "ปัจจัยที่มีผลต่อสถานะสุขภาพ":"Factors Affecting Health Status",
-        "ความผิดปกติจากทางคลินิกและห้องปฏิบัติการ":"Abnormalities from Clinical",
-        "โรคทางเดินอาหาร":"Gastrointestinal Disease",
-        "URI":"Upper Respiratory Infection (URI)",
-        "การติดเชื้อไวรัส":"Viral Infection",
-        "การบาดเจ็บ การเป็นพิษ และอุบัติเหตุ":"Injury, Poisoning, and Accidents",
-    }
-    if "group_disease" in df.columns:
-        df["disease_group_mapped"] = df["group_disease"].map(disease_mapping).fillna(df["group_disease"])
-
-    # --- normalize "สิทธิการรักษา / ผู้ชำระเงิน / Payer"
-    payer_aliases = [
-        "Customer/Vendor Name", "สิทธิการรักษา", "ผู้ชำระเงิน", "Payer", "Insurance", "สิทธิ์การรักษา"
-    ]
-    payer_col = next((c for c in payer_aliases if c in df.columns), None)
-    if payer_col and payer_col != "Customer/Vendor Name":
-        df.rename(columns={payer_col: "Customer/Vendor Name"}, inplace=True)
-
-    # --- normalize "วิธีจ่ายเงิน / Payment Method"
-    paym_aliases = [
-        "Payment Method","วิธีชำระเงิน","ช่องทางชำระเงิน","ประเภทการชำระเงิน","Payment Type","Method"
-    ]
-    paym_col = next((c for c in paym_aliases if c in df.columns), None)
-    if paym_col:
-        if paym_col != "Payment Method":
-            df.rename(columns={paym_col: "Payment Method"}, inplace=True)
-        df["Payment Method"] = df["Payment Method"].astype(str).str.strip()
-
-    # --- strict de-dup
-    candidate_keys = [
-        ["Branch","Posting Date","Document No","Line No","LineTotal"],
-        ["Branch","Posting Date","Document No","Description","LineTotal"],
-        ["Branch","Posting Date","Description","LineTotal"],
-    ]
-    if strict_dedup:
-        used_key = None
-        before = len(df)
-        for ks in candidate_keys:
-            ks = [k for k in ks if k in df.columns]
-            if len(ks) >= 3:
-                dup_mask = df.duplicated(subset=ks, keep=False)
-                dup_cnt  = int(dup_mask.sum())
-                if dup_cnt > 0:
-                    df = df.drop_duplicates(subset=ks)
-                    used_key = ks
-                    break
-        after = len(df)
-        if used_key is not None and after < before:
-            st.warning(f"🧹 ลบข้อมูลซ้ำ {before-after:,} แถว ด้วยคีย์ {used_key}")
-        elif used_key is None:
-            dup_any = df.duplicated(keep=False).sum()
-            if dup_any > 0:
-                st.warning(f"พบรูปแบบซ้ำ {dup_any:,} แถว แต่ไม่มีคีย์ที่เหมาะสม — กรุณาตรวจคีย์เอกลักษณ์")
-
-    return df
-
-# เปิด/ปิด strict de-dup ใน sidebar
-st.sidebar.header("⚙️ Filters")
-strict_dedup = st.sidebar.checkbox("Strict de-dup (ตัดแถวซ้ำอัตโนมัติ)", value=True)
-
-df = clean_dataframe(df_raw, strict_dedup=strict_dedup)
+prof.end()
 
 # ================== PROFIT & FILTERS ==================
 profit_formula = st.sidebar.selectbox(
     "สูตรคำนวณกำไร",
-    (
-        "Per-Unit Cost: LineTotal - (avg_cost × Quantity)",
-        "Current: LineTotal - avg_cost",
-        "Fixed 40% Margin: LineTotal × 0.40",
-    ),
+    tuple(PROFIT_FORMULAS),
     help="เลือกสูตรกำไรสำหรับทุกกราฟ/ตาราง",
 )
-
-df = df.copy()
-if profit_formula.startswith("Per-Unit"):
-    if {"avg_cost","Quantity"}.issubset(df.columns):
-        df["Profit"] = df["LineTotal"] - (df["avg_cost"] * df["Quantity"])
+profit_col = PROFIT_FORMULAS[profit_formula]
+
+# โหมด pushdown: ช่วงวันที่/รายชื่อสาขามาจาก scan (อ่านแค่ 2 คอลัมน์) แล้วค่อยโหลดเฉพาะส่วนที่เลือก
+# โฟลเดอร์ partition ใช้ ingest แบบเพิ่มทีละไฟล์แทน (ไม่รองรับ pushdown)
+artifacts = bool(ARTIFACTS_DIR)
+streaming = not artifacts and LOAD_MODE == "stream"
+partitioned = not (artifacts or streaming) and an.is_partitioned(DATA_PATH)
+prof.begin("load + clean (cached)")
+try:
+    if artifacts:
+        # cube + sketch การรับชำระจาก precompute — ไม่มีแถวดิบ (df = None)
+        manifest, cubes, sketch, df = (*load_artifacts(ARTIFACTS_DIR, source_fp), None)
+        clean_notes, clean_stats = tuple(manifest["notes"]), {"dedup": manifest["dedup"]}
+        min_date = pd.to_datetime(manifest["min_date"]).date()
+        max_date = pd.to_datetime(manifest["max_date"]).date()
+        branch_list = sorted(cubes["daily"]["Branch"].dropna().unique().tolist())
+    elif streaming:
+        cubes, sketch, clean_notes, clean_stats = load_stream(DATA_PATH, source_fp, strict_dedup)
+        df = None
+        min_date = cubes["daily"]["Day"].min().date()
+        max_date = cubes["daily"]["Day"].max().date()
+        branch_list = sorted(cubes["daily"]["Branch"].dropna().unique().tolist())
+    elif partitioned:
+        df, cubes, sketch, clean_notes, clean_stats = partition_store(DATA_PATH, strict_dedup).refresh(source_fp)
+        min_date = df["Posting Date"].min().date()
+        max_date = df["Posting Date"].max().date()
+        branch_list = sorted(df["Branch"].dropna().unique().tolist())
+    elif LOAD_MODE == "pushdown":
+        scan = scan_parquet(DATA_PATH, source_fp)
+        min_date, max_date = scan["min_date"], scan["max_date"]
+        branch_list = sorted(scan["branch_raw"])
     else:
-        df["Profit"] = 0.0
-elif profit_formula.startswith("Current"):
-    df["Profit"] = df["LineTotal"] - df.get("avg_cost", 0)
-else:
-    df["Profit"] = df["LineTotal"] * 0.40
+        df, clean_notes, clean_stats = load_clean_dataframe(DATA_PATH, source_fp, strict_dedup)
+        min_date = df["Posting Date"].min().date()
+        max_date = df["Posting Date"].max().date()
+        branch_list = sorted(df["Branch"].dropna().unique().tolist())
+except Exception as e:
+    st.error(f"โหลดข้อมูลไม่สำเร็จ: {e}")
+    st.stop()
+prof.end()
 
-min_date = df["Posting Date"].min().date()
-max_date = df["Posting Date"].max().date()
 date_range = st.sidebar.date_input("ช่วงวันที่", (min_date, max_date), min_value=min_date, max_value=max_date)
 
-branch_list = sorted(df["Branch"].dropna().unique().tolist())
 branch_mode = st.sidebar.radio("โหมดเลือกสาขา", ["ทุกสาขา","เลือกบางสาขา"], horizontal=True)
 if branch_mode == "เลือกบางสาขา":
     selected_branches = st.sidebar.multiselect("เลือกสาขา", branch_list, default=branch_list[:10])
@@ -177,66 +202,170 @@ else:
     selected_branches = branch_list
 
 start_date, end_date = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-df_filtered = df[
-    (df["Posting Date"] >= start_date) &
-    (df["Posting Date"] <= end_date) &
-    (df["Branch"].isin(selected_branches))
-].copy()
 
-if df_filtered.empty:
+# วันที่สิ้นสุดรวมทั้งวัน (cube daily เก็บระดับวัน)
+end_excl = end_date + pd.Timedelta(days=1)
+# ช่วงที่เลือกเริ่ม/จบกลางเดือน (ภายในช่วงข้อมูล) → section รายเดือน (cube รายเดือน, sketch) นับเดือนแรก/สุดท้ายทั้งเดือน
+month_partial = (start_date.day != 1 and start_date.date() > min_date) or (end_excl.day != 1 and end_date.date() < max_date)
+
+pushdown_filters = None
+if LOAD_MODE == "pushdown" and not (partitioned or artifacts):
+    prof.begin("pushdown load + clean (cached)")
+    try:
+        pushdown_filters = an.build_pushdown_filters(scan, start_date, end_date, selected_branches) or None
+        df, clean_notes, clean_stats = load_clean_dataframe(
+            DATA_PATH, source_fp, strict_dedup,
+            columns=scan["columns"],
+            filters=pushdown_filters,
+            dedup_key=scan["dedup_key"],  # คีย์ที่เลือกจากทั้งไฟล์ → ตัดแถวซ้ำเหมือนโหมด full
+        )
+    except Exception as e:
+        st.error(f"โหลดข้อมูลไม่สำเร็จ: {e}")
+        st.stop()
+    prof.end(len(df))
+for msg in clean_notes:  # replay คำเตือนจากรอบที่ถูก cache ไว้
+    st.warning(msg)
+
+if artifacts:
+    st.sidebar.caption(f"📦 ใช้ผล precompute ({manifest['created']}, strict de-dup = {manifest['strict_dedup']})")
+
+dataset_key = f"{source_fp}|{strict_dedup}|{LOAD_MODE}|{pushdown_filters}"
+# โหมด artifacts/stream ไม่มีแถวดิบให้ DuckDB → ใช้ cube เสมอ
+all_branches = set(selected_branches) == set(branch_list)
+use_duckdb = QUERY_ENGINE == "duckdb" and df is not None
+if use_duckdb:
+    prof.begin("register DuckDB (cached)", len(df))
+    try:
+        engine = load_duckdb(df, dataset_key)
+    except ImportError:
+        st.error("QUERY_ENGINE=duckdb ต้องติดตั้งแพ็กเกจ duckdb ก่อน (pip install duckdb)")
+        st.stop()
+    prof.begin("filter (branch/date)", len(df))
+    q = engine.sections(start_date, end_excl, selected_branches)
+else:
+    if not (partitioned or artifacts or streaming):
+        prof.begin("build_cubes (cached)", len(df))
+        cubes = load_cubes(df, dataset_key)
+        prof.end(sum(len(c) for c in cubes.values()))
+    prof.begin("filter (branch/date)", len(cubes["daily"]))
+    cubes_f = an.slice_cubes(cubes, load_cube_offsets(cubes, f"cubes|{dataset_key}"),
+                             start_date, end_excl, selected_branches)
+    # cube hospital เป็นยอดทุกสาขา → เลือกบางสาขาแล้วมีแถวดิบ: ฮีตแมปรวมจากแถวของสาขาที่เลือก (ช่วงเดือนเดียวกับ cube)
+    heat_rows = None
+    if df is not None and not all_branches and "hospital" in cubes:
+        heat_rows = lambda: slice_branch_dates(
+            df[["Branch","Posting Date","โรงพยาบาล","Customer/Vendor Name","LineTotal"]],
+            load_branch_offsets(df, f"rows|{dataset_key}"), "Posting Date",
+            *an.month_span(start_date, end_excl), selected_branches)
+    q = an.PandasSections(cubes_f, heat_rows)
+
+# ผลทุก section ผ่าน result cache ของโปรเซส — คีย์ = มุมมอง (ชุดข้อมูล, ช่วงวันที่, hash สาขา) + เมธอด + พารามิเตอร์
+view = an.view_key(dataset_key, start_date, end_date, selected_branches)
+q = memo = an.MemoSections(q, result_cache(), view)
+
+def cached(name, compute, *params):
+    """งานนอกเมธอดของ sections (top_cross, sketch) ผ่าน result cache เดียวกัน — ตอนพรีวิวคำนวณตรง (ไม่เก็บค่าประมาณ)"""
+    return compute() if preview is not None else memo.cached(name, compute, *params)
+
+# DTP/Overdue ตอบจาก sketch รายเดือนที่คำนวณไว้ (ไม่ copy แถวทุกครั้งที่เปลี่ยนตัวกรอง)
+if df is not None and not partitioned:
+    sketch = load_sketch(df, dataset_key)
+sketch_f = an.filter_sketch(sketch, start_date, end_excl, selected_branches)
+# แถวดิบยังใช้กับ Data Quality (เป็น view ของ df ที่แชร์ข้าม session — ห้ามแก้ไข in-place)
+df_filtered = (None if df is None else
+               slice_branch_dates(df, load_branch_offsets(df, f"rows|{dataset_key}"),
+                                  "Posting Date", start_date, end_excl, selected_branches))
+
+prof.end(len(q))
+
+if q.empty:
     st.warning("ไม่พบข้อมูลตามตัวกรอง")
     st.stop()
 
+# ================== SECTION JOBS ==================
+# section ของแท็บที่เปิดอยู่ส่งเข้า thread pool พร้อมกัน (ผลเข้า memo) แล้ววาดลง placeholder ตามที่เสร็จ
+# งานค้างของรอบก่อน (ตัวกรอง/แท็บเก่า) ที่ยังไม่เริ่มถูกยกเลิก — งานที่รันอยู่ปล่อยจบ ผลยังอยู่ใน result cache
+an.cancel_sections(st.session_state.pop("section_jobs", {}))
+open_tabs = [st.session_state.get("main_tab", TABS[0])] if LAZY_TABS else TABS
+jobs = an.section_jobs(memo, profit_col, [name for t in open_tabs for name in TAB_SECTIONS[t]])
+ledger = None
+if TABS[1] in open_tabs:
+    # ledger รายผู้ป่วยสร้างครั้งเดียวต่อชุดข้อมูล (ต้องมีแถวดิบ + Patient ID) เมื่อเปิดแท็บนี้ครั้งแรก
+    if df is not None:
+        ledger = load_patient_ledger(df, dataset_key)
+    if ledger is not None:
+        jobs["patients"] = lambda: memo.cached("patient_tables", lambda: an.patient_tables(
+            an.filter_ledger(ledger, start_date, end_excl, selected_branches)))
+    if "dtp" in sketch_f:
+        jobs["dtp"] = lambda: memo.cached("dtp_quantiles", lambda: an.dtp_quantiles(sketch_f["dtp"]))
+    if "overdue" in sketch_f:
+        jobs["overdue"] = lambda: memo.cached("overdue_buckets", lambda: an.sketch_overdue_buckets(sketch_f["overdue"]))
+futures = st.session_state["section_jobs"] = an.submit_sections(section_pool(), jobs, prof)
+
+# พรีวิว: มุมมองใหญ่ที่งานยังไม่เสร็จในช่วงสั้นๆ (ไม่มีใน result cache) → วาดจากตัวอย่างก่อน แล้ว rerun เมื่อค่าจริงเสร็จ
+# พรีวิวครั้งเดียวต่อมุมมอง/แท็บ — รอบ rerun หลังพรีวิววาดค่าจริงเสมอ (ไม่วนพรีวิวซ้ำถ้า pool ยังยุ่งหรือผลถูก evict)
+preview = None
+preview_key = (view, profit_col, tuple(open_tabs))
+if (preview_on and not use_duckdb and len(q) >= PREVIEW_MIN_ROWS
+        and st.session_state.get("previewed") != preview_key and not an.wait_sections(futures, PREVIEW_WAIT_S)):
+    st.session_state["previewed"] = preview_key
+    samples, sample_offsets = load_preview_sample(cubes, dataset_key)
+    preview = q = an.SampledSections(an.slice_cubes(samples, sample_offsets, start_date, end_excl, selected_branches),
+                                     heat_rows)
+
 st.caption(f"🧮 Using profit formula: {profit_formula}")
+if month_partial and not use_duckdb:
+    st.caption("ℹ️ ผลิตภัณฑ์ / โรค / สิทธิการรักษา / ช่องทางชำระ / ฮีตแมป สรุปจาก cube รายเดือน — "
+               "เดือนแรก/เดือนสุดท้ายของช่วงที่เลือกนับทั้งเดือน (KPI และสาขานับตรงวัน)")
+if not use_duckdb and "hospital" in cubes and not all_branches and heat_rows is None:
+    st.caption("ℹ️ ฮีตแมปสิทธิการรักษา × โรงพยาบาลแสดงยอดทุกสาขา (ไม่มีแถวรายการในโหมดนี้)")
+if preview is not None:
+    st.info(f"⚡ ค่าประมาณจากตัวอย่าง {sum(len(s) for s in preview.samples.values()):,} แถว (แบ่งชั้นตามสาขา × เดือน, ± = ช่วงความเชื่อมั่น 95%) "
+            "— กำลังคำนวณค่าจริง หน้าจะอัปเดตเองเมื่อเสร็จ")
 st.info(f"สาขาที่กำลังแสดงผล: {', '.join(selected_branches[:15])}{' ...' if len(selected_branches)>15 else ''}  • ช่วงวันที่: {start_date.date()} → {end_date.date()}")
 
-# ================== TABS ==================
-biz_tab, med_tab = st.tabs(["📈 Business","🩺 Medical"])
-
-# ================== BUSINESS ANALYTICS ==================
-with biz_tab:
-    st.markdown("## 📈 Business Analytics")
-
-    # SUMMARY OVERVIEW
-    total_revenue = df_filtered["LineTotal"].sum()
-    total_profit  = df_filtered["Profit"].sum()
-    avg_margin = (total_profit / total_revenue * 100) if total_revenue else 0
-    branch_count = df_filtered["Branch"].nunique()
-    year_range = f"{df_filtered['Posting Date'].dt.year.min()}–{df_filtered['Posting Date'].dt.year.max()}"
+# SUMMARY OVERVIEW
+def render_kpi():
+    prof.begin("KPI summary", len(q))
+    kpi = q.kpi_summary(profit_col)
+    rev_ci = margin_ci = ""
+    if preview is not None:
+        ci = preview.intervals(profit_col).iloc[0]
+        ci_style = 'style="margin:0;color:#999;font-size:0.85rem;"'
+        rev_ci = f'<div {ci_style}>± {ci["Revenue_ci"]:,.0f} ฿ (ประมาณ)</div>'
+        margin_ci = f'<div {ci_style}>± {ci["Margin%_ci"]:.2f} pp • ARPC {ci["ARPC"]:,.0f} ± {ci["ARPC_ci"]:,.0f} ฿</div>'
 
     st.markdown(f"""
     <div style="display:flex; gap:1.5rem; flex-wrap:wrap; margin-bottom:1.5rem;">
       <div style="flex:1; min-width:220px; background:#1c1c1c; padding:1rem; border-radius:0.8rem; text-align:center;">
         <h4 style="margin:0;color:#ccc;">💰 รายได้รวมทั้งหมด</h4>
-        <h2 style="margin:0;color:#52c41a;">{total_revenue:,.0f} ฿</h2>
+        <h2 style="margin:0;color:#52c41a;">{kpi['revenue']:,.0f} ฿</h2>{rev_ci}
       </div>
       <div style="flex:1; min-width:220px; background:#1c1c1c; padding:1rem; border-radius:0.8rem; text-align:center;">
         <h4 style="margin:0;color:#ccc;">📊 กำไรขั้นต้นรวม</h4>
-        <h2 style="margin:0;color:#fadb14;">{total_profit:,.0f} ฿</h2>
+        <h2 style="margin:0;color:#fadb14;">{kpi['profit']:,.0f} ฿</h2>
       </div>
       <div style="flex:1; min-width:220px; background:#1c1c1c; padding:1rem; border-radius:0.8rem; text-align:center;">
         <h4 style="margin:0;color:#ccc;">📈 อัตรากำไรเฉลี่ย</h4>
-        <h2 style="margin:0;color:#1890ff;">{avg_margin:.1f}%</h2>
+        <h2 style="margin:0;color:#1890ff;">{kpi['margin']:.1f}%</h2>{margin_ci}
       </div>
       <div style="flex:1; min-width:220px; background:#1c1c1c; padding:1rem; border-radius:0.8rem; text-align:center;">
         <h4 style="margin:0;color:#ccc;">🏢 จำนวนสาขา</h4>
-        <h2 style="margin:0;color:#fff;">{branch_count:,}</h2>
+        <h2 style="margin:0;color:#fff;">{kpi['branches']:,}</h2>
       </div>
       <div style="flex:1; min-width:220px; background:#1c1c1c; padding:1rem; border-radius:0.8rem; text-align:center;">
         <h4 style="margin:0;color:#ccc;">📅 ปีข้อมูล</h4>
-        <h2 style="margin:0;color:#fff;">{year_range}</h2>
+        <h2 style="margin:0;color:#fff;">{kpi['year_range']}</h2>
       </div>
     </div>
     """, unsafe_allow_html=True)
 
-    # Top 5 Branches by Revenue and Profit
+
+# Top 5 Branches by Revenue and Profit
+def render_top_branches():
+    prof.begin("Top 5 Branches by Revenue and Profit", len(q))
     st.subheader("Top 5 Branches by Revenue and Profit")
-    top5 = (
-        df_filtered.groupby("Branch")[ ["LineTotal","Profit"] ].sum()
-          .sort_values("LineTotal", ascending=False)
-          .head(5)
-          .reset_index()
-    )
+    top5 = q.top_branches(profit_col, n=5)
     if top5.empty:
         st.info("ไม่มีข้อมูลสำหรับกราฟนี้")
     else:
@@ -246,7 +375,7 @@ with biz_tab:
         top5_melt["Value"]  = pd.to_numeric(top5_melt["Value"], errors="coerce").fillna(0)
 
         chart = (
-            alt.Chart(top5_melt)
+            alt.Chart(chart_frame(top5_melt, ["Branch","Metric","Value"]))
             .mark_bar()
             .encode(
                 x=alt.X("Branch:N", title="Branch"),
@@ -256,17 +385,17 @@ with biz_tab:
             )
         )
         st.altair_chart(chart, use_container_width=True)
+        prof.end(len(top5))
 
-    # Product Revenue Contribution (Top 10)
+
+# Product Revenue Contribution (Top 10)
+def render_product():
+    prof.begin("Product Revenue Contribution (Top 10)", len(q))
     st.subheader("Product Revenue Contribution (Top 10)")
-    if "Description" in df_filtered.columns:
-        prod = (df_filtered.groupby("Description")["LineTotal"].sum()
-                .reset_index()
-                .sort_values("LineTotal", ascending=False).head(10))
-        total_sum = prod["LineTotal"].sum()
-        prod["Percent"] = (prod["LineTotal"]/total_sum)*100 if total_sum>0 else 0
-
-        base = alt.Chart(prod).encode(
+    if "Description" in q.columns:
+        prod = q.product_contribution(n=10)
+
+        base = alt.Chart(chart_frame(prod, ["Description","LineTotal","Percent"])).encode(
             theta=alt.Theta("LineTotal:Q", stack=True),
             color=alt.Color("Description:N", title="Product/Service"),
             tooltip=[
@@ -280,27 +409,23 @@ with biz_tab:
             base.mark_text(radius=145, size=12).encode(text=alt.Text("Percent:Q", format=".1f")),
             use_container_width=True
         )
+        prof.end(len(prod))
     else:
         st.info("ไม่พบคอลัมน์ Description")
 
-# ================== MEDICAL ANALYTICS ==================
-with med_tab:
-    st.markdown("## 🩺 Medical Analytics")
 
-    # ---- Disease Analysis by Average Age (ตามจำนวนเคส) ----
+# ---- Disease Analysis by Average Age (ตามจำนวนเคส) ----
+def render_disease():
+    prof.begin("Disease Analysis by Average Age", len(q))
     st.subheader("Disease Analysis by Average Age")
-    if {"disease_group_mapped","age"}.issubset(df_filtered.columns):
-        dis_age = (
-            df_filtered.groupby("disease_group_mapped", as_index=False)
-            .agg(AverageAge=("age","mean"), Cases=("age","size"))
-            .sort_values(["Cases","AverageAge"], ascending=[False, False])
-        )
+    if {"disease_group_mapped","age_sum"}.issubset(q.columns):
+        dis_age = q.disease_age()
         top_n = st.slider("แสดงสูงสุด (ตามจำนวนเคส)", 5, min(60, len(dis_age)), min(20, len(dis_age)))
         dis_age = dis_age.head(top_n)
         dynamic_height = int(26 * max(5, len(dis_age)) + 80)
 
         chart = (
-            alt.Chart(dis_age, height=dynamic_height)
+            alt.Chart(chart_frame(dis_age, ["disease_group_mapped","AverageAge","Cases"]), height=dynamic_height)
             .mark_bar()
             .encode(
                 x=alt.X("AverageAge:Q", title="Average Age", scale=alt.Scale(nice=True)),
@@ -315,36 +440,54 @@ with med_tab:
             .properties(padding={"left": 10, "right": 10, "top": 10, "bottom": 10})
         )
         st.altair_chart(chart.configure_view(stroke=None), use_container_width=True)
+        prof.end(len(dis_age))
     else:
         st.info("ไม่พบคอลัมน์ที่ต้องใช้ (disease_group_mapped, age)")
 
-    st.markdown("---")
-    st.header("🏥🔖 สิทธิการรักษา • โรงพยาบาล • การจ่ายเงิน")
 
-    # ================== PAYER / RIGHTS ANALYSIS ==================
+# ================== PAYER / RIGHTS ANALYSIS ==================
+def render_payer():
+    prof.begin("1) Payer Mix & KPI", len(q))
     st.subheader("1) Payer Mix & KPI")
-    if "Customer/Vendor Name" in df_filtered.columns:
-        payer_agg = (
-            df_filtered.groupby("Customer/Vendor Name", as_index=False)
-            .agg(
-                Revenue=("LineTotal","sum"),
-                Profit=("Profit","sum"),
-                Cases=("LineTotal","size"),
-            )
-            .sort_values("Revenue", ascending=False)
-        )
-        payer_agg["ARPC"] = payer_agg["Revenue"] / payer_agg["Cases"]  # Avg revenue per case
-        payer_agg["Margin%"] = np.where(payer_agg["Revenue"]>0, payer_agg["Profit"]/payer_agg["Revenue"]*100, 0.0)
+    if "Customer/Vendor Name" in q.columns:
+        payer_agg = q.payer_kpi(profit_col)
+        cmp_cols = an.MARGIN_LABELS
 
         top_payer_n = st.slider("แสดงสิทธิการรักษาสูงสุด (ตามรายได้)", 5, min(50, len(payer_agg)), min(15, len(payer_agg)))
+        compare_formulas = st.checkbox("เทียบ Margin% ทุกสูตรกำไรในตาราง", value=False)
         payer_show = payer_agg.head(top_payer_n)
+        payer_tbl = payer_show
+        payer_show = payer_show.drop(columns=list(cmp_cols.values()))
+        payer_chart = chart_frame(payer_show, ["Customer/Vendor Name","Revenue","Cases","ARPC","Margin%"])
+
+        # พรีวิว: เส้นช่วงความเชื่อมั่น 95% ต่อสิทธิซ้อนบนแท่ง (ทุก layer เรียงแกน y ด้วย sort เดียวกัน)
+        payer_ci = None
+        if preview is not None:
+            payer_ci = chart_frame(
+                payer_show[["Customer/Vendor Name"]].merge(preview.intervals(profit_col, by="Customer/Vendor Name"),
+                                                           on="Customer/Vendor Name", how="left"),
+                ["Customer/Vendor Name","Revenue","Revenue_ci","ARPC","ARPC_ci"])
+
+        def payer_sort(metric):
+            return alt.EncodingSortField(field=metric, op="max", order="descending")
+
+        def with_ci(bars, metric):
+            if payer_ci is None:
+                return bars
+            return bars + alt.Chart(payer_ci).transform_calculate(
+                lo=f"datum['{metric}'] - datum['{metric}_ci']", hi=f"datum['{metric}'] + datum['{metric}_ci']",
+            ).mark_rule(color="#bbb", strokeWidth=2).encode(
+                x="lo:Q", x2="hi:Q",
+                y=alt.Y("Customer/Vendor Name:N", sort=payer_sort(metric)),
+                tooltip=[alt.Tooltip(f"{metric}_ci:Q", format=",.0f", title="± (95%)")],
+            )
 
         cols = st.columns(2)
         with cols[0]:
             st.altair_chart(
-                alt.Chart(payer_show).mark_bar().encode(
+                with_ci(alt.Chart(payer_chart).mark_bar().encode(
                     x=alt.X("Revenue:Q", title="Revenue (฿)"),
-                    y=alt.Y("Customer/Vendor Name:N", sort='-x', title="Payer / สิทธิการรักษา",
+                    y=alt.Y("Customer/Vendor Name:N", sort=payer_sort("Revenue"), title="Payer / สิทธิการรักษา",
                             axis=alt.Axis(labelLimit=300, labelPadding=6)),
                     tooltip=[
                         "Customer/Vendor Name",
@@ -353,14 +496,14 @@ with med_tab:
                         alt.Tooltip("ARPC:Q", format=",.0f", title="Avg/Case"),
                         alt.Tooltip("Margin%:Q", format=".1f", title="Margin (%)"),
                     ]
-                ),
+                ), "Revenue"),
                 use_container_width=True
             )
         with cols[1]:
             st.altair_chart(
-                alt.Chart(payer_show).mark_bar().encode(
+                with_ci(alt.Chart(payer_chart).mark_bar().encode(
                     x=alt.X("ARPC:Q", title="Avg Revenue per Case (฿)"),
-                    y=alt.Y("Customer/Vendor Name:N", sort='-x', title=None,
+                    y=alt.Y("Customer/Vendor Name:N", sort=payer_sort("ARPC"), title=None,
                             axis=alt.Axis(labelLimit=300, labelPadding=6)),
                     tooltip=[
                         "Customer/Vendor Name",
@@ -368,49 +511,47 @@ with med_tab:
                         alt.Tooltip("Cases:Q", format=",d"),
                         alt.Tooltip("Revenue:Q", format=",.0f"),
                     ]
-                ),
+                ), "ARPC"),
                 use_container_width=True
             )
 
         st.dataframe(
-            payer_show.assign(
+            (payer_tbl if compare_formulas else payer_show).assign(
                 Revenue=lambda d: d["Revenue"].map(lambda x: f"{x:,.0f}"),
                 Profit=lambda d: d["Profit"].map(lambda x: f"{x:,.0f}"),
                 ARPC=lambda d: d["ARPC"].map(lambda x: f"{x:,.0f}"),
-                **{"Margin%": payer_show["Margin%"].map(lambda x: f"{x:.1f}%")}
+                **{"Margin%": payer_show["Margin%"].map(lambda x: f"{x:.1f}%")},
+                **({label: payer_tbl[label].map(lambda x: f"{x:.1f}%") for label in cmp_cols.values()}
+                   if compare_formulas else {}),
             ).rename(columns={"Customer/Vendor Name":"Payer / สิทธิการรักษา"}),
             use_container_width=True
         )
+        prof.end(len(payer_agg))
     else:
         st.info("ไม่พบคอลัมน์สิทธิการรักษา (เช่น Customer/Vendor Name)")
 
-    # ================== HOSPITAL x PAYER MATRIX ==================
+
+# ================== HOSPITAL x PAYER MATRIX ==================
+def render_heatmap():
+    prof.begin("2) สิทธิการรักษา × โรงพยาบาล (Cases/Revenue Heatmap)", len(q))
     st.subheader("2) สิทธิการรักษา × โรงพยาบาล (Cases/Revenue Heatmap)")
-    has_cols = {"Customer/Vendor Name","โรงพยาบาล"}.issubset(df_filtered.columns)
+    has_cols = {"Customer/Vendor Name","โรงพยาบาล"}.issubset(q.columns)
     if has_cols:
         metric = st.radio("เลือกตัวชี้วัดสำหรับฮีตแมป", ["Cases","Revenue"], horizontal=True)
-        case_tbl = df_filtered.groupby(["โรงพยาบาล","Customer/Vendor Name"]).size().reset_index(name="Cases")
-        rev_tbl  = df_filtered.groupby(["โรงพยาบาล","Customer/Vendor Name"])["LineTotal"].sum().reset_index(name="Revenue")
-        cross = case_tbl.merge(rev_tbl, on=["โรงพยาบาล","Customer/Vendor Name"], how="outer").fillna(0)
+        cross = q.hospital_payer_cross()
 
-        # rank by chosen metric
-        hosp_tot = cross.groupby("โรงพยาบาล")[metric].sum().sort_values(ascending=False)
-        payer_tot = cross.groupby("Customer/Vendor Name")[metric].sum().sort_values(ascending=False)
-
-        max_h = max(5, min(30, len(hosp_tot)))
-        max_p = max(5, min(30, len(payer_tot)))
+        max_h = max(5, min(30, cross["โรงพยาบาล"].nunique()))
+        max_p = max(5, min(30, cross["Customer/Vendor Name"].nunique()))
         top_h = st.slider("แสดงโรงพยาบาลสูงสุด", 5, max_h, min(12, max_h))
         top_p = st.slider("แสดงสิทธิการรักษาสูงสุด", 5, max_p, min(15, max_p))
 
-        hosp_order = hosp_tot.head(top_h).index.tolist()
-        payer_order = payer_tot.head(top_p).index.tolist()
-        cross_f = cross[cross["โรงพยาบาล"].isin(hosp_order) & cross["Customer/Vendor Name"].isin(payer_order)].copy()
-        cross_f["โรงพยาบาล"] = pd.Categorical(cross_f["โรงพยาบาล"], categories=hosp_order, ordered=True)
-        cross_f["Customer/Vendor Name"] = pd.Categorical(cross_f["Customer/Vendor Name"], categories=payer_order, ordered=True)
+        # rank by chosen metric
+        cross_f, hosp_order, payer_order = cached("top_cross", lambda: an.top_cross(cross, metric, top_h, top_p),
+                                                  metric, top_h, top_p)
         heat_height = 32 * len(hosp_order) + 60
 
         st.altair_chart(
-            alt.Chart(cross_f).mark_rect().encode(
+            alt.Chart(chart_frame(cross_f, ["โรงพยาบาล","Customer/Vendor Name","Cases","Revenue"])).mark_rect().encode(
                 x=alt.X("Customer/Vendor Name:N", title="Payer / สิทธิการรักษา",
                         sort=payer_order, axis=alt.Axis(labelLimit=250, labelPadding=6)),
                 y=alt.Y("โรงพยาบาล:N", title="Hospital", sort=hosp_order,
@@ -425,53 +566,56 @@ with med_tab:
             ).properties(height=heat_height),
             use_container_width=True,
         )
+        prof.end(len(cross_f))
     else:
         st.info("ต้องมีคอลัมน์ 'โรงพยาบาล' และ 'Customer/Vendor Name'")
 
-    # ================== MONTHLY TRENDS BY PAYER ==================
+
+# ================== MONTHLY TRENDS BY PAYER ==================
+def render_trend():
+    prof.begin("3) แนวโน้มรายเดือนตามสิทธิการรักษา (Stacked Area)", len(q))
     st.subheader("3) แนวโน้มรายเดือนตามสิทธิการรักษา (Stacked Area)")
-    if {"Customer/Vendor Name","YM","LineTotal"}.issubset(df_filtered.columns):
+    if {"Customer/Vendor Name","YM","LineTotal"}.issubset(q.columns):
         # เอาเฉพาะ Top N payers โดยรายได้รวม
-        payer_tot = (
-            df_filtered.groupby("Customer/Vendor Name")["LineTotal"].sum()
-            .sort_values(ascending=False)
-        )
+        payer_tot = q.payer_revenue()
         top_p = st.slider("เลือกจำนวน Top Payers ที่แสดง", 3, min(15, len(payer_tot)), min(8, len(payer_tot)))
         top_payers = payer_tot.head(top_p).index.tolist()
 
-        trend = (df_filtered[df_filtered["Customer/Vendor Name"].isin(top_payers)]
-                 .groupby(["YM","Customer/Vendor Name"], as_index=False)["LineTotal"].sum())
-        # เพื่อให้แกนเวลาเรียงถูก
-        trend["YM_ord"] = pd.PeriodIndex(trend["YM"], freq="M").to_timestamp()
+        trend = q.monthly_trend(top_payers)
+        # trend รวมมาที่ระดับ (เดือน × payer) แล้ว → chart ไม่ต้อง sum ซ้ำในเบราว์เซอร์; ช่วงยาวมากลดจุดด้วย LTTB
+        trend_chart = chart_frame(an.downsample_stacked(trend, "YM_ord", "LineTotal", max_rows=an.CHART_MAX_ROWS),
+                                  ["YM_ord","Customer/Vendor Name","LineTotal","Month"])
 
         st.altair_chart(
-            alt.Chart(trend).mark_area(opacity=0.85).encode(
+            alt.Chart(trend_chart).mark_area(opacity=0.85).encode(
                 x=alt.X("YM_ord:T", title="Month"),
-                y=alt.Y("sum(LineTotal):Q", title="Revenue (฿)"),
+                y=alt.Y("LineTotal:Q", title="Revenue (฿)"),
                 color=alt.Color("Customer/Vendor Name:N", title="Payer"),
                 tooltip=[
-                    alt.Tooltip("YM:N", title="Month"),
+                    alt.Tooltip("Month:N", title="Month"),
                     "Customer/Vendor Name:N",
-                    alt.Tooltip("sum(LineTotal):Q", format=",.0f", title="Revenue (฿)")
+                    alt.Tooltip("LineTotal:Q", format=",.0f", title="Revenue (฿)")
                 ]
             ),
             use_container_width=True
         )
+        prof.end(len(trend))
     else:
         st.info("ไม่พบคอลัมน์สำหรับแนวโน้มรายเดือน (YM / Customer/Vendor Name / LineTotal)")
 
-    # ================== PAYMENT METHOD ANALYSIS ==================
+
+# ================== PAYMENT METHOD ANALYSIS ==================
+def render_payment():
+    prof.begin("4) การจ่ายเงิน / ช่องทางชำระ", len(q))
     st.subheader("4) การจ่ายเงิน / ช่องทางชำระ")
-    if "Payment Method" in df_filtered.columns:
-        paym = (df_filtered.groupby("Payment Method", as_index=False)
-                .agg(Revenue=("LineTotal","sum"), Cases=("LineTotal","size")))
-        paym["ARPC"] = np.where(paym["Cases"]>0, paym["Revenue"]/paym["Cases"], 0)
-        paym = paym.sort_values("Revenue", ascending=False)
+    if "Payment Method" in q.columns:
+        paym = q.payment_mix()
+        paym_chart = chart_frame(paym, ["Payment Method","Revenue","Cases","ARPC","Percent"])
 
         cols = st.columns(2)
         with cols[0]:
             st.altair_chart(
-                alt.Chart(paym).mark_bar().encode(
+                alt.Chart(paym_chart).mark_bar().encode(
                     x=alt.X("Revenue:Q", title="Revenue (฿)"),
                     y=alt.Y("Payment Method:N", sort='-x', title="Payment Method",
                             axis=alt.Axis(labelLimit=300, labelPadding=6)),
@@ -485,9 +629,7 @@ with med_tab:
                 use_container_width=True
             )
         with cols[1]:
-            total_rev = paym["Revenue"].sum()
-            paym["Percent"] = np.where(total_rev>0, paym["Revenue"]/total_rev*100, 0.0)
-            base = alt.Chart(paym).encode(
+            base = alt.Chart(paym_chart).encode(
                 theta=alt.Theta("Revenue:Q"),
                 color=alt.Color("Payment Method:N", title="Payment Method"),
                 tooltip=[
@@ -510,54 +652,45 @@ with med_tab:
             ),
             use_container_width=True
         )
+        prof.end(len(paym))
     else:
         st.info("ไม่พบคอลัมน์วิธีชำระเงิน (เช่น Payment Method / วิธีชำระเงิน)")
 
-    # ================== BASIC COLLECTION INSIGHT (OPTIONAL) ==================
-    st.subheader("5) สถานะการรับชำระ (ถ้ามีวันจ่าย/ครบกำหนด)")
-    # ใช้ได้ถ้ามี Posting Date + (Payment Date หรือ Due Date)
-    has_post = "Posting Date" in df_filtered.columns
-    has_pay  = "Payment Date" in df_filtered.columns or "Paid Date" in df_filtered.columns
-    has_due  = "Due Date" in df_filtered.columns
-
-    if has_post and (has_pay or has_due):
-        tmp = df_filtered.copy()
-        pay_date_col = "Payment Date" if "Payment Date" in tmp.columns else ("Paid Date" if "Paid Date" in tmp.columns else None)
-
-        # Days to Pay (DTP) และ Days Overdue (ถ้ามี Due Date)
-        if pay_date_col:
-            tmp["DaysToPay"] = (tmp[pay_date_col] - tmp["Posting Date"]).dt.days
-        if has_due:
-            tmp["DaysOverdue"] = (tmp.get(pay_date_col, tmp["Due Date"]) - tmp["Due Date"]).dt.days
 
+# ================== BASIC COLLECTION INSIGHT (OPTIONAL) ==================
+def render_collection():
+    prof.begin("5) สถานะการรับชำระ (ถ้ามีวันจ่าย/ครบกำหนด)")
+    st.subheader("5) สถานะการรับชำระ (ถ้ามีวันจ่าย/ครบกำหนด)")
+    # ใช้ได้ถ้ามี Posting Date + (Payment Date หรือ Due Date) — รวมจาก sketch ต่อ (สาขา, เดือน, สิทธิ)
+    if sketch_f:
+        if month_partial:
+            st.caption("ℹ️ ส่วนนี้สรุปเป็นรายเดือน — เดือนแรก/เดือนสุดท้ายของช่วงที่เลือกนับทั้งเดือน")
         # แจกแจงตามสิทธิการรักษา (เฉพาะบรรทัดที่มีค่า)
         show_cols = []
-        if "DaysToPay" in tmp.columns:
-            dtp_payer = tmp.dropna(subset=["DaysToPay"]).groupby("Customer/Vendor Name", as_index=False)["DaysToPay"].median() \
-                           .sort_values("DaysToPay")
+        if "dtp" in sketch_f:
+            dtp_payer = cached("dtp_quantiles", lambda: an.dtp_quantiles(sketch_f["dtp"]))
             st.altair_chart(
-                alt.Chart(dtp_payer).mark_bar().encode(
+                alt.Chart(chart_frame(dtp_payer, ["Customer/Vendor Name","DaysToPay","p90","p99"])).mark_bar().encode(
                     x=alt.X("DaysToPay:Q", title="Median Days to Pay"),
                     y=alt.Y("Customer/Vendor Name:N", sort='-x', title="Payer",
                             axis=alt.Axis(labelLimit=300, labelPadding=6)),
-                    tooltip=["Customer/Vendor Name", alt.Tooltip("DaysToPay:Q", format=",d")]
+                    tooltip=["Customer/Vendor Name", alt.Tooltip("DaysToPay:Q", format=",d", title="p50"),
+                             alt.Tooltip("p90:Q", format=",.0f"), alt.Tooltip("p99:Q", format=",.0f")]
                 ),
                 use_container_width=True
             )
+            st.dataframe(
+                dtp_payer.rename(columns={"Customer/Vendor Name":"Payer / สิทธิการรักษา", "DaysToPay":"p50"})
+                  .style.format({"p50":"{:,.1f}","p90":"{:,.1f}","p99":"{:,.1f}"}),
+                use_container_width=True, hide_index=True
+            )
             show_cols.append("DaysToPay")
 
-        if "DaysOverdue" in tmp.columns:
-            dov = tmp.dropna(subset=["DaysOverdue"]).copy()
+        if "overdue" in sketch_f:
             # bucket เป็นช่วงๆ เพื่อดูสัดส่วน
-            bins = [-9999, -1, 0, 7, 30, 60, 90, 9999]
-            labels = ["Early","On time","1–7d","8–30d","31–60d","61–90d",">90d"]
-            dov["OverdueBucket"] = pd.cut(dov["DaysOverdue"], bins=bins, labels=labels)
-            dist = dov.groupby("OverdueBucket", as_index=False)["LineTotal"].sum()
-            total = dist["LineTotal"].sum()
-            dist["Percent"] = np.where(total>0, dist["LineTotal"]/total*100, 0.0)
-
-            base = alt.Chart(dist).encode(
-                x=alt.X("OverdueBucket:N", title="Overdue Bucket", sort=labels),
+            dist = cached("overdue_buckets", lambda: an.sketch_overdue_buckets(sketch_f["overdue"]))
+            base = alt.Chart(chart_frame(dist, ["OverdueBucket","Percent","LineTotal"])).encode(
+                x=alt.X("OverdueBucket:N", title="Overdue Bucket", sort=an.OVERDUE_LABELS),
                 y=alt.Y("Percent:Q", title="Percent (%)"),
                 tooltip=[ "OverdueBucket", alt.Tooltip("Percent:Q", format=".1f"),
                           alt.Tooltip("LineTotal:Q", format=",.0f", title="Revenue (฿)") ],
@@ -569,28 +702,207 @@ with med_tab:
             st.info("มีคอลัมน์วันจ่าย/ครบกำหนด แต่ยังคำนวณไม่ได้ (อาจไม่มีค่าในช่วงที่เลือก)")
     else:
         st.caption("ℹ️ ไม่มีข้อมูลวันจ่าย/ครบกำหนดเพียงพอสำหรับวิเคราะห์ DTP/Overdue ในช่วงนี้")
+    prof.end()
+
+# ================== PATIENTS / COHORTS ==================
+def render_patients():
+    prof.begin("6) ผู้ป่วยรายบุคคล (มาซ้ำ • Cohort • รายได้ต่อผู้ป่วย)")
+    st.subheader("6) ผู้ป่วยรายบุคคล (มาซ้ำ • Cohort • รายได้ต่อผู้ป่วย)")
+    # ผลรายผู้ป่วยเป็นค่าจริงเสมอ (ตอนพรีวิวรอ job เดียวกันใน memo — อยู่ท้ายหน้า section อื่นวาดไปก่อนแล้ว)
+    pt = memo.cached("patient_tables", lambda: an.patient_tables(
+        an.filter_ledger(ledger, start_date, end_excl, selected_branches)))
+    sm = pt["summary"]
+    st.caption(f"ℹ️ คีย์ผู้ป่วย: {an.patient_key(df.columns)} • 1 visit = ผู้ป่วย × วัน • การมาครั้งแรกนับภายในช่วงที่เลือก")
+    if not sm["patients"]:
+        st.info("ไม่มีข้อมูลผู้ป่วยในช่วงนี้")
+        prof.end()
+        return
+
+    cols = st.columns(5)
+    cols[0].metric("ผู้ป่วย", f"{sm['patients']:,}")
+    cols[1].metric("มาซ้ำ (≥ 2 ครั้ง)", f"{sm['revisit_rate']:.1f}%")
+    cols[2].metric("ครั้งต่อผู้ป่วย", f"{sm['visits_per_patient']:.2f}")
+    cols[3].metric("รายได้ต่อผู้ป่วย", f"{sm['revenue_per_patient']:,.0f} ฿")
+    cols[4].metric("ระยะกลับมา (มัธยฐาน)", "–" if sm["median_revisit_days"] is None else f"{sm['median_revisit_days']:,.0f} วัน")
+
+    cols = st.columns(2)
+    with cols[0]:
+        st.altair_chart(
+            alt.Chart(pt["visits"]).mark_bar().encode(
+                x=alt.X("Visits:N", title="จำนวนครั้งที่มา", sort=an.VISIT_BUCKETS),
+                y=alt.Y("Patients:Q", title="Patients"),
+                tooltip=["Visits", alt.Tooltip("Patients:Q", format=",d"), alt.Tooltip("Percent:Q", format=".1f")],
+            ),
+            use_container_width=True
+        )
+    with cols[1]:
+        st.altair_chart(
+            alt.Chart(pt["revisits"]).mark_bar().encode(
+                x=alt.X("Interval:N", title="ระยะห่างถึงการมาครั้งถัดไป", sort=an.REVISIT_LABELS),
+                y=alt.Y("Percent:Q", title="Percent (%)"),
+                tooltip=["Interval", alt.Tooltip("Revisits:Q", format=",d"), alt.Tooltip("Percent:Q", format=".1f")],
+            ),
+            use_container_width=True
+        )
+
+    # retention: เดือนที่มาครั้งแรก × เดือนถัดมา (เลือกดูเฉพาะ cohort ของสาขาแรกที่มาได้)
+    cohort_branches = pt["cohorts"]["Branch"].dropna().unique().tolist()
+    cohort_branch = st.selectbox("Cohort ตามสาขาที่มาครั้งแรก", ["ทุกสาขา", *sorted(cohort_branches)])
+    matrix = an.retention_matrix(pt["cohorts"], None if cohort_branch == "ทุกสาขา" else [cohort_branch])
+    matrix = matrix.assign(CohortMonth=matrix["Cohort"].dt.strftime("%Y-%m"))
+    st.altair_chart(
+        alt.Chart(chart_frame(matrix, ["CohortMonth","MonthsSince","Patients","CohortSize","Retention%"])).mark_rect().encode(
+            x=alt.X("MonthsSince:O", title="เดือนหลังการมาครั้งแรก"),
+            y=alt.Y("CohortMonth:O", title="Cohort (เดือนที่มาครั้งแรก)"),
+            color=alt.Color("Retention%:Q", title="Retention (%)", scale=alt.Scale(scheme="greens")),
+            tooltip=["CohortMonth", "MonthsSince", alt.Tooltip("Patients:Q", format=",d"),
+                     alt.Tooltip("CohortSize:Q", format=",d"), alt.Tooltip("Retention%:Q", format=".1f")],
+        ).properties(height=18 * matrix["CohortMonth"].nunique() + 60),
+        use_container_width=True
+    )
+
+    if pt["payers"] is not None:
+        payers = pt["payers"]
+        st.altair_chart(
+            alt.Chart(chart_frame(payers.head(15), ["Customer/Vendor Name","RevenuePerPatient","Patients","VisitsPerPatient"]))
+            .mark_bar().encode(
+                x=alt.X("RevenuePerPatient:Q", title="Revenue per Patient (฿)"),
+                y=alt.Y("Customer/Vendor Name:N", sort='-x', title="Payer",
+                        axis=alt.Axis(labelLimit=300, labelPadding=6)),
+                tooltip=["Customer/Vendor Name", alt.Tooltip("RevenuePerPatient:Q", format=",.0f"),
+                         alt.Tooltip("Patients:Q", format=",d"), alt.Tooltip("VisitsPerPatient:Q", format=".2f")],
+            ),
+            use_container_width=True
+        )
+        st.dataframe(
+            payers.rename(columns={"Customer/Vendor Name":"Payer / สิทธิการรักษา"})
+              .style.format({"Patients":"{:,}","Visits":"{:,}","Revenue":"{:,.0f}",
+                             "RevenuePerPatient":"{:,.0f}","VisitsPerPatient":"{:.2f}"}),
+            use_container_width=True, hide_index=True
+        )
+    prof.end(sm["patients"])
+
+# ================== TABS ==================
+# สลับแท็บ = rerun → คำนวณ/วาดเฉพาะแท็บที่เปิดอยู่; แต่ละ section จองตำแหน่งด้วย st.empty() ตามลำดับบนหน้า
+biz_tab, med_tab = st.tabs(TABS, key="main_tab", on_change="rerun") if LAZY_TABS else st.tabs(TABS)
+slots = []  # (placeholder, งานที่ต้องรอ, ฟังก์ชันวาด)
+
+def slot(deps, render):
+    slots.append((st.empty(), deps, render))
+
+with biz_tab:
+    if TABS[0] in open_tabs:
+        st.markdown("## 📈 Business Analytics")
+        slot(["kpi"], render_kpi)
+        slot(["top_branches"], render_top_branches)
+        slot(["product"], render_product)
+
+with med_tab:
+    if TABS[1] in open_tabs:
+        st.markdown("## 🩺 Medical Analytics")
+        slot(["disease"], render_disease)
+        st.markdown("---")
+        st.header("🏥🔖 สิทธิการรักษา • โรงพยาบาล • การจ่ายเงิน")
+        slot(["payer"], render_payer)
+        slot(["heatmap"], render_heatmap)
+        slot(["trend"], render_trend)
+        slot(["payment"], render_payment)
+        slot(["dtp","overdue"], render_collection)
+        # ต้องมีรหัสผู้ป่วยจริงและแถวดิบ (โหมด artifacts/stream ไม่มี) — ไม่มี → ไม่แสดง section นี้
+        if ledger is not None:
+            slot(["patients"], render_patients)
+
+def render_ready():
+    """วาดทุก slot ที่งานที่ต้องรอเสร็จแล้ว (งานที่ไม่ได้ส่ง เช่น ขาดคอลัมน์ = ไม่ต้องรอ)"""
+    for s in [s for s in slots if all(futures[d].done() for d in s[1] if d in futures)]:
+        with s[0].container():
+            s[2]()
+        slots.remove(s)
+
+# พรีวิววาดจากตัวอย่างทันทีตามลำดับ; ค่าจริงวาดตามลำดับที่งานเสร็จ (section ที่เร็วขึ้นก่อน ไม่ต้องรอตัวช้าข้างบน)
+if preview is not None:
+    for placeholder, _, render in slots:
+        with placeholder.container():
+            render()
+else:
+    render_ready()
+    for _ in as_completed(futures.values()):
+        render_ready()
 
 # ================== DATA QUALITY / DEBUG ==================
 with st.expander("🔍 Data Quality / Sanity Checks"):
-    st.write("จำนวนแถวหลังกรอง:", len(df_filtered))
-    st.write("จำนวนสาขา:", df_filtered["Branch"].nunique())
-    st.write("ค่าเฉลี่ย LineTotal ต่อแถว:", f"{df_filtered['LineTotal'].mean():,.2f}")
-    st.write("ยอดรวมทั้งหมด (หลัง clean + filter):", f"{df_filtered['LineTotal'].sum():,.0f}")
+    # โหมด artifacts/stream ไม่มีแถวดิบ → นับจาก cube daily (Cases = จำนวนแถว)
+    dq_src = cubes_f["daily"] if df_filtered is None else df_filtered
+    n_rows = int(dq_src["Cases"].sum()) if df_filtered is None else len(df_filtered)
+    st.write("จำนวนแถวหลังกรอง:", n_rows)
+    st.write("จำนวนสาขา:", dq_src["Branch"].nunique())
+    st.write("ค่าเฉลี่ย LineTotal ต่อแถว:", f"{dq_src['LineTotal'].sum() / n_rows:,.2f}")
+    st.write("ยอดรวมทั้งหมด (หลัง clean + filter):", f"{dq_src['LineTotal'].sum():,.0f}")
 
     st.write("ยอดรวมตามสาขา:")
-    st.dataframe(
-        df_filtered.groupby("Branch", as_index=False)["LineTotal"].sum()
-          .sort_values("LineTotal", ascending=False)
-          .style.format({"LineTotal":"{:,.0f}"})
-    )
+    st.dataframe(an.branch_totals(dq_src).style.format({"LineTotal":"{:,.0f}"}))
 
-    st.write("Top 10 transactions by LineTotal:")
-    st.dataframe(
-        df_filtered.nlargest(10, "LineTotal")[ ["Posting Date","Branch","Description","LineTotal"] ]
-          .style.format({"LineTotal":"{:,.0f}"})
-    )
+    if df_filtered is not None:
+        st.write("Top 10 transactions by LineTotal:")
+        st.dataframe(
+            df_filtered.nlargest(10, "LineTotal")[ ["Posting Date","Branch","Description","LineTotal"] ]
+              .style.format({"LineTotal":"{:,.0f}"})
+        )
+
+    if clean_stats.get("dedup"):
+        st.write("จำนวนแถวซ้ำต่อคีย์ (ก่อนตัด, นับทุกแถวในกลุ่มที่ซ้ำ):")
+        st.dataframe(pd.DataFrame({"Key": list(clean_stats["dedup"]), "DuplicateRows": list(clean_stats["dedup"].values())}))
+
+    if "snapshot" in clean_stats:
+        sn = clean_stats["snapshot"]
+        st.write("Cleaned snapshot:", f"{'โหลดจาก' if sn['hit'] else 'เขียน'} {sn['path']}")
+
+    if "ingest" in clean_stats:
+        ig = clean_stats["ingest"]
+        st.write("Partition ingest:", f"{ig['refreshed']:,} / {ig['partitions']:,} ไฟล์ที่ clean ใหม่ "
+                 f"({ig['workers']} workers, โหลด+clean {ig['load_seconds']:.2f} s) รวม {ig['seconds']:.2f} s")
+
+    if "stream" in clean_stats:
+        sm = clean_stats["stream"]
+        st.write("Streaming:", f"{sm['rows']:,} แถว ({sm['rows_kept']:,} หลัง de-dup) ใน {sm['batches']:,} batch × "
+                 f"{sm['batch_rows']:,} แถว, อ่านไฟล์ {sm['passes']} รอบ")
+
+    if "compact" in clean_stats:
+        cp = clean_stats["compact"]
+        saved = cp["mem_before"] - cp["mem_after"]
+        st.write(
+            "หน่วยความจำ (compact dtypes):",
+            f"{cp['mem_before']/2**20:,.1f} MB → {cp['mem_after']/2**20:,.1f} MB "
+            f"(ลด {saved/2**20:,.1f} MB, {saved/cp['mem_before']*100 if cp['mem_before'] else 0:.0f}%)"
+        )
+        st.write("เวลา groupby ก่อน/หลังแปลง dtype (ทั้งชุดข้อมูล):")
+        st.dataframe(
+            cp["timings"].assign(speedup=lambda d: d["before_s"] / d["after_s"])
+              .style.format({"before_s":"{:.4f}","after_s":"{:.4f}","speedup":"{:.1f}×"})
+        )
+    elif df is not None:
+        # ปิดโดยค่าเริ่มต้น: ฐาน "ก่อน" ต้อง copy คอลัมน์มิติเป็นข้อความและ groupby ทั้งชุดข้อมูลซ้ำทุกครั้งที่ clean
+        st.caption("ℹ️ รายงานหน่วยความจำ/เวลา groupby ก่อน-หลัง compact dtypes ปิดอยู่ — ตั้ง COMPACT_REPORT=1 "
+                   "(หรือ PROFILE_STAGES=1) แล้วจะวัดตอน clean ครั้งถัดไป")
+
+    rc = result_cache().stats()
+    st.write("Result cache (ทุก session):", f"{rc['entries']:,} ผล, {rc['bytes']/2**20:,.1f} / {rc['max_bytes']/2**20:,.0f} MB • "
+             f"hit {rc['hits']:,} / miss {rc['misses']:,} ({rc['hit_rate']:.0%}) • evicted {rc['evictions']:,}")
+
+    if profile_on:
+        stage_fmt = {"seconds":"{:.4f}","rows_in":"{:,.0f}","rows_out":"{:,.0f}","mem_delta_mb":"{:+,.1f}"}
+        st.write("⏱️ เวลาแต่ละขั้นในรอบนี้ (ขั้นที่มี cached = เวลาดึงจาก cache ถ้า hit):")
+        st.dataframe(prof.frame().style.format(stage_fmt, na_rep="–"))
+        if clean_stats.get("stages"):
+            st.write("⏱️ เวลาตอนสร้าง cache ของ load/clean (รอบที่ cache miss):")
+            st.dataframe(pd.DataFrame(clean_stats["stages"], columns=an.STAGE_COLUMNS).style.format(stage_fmt, na_rep="–"))
 
 st.markdown("---")
 st.caption(
-    f"📅 Data: {min_date} → {max_date} | Rows after filter: {len(df_filtered):,} | Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    f"📅 Data: {min_date} → {max_date} | Rows after filter: {n_rows:,} | Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
 )
+
+# พรีวิววาดครบแล้ว → รอค่าจริงจาก thread pool แล้ววาดใหม่ทั้งหน้า (รอบถัดไปดึงผลจาก memo ทันที)
+if preview is not None:
+    an.wait_sections(futures)
+    st.rerun()
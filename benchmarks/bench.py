@@ -0,0 +1,135 @@
+# benchmarks/bench.py
+"""วัดเวลา/หน่วยความจำของแต่ละ stage ของ dashboard บนข้อมูลสังเคราะห์หลายขนาด
+
+แต่ละขนาดรันใน process แยก (peak RSS ไม่ปนกัน) แล้วต่อท้ายผลใน results.jsonl พร้อม git revision
+เพื่อเทียบข้ามเวอร์ชัน — stage ที่ช้ากว่ารอบก่อนของขนาดเดียวกันเกิน --threshold จะถูกทำเครื่องหมาย
+
+    python benchmarks/bench.py --rows 100000 1000000 10000000
+"""
+import argparse, json, os, resource, subprocess, sys, tempfile, time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+import analytics as an
+from synthetic import generate
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")  # อยู่ใน .gitignore (ผลต่อเครื่อง)
+DATA_DIR = os.path.join(tempfile.gettempdir(), "hospital-bench")
+
+def _peak_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: KiB
+
+def run_stages(path: str) -> list:
+    """รันทุก stage ครั้งเดียว คืน [{"stage", "seconds", "rows", "peak_mb"}]"""
+    out = []
+
+    def stage(name, fn):
+        t0 = time.perf_counter()
+        res = fn()
+        rows = len(res) if hasattr(res, "__len__") and not isinstance(res, dict) else None
+        out.append({"stage": name, "seconds": time.perf_counter() - t0, "rows": rows, "peak_mb": _peak_mb()})
+        return res
+
+    raw = stage("load_parquet", lambda: an.read_parquet(path))
+    df = stage("clean_dataframe", lambda raw=raw: an.clean_dataframe(raw, strict_dedup=True, warn=lambda msg: None))
+    del raw  # ไม่ถือแถวดิบค้างระหว่าง stage ถัดไป (lambda ผูก raw ไว้เป็น default — ไม่อ้างชื่อที่ถูกลบ)
+    df = stage("profit+sort", lambda: an.add_profit_columns(an.sort_by_branch_date(df, "Posting Date")))
+    cubes = stage("build_cubes", lambda: an.build_cubes(df))
+    out[-1]["rows"] = sum(len(c) for c in cubes.values())
+    row_offsets = stage("offsets(rows)", lambda: an.branch_offsets(df))
+    cube_offsets = stage("offsets(cubes)", lambda: an.cube_offsets(cubes))
+
+    # ตัวกรองแบบที่ผู้ใช้เลือกบ่อย: ครึ่งหนึ่งของสาขา × 180 วันล่าสุด
+    branches = sorted(row_offsets)[: max(1, len(row_offsets) // 2)]
+    end_excl = df["Posting Date"].max().normalize() + pd.Timedelta(days=1)
+    start = end_excl - pd.Timedelta(days=180)
+    stage("filter(rows)", lambda: an.slice_branch_dates(df, row_offsets, "Posting Date", start, end_excl, branches))
+    q = an.PandasSections(stage("filter(cubes)", lambda: an.slice_cubes(cubes, cube_offsets, start, end_excl, branches)))
+
+    stage("kpi_summary", lambda: q.kpi_summary())
+    stage("top_branches", lambda: q.top_branches())
+    stage("product_contribution", lambda: q.product_contribution())
+    stage("disease_age", lambda: q.disease_age())
+    stage("payer_kpi", lambda: q.payer_kpi())
+    cross = stage("hospital_payer_cross", lambda: q.hospital_payer_cross())
+    stage("top_cross", lambda: an.top_cross(cross, "Revenue", 12, 15))
+    top_payers = q.payer_revenue().head(8).index.tolist()
+    stage("monthly_trend", lambda: q.monthly_trend(top_payers))
+    stage("payment_mix", lambda: q.payment_mix())
+    sketch = stage("collection_sketch", lambda: an.collection_sketch(an.collection_rows(df)))
+    sketch_f = stage("filter(sketch)", lambda: an.filter_sketch(sketch, start, end_excl, branches))
+    stage("dtp_quantiles", lambda: an.dtp_quantiles(sketch_f["dtp"]))
+    stage("overdue_buckets", lambda: an.sketch_overdue_buckets(sketch_f["overdue"]))
+    ledger = stage("patient_ledger", lambda: an.patient_ledger(df))
+    ledger_f = stage("filter(ledger)", lambda: an.filter_ledger(ledger, start, end_excl, branches))
+    stage("patient_tables", lambda: an.patient_tables(ledger_f))
+    return out
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def _previous(results_path: str, rows: int, dup_rate: float, before: str):
+    """ผลรอบล่าสุดก่อนหน้าของขนาด/อัตราซ้ำเดียวกัน"""
+    prev = None
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec["rows"] == rows and rec["dup_rate"] == dup_rate and rec["run"] != before:
+                    prev = rec
+    return prev
+
+def report(rec: dict, prev, threshold: float):
+    print(f"\n== {rec['rows']:,} rows (dup {rec['dup_rate']:.1%}) @ {rec['git']} — peak {rec['peak_mb']:,.0f} MB")
+    before = {s["stage"]: s["seconds"] for s in prev["stages"]} if prev else {}
+    for s in rec["stages"]:
+        line = f"  {s['stage']:<22}{s['seconds']:>10.4f} s{s['peak_mb']:>10,.0f} MB"
+        if s["stage"] in before and before[s["stage"]] > 0:
+            ratio = s["seconds"] / before[s["stage"]]
+            line += f"   {ratio:>5.2f}× vs {prev['git']}" + ("  ⚠ regression" if ratio > 1 + threshold else "")
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark stages ของ dashboard บนข้อมูลสังเคราะห์")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--dup-rate", type=float, default=0.01)
+    parser.add_argument("--data-dir", default=DATA_DIR, help="ที่เก็บไฟล์สังเคราะห์ (สร้างครั้งเดียวแล้วใช้ซ้ำ)")
+    parser.add_argument("--results", default=RESULTS, help="ไฟล์ประวัติผล (ต่อท้าย) — ค่าเริ่มต้นไม่ถูก commit")
+    parser.add_argument("--threshold", type=float, default=0.2, help="ช้ากว่ารอบก่อนเกินสัดส่วนนี้ = regression")
+    parser.add_argument("--child", help=argparse.SUPPRESS)  # path ของไฟล์ที่จะวัด (รันใน process ลูก)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_stages(args.child)))
+        return
+
+    run = datetime.now().isoformat(timespec="seconds")
+    for rows in args.rows:
+        path = os.path.join(args.data_dir, f"synthetic_{rows}_{args.dup_rate:g}.parquet")
+        if not os.path.exists(path):
+            print(f"generating {path} ...")
+            generate(path, rows, args.dup_rate)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", path],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{rows:,} rows failed:\n{proc.stderr}", file=sys.stderr)
+            continue
+        stages = json.loads(proc.stdout.strip().splitlines()[-1])
+        rec = {
+            "run": run, "git": _git_rev(), "rows": rows, "dup_rate": args.dup_rate,
+            "python": sys.version.split()[0], "pandas": pd.__version__,
+            "peak_mb": max(s["peak_mb"] for s in stages), "stages": stages,
+        }
+        report(rec, _previous(args.results, rows, args.dup_rate, run), args.threshold)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# benchmarks/synthetic.py
+"""สร้างไฟล์ parquet สังเคราะห์ schema เดียวกับข้อมูลจริงของ dashboard (100k – 50M แถว)
+
+เขียนทีละ chunk ด้วย ParquetWriter — หน่วยความจำคงที่ไม่ขึ้นกับจำนวนแถว
+
+    python benchmarks/synthetic.py --rows 1000000 --dup-rate 0.02 --out /tmp/tx_1m.parquet
+"""
+import argparse, os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# ชื่อกลุ่มโรคภาษาไทยที่ clean_dataframe map ได้ + กลุ่มอื่นๆ ที่ไม่มีใน mapping (ผ่านไปตามเดิม)
+DISEASES_TH = [
+    "กล้ามเนื้อเคล็ด", "โรคทางเดินปัสสาวะ", "ปัจจัยที่มีผลต่อสถานะสุขภาพ",
+    "ความผิดปกติจากทางคลินิกและห้องปฏิบัติการ", "โรคทางเดินอาหาร", "URI",
+    "การติดเชื้อไวรัส", "การบาดเจ็บ การเป็นพิษ และอุบัติเหตุ",
+]
+PAYERS_TH = ["บัตรทอง", "ประกันสังคม", "เงินสด", "ข้าราชการ", "AIA", "Allianz", "เมืองไทยประกันชีวิต"]
+GENDERS   = ["M", "F", "ชาย", "หญิง", "W", ""]
+METHODS   = ["Cash", "Card", "Transfer", "QR", "Credit"]
+
+def _labels(base: list, n: int, prefix: str) -> np.ndarray:
+    """n ค่าแรกจาก base แล้วต่อด้วย prefix+เลข ถ้า n มากกว่า base"""
+    out = list(base[:n]) + [f"{prefix}{i:03d}" for i in range(max(0, n - len(base)))]
+    return np.array(out, dtype=object)
+
+def make_chunk(rng: np.random.Generator, n: int, doc_offset: int, *, branches=30, hospitals=40,
+               payers=25, diseases=60, products=300, patients=20_000, start="2022-01-01", days=1095) -> pd.DataFrame:
+    """n แถวของรายการ (ค่าต่อคอลัมน์สุ่มแบบสม่ำเสมอ ยกเว้น payer/สินค้าเบ้แบบ Zipf ให้ใกล้ข้อมูลจริง)"""
+    branch_names = np.array([f"สาขา {i:02d} " for i in range(branches)], dtype=object)  # มีช่องว่างท้ายให้ strip
+    hosp_names   = np.array([f"โรงพยาบาล {i:03d}" for i in range(hospitals)], dtype=object)
+    payer_names  = _labels(PAYERS_TH, payers, "ประกันเอกชน ")
+    disease_names = _labels(DISEASES_TH, diseases, "กลุ่มโรค ")
+    product_names = np.array([f"รายการ {i:04d}" for i in range(products)], dtype=object)
+
+    def zipf_choice(values, size):
+        w = 1.0 / np.arange(1, len(values) + 1)
+        return values[rng.choice(len(values), size=size, p=w / w.sum())]
+
+    posting = np.datetime64(start, "D") + rng.integers(0, days, n).astype("timedelta64[D]")
+    doc = doc_offset + np.arange(n) // 3  # ~3 บรรทัดต่อเอกสาร
+    qty = rng.integers(1, 6, n)
+    avg_cost = rng.gamma(2.0, 80.0, n).round(2)
+    line_total = (avg_cost * qty * rng.uniform(1.1, 2.5, n)).round(2)
+    paid = posting + rng.integers(0, 150, n).astype("timedelta64[D]")
+    unpaid = rng.random(n) < 0.05
+    frame = pd.DataFrame({
+        "Posting Date": posting.astype("datetime64[ns]"),
+        "Branch": branch_names[rng.integers(0, branches, n)],
+        "โรงพยาบาล": hosp_names[rng.integers(0, hospitals, n)],
+        "Customer/Vendor Name": zipf_choice(payer_names, n),
+        "group_disease": disease_names[rng.integers(0, diseases, n)],
+        "เพศ คนไข้": np.array(GENDERS, dtype=object)[rng.integers(0, len(GENDERS), n)],
+        "age": rng.integers(0, 95, n).astype("float64"),
+        "LineTotal": line_total,
+        "avg_cost": avg_cost,
+        "Quantity": qty,
+        "Document No": np.char.add("INV", doc.astype(str)).astype(object),
+        "Line No": np.arange(n) % 3 + 1,
+        "Description": zipf_choice(product_names, n),
+        "Payment Method": np.array(METHODS, dtype=object)[rng.integers(0, len(METHODS), n)],
+        "Payment Date": pd.Series(paid.astype("datetime64[ns]")).where(~unpaid),
+        "Due Date": (posting + np.timedelta64(30, "D")).astype("datetime64[ns]"),
+    })
+    # HN ต่อเอกสาร (ทุกบรรทัดของเอกสารเป็นผู้ป่วยคนเดียว) จากกลุ่มผู้ป่วยเดียวกันทุก chunk → มีผู้ป่วยมาซ้ำ
+    # สุ่มหลังคอลัมน์อื่น: คอลัมน์เดิมของ seed เดิมไม่เปลี่ยน
+    frame["HN"] = np.char.add("HN", rng.integers(0, patients, n // 3 + 1)[doc - doc_offset].astype(str)).astype(object)
+    return frame
+
+def generate(path: str, rows: int, dup_rate: float = 0.01, chunk_rows: int = 1_000_000, seed: int = 0,
+             **cardinality) -> str:
+    """เขียน rows แถว (รวมแถวซ้ำ ~dup_rate ที่คัดลอกจากแถวเดิมใน chunk เดียวกัน) ลง path"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    writer, written = None, 0
+    try:
+        while written < rows:
+            n = min(chunk_rows, rows - written)
+            n_dup = int(round(n * dup_rate))
+            chunk = make_chunk(rng, n - n_dup, doc_offset=written, **cardinality)
+            if n_dup:
+                chunk = pd.concat([chunk, chunk.iloc[rng.integers(0, len(chunk), n_dup)]], ignore_index=True)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path + ".tmp", table.schema)
+            writer.write_table(table)
+            written += n
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(path + ".tmp", path)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="สร้างข้อมูลรายการโรงพยาบาลสังเคราะห์ (parquet)")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--dup-rate", type=float, default=0.01, help="สัดส่วนแถวซ้ำ (0–1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    for name, default in [("branches", 30), ("hospitals", 40), ("payers", 25), ("diseases", 60), ("products", 300),
+                          ("patients", 20_000)]:
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"จำนวน {name} ที่ต่างกัน")
+    args = parser.parse_args(argv)
+    generate(args.out, args.rows, args.dup_rate, args.chunk_rows, args.seed,
+             branches=args.branches, hospitals=args.hospitals, payers=args.payers,
+             diseases=args.diseases, products=args.products, patients=args.patients)
+    print(f"wrote {args.out}: {args.rows:,} rows")
+
+if __name__ == "__main__":
+    main()
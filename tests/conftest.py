@@ -0,0 +1,57 @@
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+# แคช/snapshot ของ test แยกจากของเครื่อง (ต้องตั้งก่อน import analytics)
+os.environ["DATA_CACHE_DIR"] = tempfile.mkdtemp(prefix="hospital-analysis-test-")
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import analytics as an
+from synthetic import generate
+
+ROWS = 20_000
+
+def _norm(frame: pd.DataFrame, keys=None) -> pd.DataFrame:
+    """เทียบค่าได้โดยไม่สน dtype/ลำดับแถว: category → str, เรียงตาม keys (ค่าเริ่มต้น = คอลัมน์ที่ไม่ใช่ทศนิยม)"""
+    out = frame.reset_index(drop=True).copy()
+    for c in out.columns:
+        if isinstance(out[c].dtype, pd.CategoricalDtype) or out[c].dtype == object:
+            out[c] = out[c].astype(str)
+    keys = keys or [c for c in out.columns if not pd.api.types.is_float_dtype(out[c])]
+    return out.sort_values(keys).reset_index(drop=True)
+
+def assert_same(a: pd.DataFrame, b: pd.DataFrame, keys=None):
+    pd.testing.assert_frame_equal(_norm(a, keys), _norm(b, keys)[list(a.columns)], check_dtype=False, rtol=1e-9)
+
+def assert_same_cubes(a: dict, b: dict):
+    """assert_same ของทุก cube (เรียงตามเวลา + มิติของ cube นั้น)"""
+    assert a.keys() == b.keys()
+    for name in a:
+        dims, time_col = an.CUBES[name]
+        assert_same(a[name], b[name], [time_col, *dims])
+
+@pytest.fixture(scope="session")
+def parts_dir(tmp_path_factory):
+    """โฟลเดอร์ partition 3 ไฟล์ (คนละ seed → สาขา/ช่วงวันที่ทับกัน มีแถวซ้ำในแต่ละไฟล์)"""
+    root = tmp_path_factory.mktemp("parts")
+    for i in range(3):
+        generate(str(root / f"part_{i}.parquet"), ROWS // 3, dup_rate=0.02, seed=i)
+    return str(root)
+
+@pytest.fixture(scope="session")
+def source(parts_dir, tmp_path_factory):
+    """ไฟล์เดียวที่เป็นการต่อกันของทุก partition (ลำดับเดียวกับ list_partitions)"""
+    path = tmp_path_factory.mktemp("full") / "data.parquet"
+    pq.write_table(pa.concat_tables([pq.read_table(os.path.join(parts_dir, f"part_{i}.parquet")) for i in range(3)]),
+                   path)
+    return str(path)
+
+@pytest.fixture(scope="session")
+def full(source):
+    """ทางตรง: load_clean ทั้งไฟล์ → (df, cubes, sketch, notes)"""
+    df, notes, _ = an.load_clean(source, strict_dedup=True)
+    return df, an.build_cubes(df), an.collection_sketch(an.collection_rows(df)), notes
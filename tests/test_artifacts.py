@@ -0,0 +1,45 @@
+"""precompute CLI → read_artifacts ต้องได้ cube/sketch/ตารางเท่ากับคำนวณตรงจาก load_clean (โหมดปกติและ --stream)"""
+import json, os
+
+import numpy as np
+import pytest
+
+import analytics as an
+from conftest import assert_same, assert_same_cubes
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_precompute_round_trip(source, full, tmp_path, stream):
+    df, cubes, sketch, notes = full
+    out = str(tmp_path / "artifacts")
+    assert an.main(["precompute", "--source", source, "--out", out, *(["--stream"] if stream else [])]) == 0
+    manifest, a_cubes, a_sketch = an.read_artifacts(out)
+    assert manifest["rows"] == len(df) and manifest["notes"] == list(notes)
+    assert manifest["cleaning_version"] == an.CLEANING_VERSION
+    assert_same_cubes(cubes, a_cubes)
+    for kind in ("dtp", "overdue"):
+        assert_same(sketch[kind], a_sketch[kind])
+    tables = an.section_tables(cubes, sketch, manifest["profit_col"])
+    assert sorted(tables) == manifest["tables"]
+    for name, table in tables.items():
+        assert_same(table, an.read_table(out, name))
+
+def test_old_manifest_rejected(source, tmp_path):
+    out = str(tmp_path / "artifacts")
+    an.main(["precompute", "--source", source, "--out", out])
+    path = os.path.join(out, an.MANIFEST)
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["cleaning_version"] = an.CLEANING_VERSION - 1
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    with pytest.raises(ValueError, match="CLEANING_VERSION"):
+        an.read_artifacts(out)
+
+def test_sketch_quantiles_within_one_bin(full):
+    # DaysToPay เป็นจำนวนเต็มวัน → ฮิสโตแกรมของ sketch มี bin กว้าง 1 วัน
+    df, _, sketch, _ = full
+    rows = an.collection_rows(df)
+    got = an.dtp_quantiles(sketch["dtp"]).set_index("Customer/Vendor Name")
+    for payer, days in rows.dropna(subset=["DaysToPay"]).groupby("Customer/Vendor Name", observed=True)["DaysToPay"]:
+        for q, label in an.DTP_QUANTILES.items():
+            assert abs(got.loc[payer, label] - np.quantile(days.to_numpy(dtype="float64"), q)) <= 1, (payer, label)
@@ -0,0 +1,16 @@
+"""downsample_stacked ต้องลดจุดให้ทุก series อยู่ใน max_rows (compact_frame ไม่ต้องตัดท้ายกราฟ)"""
+import numpy as np
+import pandas as pd
+
+import analytics as an
+
+def test_downsample_stacked_fits_max_rows():
+    months, series = 3_000, 15
+    df = pd.DataFrame({"x": np.repeat(np.arange(months), series), "s": np.tile(np.arange(series), months),
+                       "y": np.random.default_rng(0).random(months * series)})
+    out = an.downsample_stacked(df, "x", "y", max_points=1_000, max_rows=5_000)
+    assert len(out) <= 5_000
+    # ทุก series มีจุดชุดเดียวกัน และครอบคลุมทั้งช่วง (ไม่ถูกตัดท้าย)
+    assert out.groupby("s")["x"].apply(tuple).nunique() == 1
+    assert out["x"].min() == 0 and out["x"].max() == months - 1
+    assert len(an.compact_frame(out, ["x", "s", "y"], max_rows=5_000)) == len(out)
@@ -0,0 +1,127 @@
+"""clean_dataframe ทีละขั้นเทียบกับวิธีตรง ๆ แบบเดิม (drop_duplicates ฯลฯ)"""
+import pandas as pd
+import pytest
+
+import analytics as an
+from synthetic import generate
+
+@pytest.fixture(scope="module")
+def raw(tmp_path_factory):
+    """แถวดิบที่มีแถวซ้ำฝังไว้ (synthetic คัดลอกแถวต้น chunk ไปไว้ท้าย chunk)"""
+    return pd.read_parquet(generate(str(tmp_path_factory.mktemp("clean") / "raw.parquet"), 3_000, dup_rate=0.05, seed=5))
+
+def _unique(frame, col):
+    return frame.assign(**{col: [f"u{i}" for i in range(len(frame))]})
+
+# แต่ละกรณีทำให้คีย์ก่อนหน้าไม่มีแถวซ้ำ → ต้องไล่ CANDIDATE_KEYS ไปคีย์ถัดไป
+DEDUP_CASES = {
+    "line_no": (lambda f: f, 0),
+    "description": (lambda f: _unique(f, "Line No"), 1),
+    "posting_only": (lambda f: _unique(_unique(f, "Line No"), "Document No"), 2),
+    "no_key": (lambda f: _unique(_unique(_unique(f, "Line No"), "Document No"), "Description"), None),
+}
+
+@pytest.mark.parametrize("case", DEDUP_CASES)
+def test_dedup_matches_drop_duplicates(raw, case):
+    make, key_index = DEDUP_CASES[case]
+    frame = make(raw)
+    base = an.clean_dataframe(frame, strict_dedup=False)
+    notes, stats = [], {}
+    got = an.clean_dataframe(frame, strict_dedup=True, warn=notes.append, stats=stats)
+
+    keys = [ks for ks in an.CANDIDATE_KEYS if set(ks) <= set(base.columns)]
+    assert stats["dedup"] == {" + ".join(ks): int(base.duplicated(subset=ks, keep=False).sum()) for ks in keys}
+    chosen = next((ks for ks in keys if base.duplicated(subset=ks).any()), None)
+    assert chosen == (None if key_index is None else an.CANDIDATE_KEYS[key_index])
+    if chosen is None:
+        pd.testing.assert_frame_equal(got, base)
+        assert not notes
+        return
+    expected = base.drop_duplicates(subset=chosen)  # keep="first"
+    assert len(expected) < len(base)
+    pd.testing.assert_frame_equal(got, expected)
+    assert notes == [f"🧹 ลบข้อมูลซ้ำ {len(base) - len(expected):,} แถว ด้วยคีย์ {chosen}"]
+
+# ค่าที่ strip แล้วชนกัน (" A"/"A "/"A"), ค่าว่าง/NA หลายแบบ และค่าที่ไม่อยู่ใน mapping
+TEXT_VALUES = [" A", "A", "A ", "B", None, float("nan"), "", "  ", "nan", "M", " F", "ชาย ", "หญิง", "W", "x", "m"]
+GENDER_MAPPING = {"M": "Male", "F": "Female", "W": "Female", "ชาย": "Male", "หญิง": "Female"}  # ของ clean_dataframe
+
+def test_map_unique_matches_per_row():
+    s = pd.Series(TEXT_VALUES * 50, name="Branch").sample(frac=1, random_state=0)
+    got = an.map_unique(s, an._strip_text)
+    pd.testing.assert_series_equal(got, an._strip_text(s).astype("category"))
+    assert list(got.cat.categories) == sorted(set(got.dropna()))
+    # input เป็น category อยู่แล้ว (แบบที่ clean_dataframe ส่งต่อ) ก็ต้องได้ผลเดียวกัน
+    pd.testing.assert_series_equal(an.map_unique(s.astype("category"), an._strip_text), got)
+
+def test_gender_mapping_matches_per_row():
+    raw = pd.DataFrame({"Posting Date": "2024-01-01", "เพศ คนไข้": TEXT_VALUES * 3})
+    got = an.clean_dataframe(raw, strict_dedup=False)["gender_mapped"]
+    # แบบเดิม: strip ทุกแถว แล้ว map ทุกแถว ค่าที่ไม่รู้จัก (รวมค่าว่าง) เป็น "Other"
+    expected = raw["เพศ คนไข้"].astype(str).str.strip().map(GENDER_MAPPING).fillna("Other")
+    pd.testing.assert_series_equal(got.astype(str), expected, check_names=False)
+    assert set(got.cat.categories) == {"Male", "Female", "Other"}
+
+def _wide(df):
+    """schema ก่อน compact: ข้อความเป็น object, ตัวเลขเป็น float64/int64"""
+    return df.assign(**{c: df[c].astype(object) for c in an.DIMENSION_COLS if c in df.columns},
+                     age=df["age"].astype("float64"), Quantity=df["Quantity"].astype("float64"),
+                     Year=df["Year"].astype("int64"))
+
+def test_compact_dtypes_keeps_aggregates(raw):
+    wide = _wide(an.clean_dataframe(raw, strict_dedup=False))
+    stats = {}
+    got = an.compact_dtypes(wide.copy(), stats=stats, report=True)
+    for c in an.DIMENSION_COLS:
+        if c in wide.columns:
+            assert isinstance(got[c].dtype, pd.CategoricalDtype), c
+    assert got["age"].dtype == "float32" and got["Quantity"].dtype == "int32" and got["Year"].dtype == "Int16"
+    assert got["LineTotal"].dtype == "float64" and got["avg_cost"].dtype == "float64"
+    for dims, col, how in [("Branch", "LineTotal", "sum"), (["โรงพยาบาล", "Customer/Vendor Name"], "LineTotal", "sum"),
+                           ("disease_group_mapped", "age", "mean"), ("Payment Method", "Quantity", "sum"),
+                           ("Year", "LineTotal", "size")]:
+        pd.testing.assert_series_equal(got.groupby(dims, observed=True)[col].agg(how),
+                                       wide.groupby(dims)[col].agg(how), check_dtype=False, check_index_type=False,
+                                       check_categorical=False, rtol=1e-6)
+    cp = stats["compact"]
+    assert cp["mem_after"] < cp["mem_before"] and set(cp["timings"].columns) == {"before_s", "after_s"}
+
+def test_compact_dtypes_fractional_quantity():
+    df = pd.DataFrame({"Quantity": [1.0, 2.5, 3.0], "age": [30.0, 41.0, 5.0], "Year": [2023, 2024, 2024]})
+    got = an.compact_dtypes(df.copy(), stats={}, report=False)
+    assert got["Quantity"].dtype == "float32" and got["Quantity"].sum() == df["Quantity"].sum()
+    assert got["Year"].tolist() == [2023, 2024, 2024]
+
+def _baseline_profit(df, formula):
+    """สูตรเดิมที่คำนวณใหม่ทุกครั้งที่เลือกใน selectbox"""
+    if formula.startswith("Per-Unit"):
+        if {"avg_cost","Quantity"}.issubset(df.columns):
+            return df["LineTotal"] - (df["avg_cost"] * df["Quantity"])
+        return pd.Series(0.0, index=df.index)
+    if formula.startswith("Current"):
+        return df["LineTotal"] - df.get("avg_cost", 0)
+    return df["LineTotal"] * 0.40
+
+PROFIT_FRAMES = {
+    "costs": pd.DataFrame({"LineTotal": [100.0, 250.5, 0.0, 80.0, 1e6], "avg_cost": [40.0, 0.0, 10.0, float("nan"), 123.45],
+                           "Quantity": pd.array([2, 3, 1, 4, 7], dtype="int32")}),
+    "no_quantity": pd.DataFrame({"LineTotal": [100.0, 50.0], "avg_cost": [0.0, float("nan")]}),
+    "no_cost": pd.DataFrame({"LineTotal": [100.0, 50.0], "Quantity": [1.0, 2.0]}),
+}
+
+@pytest.mark.parametrize("name", PROFIT_FRAMES)
+def test_profit_columns_match_formulas(name):
+    frame = PROFIT_FRAMES[name]
+    got = an.add_profit_columns(frame.copy())
+    for formula, col in an.PROFIT_FORMULAS.items():
+        expected = _baseline_profit(frame, formula).astype("float64")
+        pd.testing.assert_series_equal(got[col], expected, check_names=False)
+        assert got[col].dtype == "float64"
+
+def test_profit_after_clean_fills_missing_cost(raw):
+    # clean เติม avg_cost ที่หายเป็น 0 ก่อนคำนวณกำไร (เหมือนเดิม)
+    frame = raw.assign(avg_cost=raw["avg_cost"].mask(raw.index % 7 == 0))
+    df = an.add_profit_columns(an.clean_dataframe(frame, strict_dedup=False))
+    assert df["avg_cost"].notna().all() and (df["avg_cost"] == 0).any()
+    for formula, col in an.PROFIT_FORMULAS.items():
+        pd.testing.assert_series_equal(df[col], _baseline_profit(df, formula).astype("float64"), check_names=False)
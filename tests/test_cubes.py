@@ -0,0 +1,37 @@
+"""cube แยกตาม section ต้องเล็กกว่าข้อมูลดิบมาก และฮีตแมปจากแถว (เลือกบางสาขา) ต้องตรงกับ cube hospital"""
+import pandas as pd
+import pytest
+
+import analytics as an
+from conftest import assert_same
+from synthetic import generate
+
+ROWS = 400_000
+
+@pytest.fixture(scope="module")
+def year(tmp_path_factory):
+    """1 ปี 30 สาขา — ความหนาแน่นใกล้ข้อมูลจริง (หลายรายการต่อสาขาต่อวัน)"""
+    path = generate(str(tmp_path_factory.mktemp("cubes") / "year.parquet"), ROWS, dup_rate=0, seed=11,
+                    days=365, products=60, diseases=20)
+    df, _, _ = an.load_clean(path)
+    return df
+
+def test_cubes_much_smaller_than_rows(year):
+    cubes = an.build_cubes(year)
+    assert set(cubes) == set(an.CUBES)
+    sizes = {name: len(cube) for name, cube in cubes.items()}
+    assert max(sizes.values()) <= len(year) / 10, sizes
+    assert sum(sizes.values()) <= len(year) / 4, sizes
+    # measure รวมของทุก cube ยังเท่ากับยอดของแถวดิบ
+    for cube in cubes.values():
+        assert cube["Cases"].sum() == len(year)
+        assert cube["LineTotal"].sum() == pytest.approx(year["LineTotal"].sum())
+
+def test_heatmap_rows_match_cube(year):
+    cubes = an.build_cubes(year)
+    start, end_excl = pd.Timestamp("2022-03-01"), pd.Timestamp("2022-09-01")
+    branches = sorted(year["Branch"].dropna().unique())
+    view = an.slice_cubes(cubes, an.cube_offsets(cubes), start, end_excl, branches)
+    rows = lambda: year[(year["Posting Date"] >= start) & (year["Posting Date"] < end_excl)]
+    assert_same(an.PandasSections(view).hospital_payer_cross(),
+                an.PandasSections(view, rows).hospital_payer_cross())
@@ -0,0 +1,58 @@
+"""PartitionStore (ingest ทีละ partition) ต้องได้ผลเท่ากับ load_clean ทั้งไฟล์ต่อกัน"""
+import os, shutil
+
+import pandas as pd
+import pytest
+
+import analytics as an
+from conftest import ROWS, assert_same, assert_same_cubes
+from synthetic import generate
+
+def test_partition_matches_full(parts_dir, full):
+    df, cubes, sketch, _ = full
+    p_df, p_cubes, p_sketch, _, stats = an.PartitionStore(parts_dir, strict_dedup=True, workers=1).refresh("v1")
+    assert stats["ingest"]["partitions"] == 3 and len(p_df) == len(df)
+    assert_same_cubes(cubes, p_cubes)
+    for kind in ("dtp", "overdue"):
+        assert_same(sketch[kind], p_sketch[kind])
+
+def test_partition_incremental_refresh(parts_dir, tmp_path):
+    root = shutil.copytree(parts_dir, tmp_path / "parts")
+    store = an.PartitionStore(str(root), strict_dedup=True, workers=1)
+    store.refresh("v1")
+    assert all("df" not in p for p in store.parts.values())  # ไม่เก็บแถวซ้ำกับ frame รวม
+
+    os.remove(root / "part_1.parquet")
+    generate(str(root / "part_1.parquet"), ROWS // 3, dup_rate=0.05, seed=7)
+    df, cubes, sketch, notes, stats = store.refresh("v2")
+    assert stats["ingest"]["refreshed"] == 1
+    f_df, f_cubes, f_sketch, f_notes, _ = an.PartitionStore(str(root), strict_dedup=True, workers=1).refresh("v2")
+    assert notes == f_notes
+    pd.testing.assert_frame_equal(df, f_df)
+    assert_same_cubes(f_cubes, cubes)
+    for kind in ("dtp", "overdue"):
+        assert_same(f_sketch[kind], sketch[kind])
+
+def test_partition_process_pool(parts_dir, tmp_path, monkeypatch):
+    # บังคับใช้ process pool (spawn) แม้ไฟล์เล็ก: ผลที่ pickle กลับมาต้องเท่ากับ clean ใน process เดียว
+    monkeypatch.setattr(an, "INGEST_PARALLEL_MIN_MB", 0)
+    root = shutil.copytree(parts_dir, tmp_path / "parts")
+    store = an.PartitionStore(str(root), strict_dedup=True, workers=2)
+    df, cubes, sketch, notes, _ = store.refresh("v1")
+    assert store.last_workers == 2
+    s_df, s_cubes, s_sketch, s_notes, _ = an.PartitionStore(str(root), strict_dedup=True, workers=1).refresh("v1")
+    pd.testing.assert_frame_equal(df, s_df)
+    assert_same_cubes(s_cubes, cubes)
+    assert notes == s_notes
+
+    # worker ที่ล้ม (ไฟล์เสีย) → exception ของ worker ถึงผู้เรียก; แก้ไฟล์แล้ว refresh ต่อได้ตามปกติ
+    (root / "part_9.parquet").write_bytes(b"not a parquet file")
+    generate(str(root / "part_8.parquet"), 500, dup_rate=0, seed=8)
+    with pytest.raises(Exception, match="[Pp]arquet"):
+        store.refresh("v2")
+    os.remove(root / "part_9.parquet")
+    df3, cubes3, _, _, stats = store.refresh("v3")
+    assert stats["ingest"]["partitions"] == 4
+    f_df, f_cubes, _, _, _ = an.PartitionStore(str(root), strict_dedup=True, workers=1).refresh("v3")
+    pd.testing.assert_frame_equal(df3, f_df)
+    assert_same_cubes(f_cubes, cubes3)
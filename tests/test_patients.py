@@ -0,0 +1,65 @@
+"""ledger รายผู้ป่วย (sort + reduceat) ต้องตรงกับ groupby ตรง ๆ บนแถว — และไม่มี ledger ถ้าไม่มีรหัสผู้ป่วยจริง"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import analytics as an
+from conftest import assert_same
+
+LEDGER_KEYS = ["Patient ID", "Day", "Branch", "Customer/Vendor Name"]
+
+@pytest.fixture(scope="module")
+def rows(full):
+    df = full[0]
+    assert "Patient ID" in df.columns  # synthetic มี HN → clean รวมเป็น Patient ID
+    return df
+
+def _naive_ledger(df):
+    return (df.assign(Day=df["Posting Date"].dt.normalize())
+            .groupby(LEDGER_KEYS, observed=True, dropna=False)
+            .agg(LineTotal=("LineTotal", "sum"), Lines=("LineTotal", "size")).reset_index())
+
+def _with_ids(ledger, df):
+    _, uniques = pd.factorize(df["Patient ID"])
+    return ledger.assign(**{"Patient ID": np.asarray(uniques)[ledger["Patient"]]}).drop(columns="Patient")
+
+def test_ledger_matches_groupby(rows):
+    ledger = an.patient_ledger(rows)
+    p, d = ledger["Patient"].to_numpy(), ledger["Day"].to_numpy()
+    assert ((p[1:] > p[:-1]) | ((p[1:] == p[:-1]) & (d[1:] >= d[:-1]))).all()  # เรียงผู้ป่วย → วัน
+    assert_same(_with_ids(ledger, rows), _naive_ledger(rows), LEDGER_KEYS)
+
+def test_filter_ledger_matches_filtered_rows(rows):
+    ledger = an.patient_ledger(rows)
+    branches = sorted(rows["Branch"].dropna().unique())[::3]
+    start, end_excl = pd.Timestamp("2022-05-10"), pd.Timestamp("2023-11-20")
+    got = an.filter_ledger(ledger, start, end_excl, branches)
+    sub = rows[rows["Branch"].isin(branches) & (rows["Posting Date"] >= start) & (rows["Posting Date"] < end_excl)]
+    assert_same(_with_ids(got, rows), _naive_ledger(sub), LEDGER_KEYS)
+
+def test_patient_tables_match_groupby(rows):
+    start, end_excl = pd.Timestamp("2022-03-01"), pd.Timestamp("2024-03-01")
+    tables = an.patient_tables(an.filter_ledger(an.patient_ledger(rows), start, end_excl,
+                                                rows["Branch"].dropna().unique()))
+    sub = rows[(rows["Posting Date"] >= start) & (rows["Posting Date"] < end_excl)]
+    visits = sub.assign(Day=sub["Posting Date"].dt.normalize())[["Patient ID", "Day"]].drop_duplicates()
+    per_patient = visits.groupby("Patient ID", observed=True).size()
+    sm = tables["summary"]
+    assert sm["patients"] == len(per_patient) and sm["visits"] == len(visits)
+    assert sm["revisit_rate"] == pytest.approx((per_patient >= 2).mean() * 100)
+    assert sm["revenue_per_patient"] == pytest.approx(sub["LineTotal"].sum() / len(per_patient))
+
+    # retention: เดือนที่มาครั้งแรก × จำนวนเดือนหลังจากนั้น, นับผู้ป่วยไม่ซ้ำต่อเดือน (ไม่เกิน COHORT_MAX_MONTHS)
+    month = visits["Day"].dt.to_period("M")
+    first = month.groupby(visits["Patient ID"], observed=True).transform("min")
+    since = (month - first).apply(lambda off: off.n)
+    naive = (pd.DataFrame({"Cohort": first.dt.to_timestamp(), "MonthsSince": since, "Patient ID": visits["Patient ID"]})
+             [since <= an.COHORT_MAX_MONTHS].drop_duplicates()
+             .groupby(["Cohort", "MonthsSince"]).size().rename("Patients").reset_index())
+    naive["CohortSize"] = naive["Cohort"].map(naive[naive["MonthsSince"] == 0].set_index("Cohort")["Patients"])
+    naive["Retention%"] = naive["Patients"] / naive["CohortSize"] * 100
+    assert_same(an.retention_matrix(tables["cohorts"]), naive, ["Cohort", "MonthsSince"])
+
+def test_no_patient_id_no_ledger(rows):
+    # Document No ไม่ใช่รหัสผู้ป่วย → ไม่สร้าง ledger (dashboard ซ่อน section รายผู้ป่วย)
+    assert an.patient_ledger(rows.drop(columns="Patient ID")) is None
@@ -0,0 +1,53 @@
+"""โหมด pushdown (อ่านเฉพาะสาขา/ช่วงวันที่ที่เลือก) ต้องตัดแถวซ้ำเหมือนโหมด full"""
+import pandas as pd
+import pytest
+
+import analytics as an
+from synthetic import generate
+
+def test_pushdown_dedup_key_matches_full(tmp_path):
+    # สาขาแรกมีแถวซ้ำจริง (คีย์ละเอียดสุด); สาขาที่สองมีแค่รายการคนละเอกสารที่ยอด/วัน/สินค้าเหมือนกัน
+    raw = pd.read_parquet(generate(str(tmp_path / "base.parquet"), 3_000, dup_rate=0, seed=3))
+    a, b = sorted(raw["Branch"].unique())[:2]
+    twins = raw[raw["Branch"] == b].head(50).assign(**{"Document No": lambda d: d["Document No"] + "-X"})
+    path = str(tmp_path / "data.parquet")
+    pd.concat([raw, raw[raw["Branch"] == a].head(50), twins], ignore_index=True).to_parquet(path)
+
+    full, _, _ = an.load_clean(path)
+    scan = an.scan_parquet(path)
+    assert scan["dedup_key"] == an.CANDIDATE_KEYS[0]
+    lo, hi = pd.Timestamp(scan["min_date"]), pd.Timestamp(scan["max_date"])
+    filters = an.build_pushdown_filters(scan, lo, hi, [b.strip()])
+    pushed, _, _ = an.load_clean(path, columns=scan["columns"], filters=filters, dedup_key=scan["dedup_key"])
+    assert len(pushed) == int((full["Branch"] == b.strip()).sum())
+    # เลือกคีย์จากแถวที่กรองแล้ว → ตกไปคีย์ที่หยาบกว่าและตัดรายการที่โหมด full เก็บไว้
+    subset, _, _ = an.load_clean(path, columns=scan["columns"], filters=filters)
+    assert len(subset) < len(pushed)
+
+def test_pushdown_reads_less_than_full(tmp_path, monkeypatch):
+    raw = pd.read_parquet(generate(str(tmp_path / "base.parquet"), 20_000, dup_rate=0.01, seed=4))
+    path = str(tmp_path / "data.parquet")
+    # คอลัมน์ที่ dashboard ไม่ใช้ + row group เล็ก (pruning ตามสาขา/วันที่มีผล)
+    raw.sort_values(["Branch", "Posting Date"]).assign(Remark="x").to_parquet(path, row_group_size=1_000)
+    reads = []
+    read_parquet = an.read_parquet
+    def recording(*args, **kwargs):
+        out = read_parquet(*args, **kwargs)
+        reads.append(out.shape)
+        return out
+    monkeypatch.setattr(an, "read_parquet", recording)
+
+    full, _, _ = an.load_clean(path)
+    scan = an.scan_parquet(path, fingerprint="v1")
+    b = sorted(scan["branch_raw"])[0]
+    lo, hi = pd.Timestamp("2023-01-01"), pd.Timestamp("2023-06-30")
+    filters = an.build_pushdown_filters(scan, lo, hi, [b])
+    pushed, _, _ = an.load_clean(path, columns=scan["columns"], filters=filters, dedup_key=scan["dedup_key"])
+    (full_rows, full_cols), (rows, cols) = reads
+    assert rows < full_rows / 10 and cols < full_cols
+    mask = (full["Branch"] == b) & full["Posting Date"].between(lo, hi + pd.Timedelta(days=1), inclusive="left")
+    assert len(pushed) == int(mask.sum())
+
+    # รอบถัดไปของไฟล์เดิม: ผล scan มาจากดิสก์ ไม่เปิดไฟล์ต้นทาง
+    monkeypatch.setattr(an.pq, "ParquetFile", lambda *a, **k: pytest.fail("scan อ่านไฟล์ต้นทางซ้ำ"))
+    assert an.scan_parquet(path, fingerprint="v1") == scan
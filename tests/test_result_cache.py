@@ -0,0 +1,50 @@
+"""ResultCache (LRU ตามขนาด) และ MemoSections: ไล่ผลที่ใช้ล่าสุดนานที่สุดออก, ชุดข้อมูลเปลี่ยน → คำนวณใหม่"""
+import numpy as np
+import pandas as pd
+
+import analytics as an
+
+def _frame(value, rows=1_000):
+    return pd.DataFrame({"x": np.full(rows, value, dtype="float64")})
+
+def test_lru_eviction_by_bytes():
+    size = an.result_nbytes(_frame(0))
+    cache = an.ResultCache(max_bytes=3 * size)
+    for k in "abc":
+        cache.get_or_compute(k, lambda k=k: _frame(ord(k)))
+    cache.get_or_compute("a", lambda: _frame(-1))  # hit → "a" ใช้ล่าสุด, "b" เก่าสุด
+    cache.get_or_compute("d", lambda: _frame(ord("d")))
+    assert "b" not in cache and all(k in cache for k in "acd")
+    assert cache.get_or_compute("a", lambda: _frame(-1))["x"].iloc[0] == ord("a")
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["hits"] == 2 and stats["misses"] == 4 and stats["bytes"] <= 3 * size
+    cache.get_or_compute("huge", lambda: _frame(0, rows=10_000))  # ใหญ่เกินงบทั้งก้อน → ไม่เก็บ ไม่ไล่ของเดิม
+    assert "huge" not in cache and all(k in cache for k in "acd")
+
+class Counting:
+    """sections ปลอมที่นับจำนวนครั้งที่ถูกคำนวณจริง"""
+    columns, empty = ["LineTotal"], False
+
+    def __init__(self, revenue):
+        self.revenue, self.calls = revenue, 0
+
+    def __len__(self):
+        return 1
+
+    def kpi_summary(self, profit_col=an.DEFAULT_PROFIT_COL):
+        self.calls += 1
+        return {"revenue": self.revenue}
+
+def test_fingerprint_change_invalidates():
+    cache = an.ResultCache()
+    start, end, branches = "2023-01-01", "2023-12-31", ["B", "A"]
+    old, new = Counting(1.0), Counting(2.0)
+    view_old = an.view_key("fp-1|True|full|None", start, end, branches)
+    view_new = an.view_key("fp-2|True|full|None", start, end, branches)
+    assert an.MemoSections(old, cache, view_old).kpi_summary()["revenue"] == 1.0
+    # rerun เดิม (ลำดับสาขาต่างกันได้) → hit ไม่คำนวณซ้ำ
+    assert an.MemoSections(old, cache, an.view_key("fp-1|True|full|None", start, end, branches[::-1])).kpi_summary()["revenue"] == 1.0
+    assert old.calls == 1
+    # ไฟล์ต้นทางเปลี่ยน (fingerprint ใหม่) → คีย์ใหม่ คำนวณจากข้อมูลใหม่
+    assert an.MemoSections(new, cache, view_new).kpi_summary()["revenue"] == 2.0
+    assert new.calls == 1 and old.calls == 1
@@ -0,0 +1,32 @@
+"""พรีวิวจากตัวอย่างแบบแบ่งชั้น: ช่วงความเชื่อมั่น (Horvitz–Thompson) ต้องครอบค่าจริงของทั้งชุดข้อมูลในสัดส่วนราว 95%"""
+import numpy as np
+
+import analytics as an
+
+SEEDS = 40
+
+def _truth(cube, profit_col, by=None):
+    g = cube.groupby(by, observed=True) if by else cube.assign(_all=0).groupby("_all")
+    t = g[["LineTotal", profit_col, "Cases"]].sum()
+    return {"Revenue": t["LineTotal"], "Margin%": t[profit_col] / t["LineTotal"] * 100,
+            "ARPC": t["LineTotal"] / t["Cases"]}
+
+def test_ht_interval_covers_full_value(full):
+    _, cubes, _, _ = full
+    profit_col = an.DEFAULT_PROFIT_COL
+    for name, by in (("daily", None), ("payer", "Customer/Vendor Name")):
+        cube = cubes[name]
+        truth = _truth(cube, profit_col, by)
+        hits = {m: [] for m in truth}
+        for seed in range(SEEDS):
+            sample = an.stratified_sample(cube, target_rows=len(cube) // 10, min_per_stratum=3, seed=seed)
+            assert len(sample) < len(cube) / 2
+            est = an.sample_intervals(sample, profit_col, by)
+            if by:
+                est = est.set_index(by).loc[truth["Revenue"].index]
+            for m, value in truth.items():
+                err = np.abs(est[m].to_numpy() - value.to_numpy())
+                hits[m].append(err <= est[f"{m}_ci"].to_numpy())
+        for m, h in hits.items():
+            coverage = np.concatenate(h).mean()
+            assert coverage >= 0.85, (name, m, coverage)
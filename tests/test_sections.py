@@ -0,0 +1,51 @@
+"""งาน section ใน thread pool: ผลเท่ากับเรียกทีละงาน และ cancel_sections ยกเลิกได้เฉพาะงานที่ยังไม่เริ่ม"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import analytics as an
+
+def _same(a, b):
+    if isinstance(a, pd.DataFrame):
+        pd.testing.assert_frame_equal(a, b)
+    elif isinstance(a, pd.Series):
+        pd.testing.assert_series_equal(a, b)
+    else:
+        assert a == b
+
+def test_pool_results_match_serial(full):
+    _, cubes, _, _ = full
+    q = an.PandasSections(cubes)
+    jobs = an.section_jobs(q)
+    assert set(jobs) == set(an.SECTION_JOBS)
+    serial = {name: fn() for name, fn in jobs.items()}
+    log = an.StageLog()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = an.submit_sections(pool, jobs, log)
+        assert list(futures) == list(jobs) and an.wait_sections(futures, timeout=60)
+    for name, fut in futures.items():
+        _same(fut.result(), serial[name])
+    assert sorted(r["stage"] for r in log.records) == sorted(f"{name} (pool job)" for name in jobs)
+
+def test_cancel_pending_only():
+    started, release = threading.Event(), threading.Event()
+    ran = []
+
+    def blocker():
+        started.set()
+        release.wait(10)
+        ran.append("blocker")
+        return "done"
+
+    jobs = {"blocker": blocker, **{f"job{i}": (lambda i=i: ran.append(i)) for i in range(3)}}
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        futures = an.submit_sections(pool, jobs)
+        assert started.wait(10)
+        # งานแรกกำลังรัน (ยกเลิกไม่ได้) อีก 3 งานยังรอคิว
+        assert an.cancel_sections(futures) == 3
+        release.set()
+        assert an.wait_sections(futures, timeout=10)
+    assert futures["blocker"].result() == "done" and ran == ["blocker"]
+    assert all(futures[f"job{i}"].cancelled() for i in range(3))
+    assert an.cancel_sections(futures) == 0  # เสร็จ/ยกเลิกไปแล้ว → ไม่นับซ้ำ
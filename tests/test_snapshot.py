@@ -0,0 +1,53 @@
+"""snapshot ของ load_clean บนดิสก์: อ่านกลับได้เท่ากับ clean ใหม่ และไม่ใช้ไฟล์เก่าเมื่อแหล่งข้อมูล/CLEANING_VERSION เปลี่ยน"""
+import json, os
+
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+import analytics as an
+
+@pytest.fixture
+def snap_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(an, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    return tmp_path / "snapshots"
+
+def test_snapshot_round_trip(source, full, snap_dir):
+    df, _, _, notes = full
+    first, first_notes, stats = an.load_clean(source, fingerprint="fp-1")
+    assert stats["snapshot"]["hit"] is False and list(snap_dir.iterdir()) == [snap_dir / os.path.basename(stats["snapshot"]["path"])]
+    again, again_notes, again_stats = an.load_clean(source, fingerprint="fp-1")
+    assert again_stats["snapshot"]["hit"] is True
+    assert [s["stage"] for s in again_stats["stages"]] == ["read_snapshot"]
+    assert again_notes == first_notes == notes and again_stats["dedup"] == stats["dedup"]
+    # dtype ของ schema แบบ compact (category / float32 / Int16) ต้องรอดการอ่านกลับด้วย
+    pd.testing.assert_frame_equal(again, df)
+    pd.testing.assert_frame_equal(first, df)
+
+def test_fingerprint_change_rebuilds(source, snap_dir):
+    an.load_clean(source, fingerprint="fp-1")
+    _, _, stats = an.load_clean(source, fingerprint="fp-2")  # ไฟล์ต้นทางเปลี่ยน
+    assert stats["snapshot"]["hit"] is False
+    assert len(list(snap_dir.iterdir())) == 2
+
+def test_cleaning_version_bump_rebuilds(source, snap_dir, monkeypatch):
+    _, _, old = an.load_clean(source, fingerprint="fp-1")
+    monkeypatch.setattr(an, "CLEANING_VERSION", an.CLEANING_VERSION + 1)
+    _, _, new = an.load_clean(source, fingerprint="fp-1")
+    assert new["snapshot"]["hit"] is False and new["snapshot"]["path"] != old["snapshot"]["path"]
+
+def test_stale_snapshot_rejected(source, full, snap_dir):
+    _, _, stats = an.load_clean(source, fingerprint="fp-1")
+    path = stats["snapshot"]["path"]
+    # ไฟล์ชื่อถูกต้องแต่เขียนโดย CLEANING_VERSION เก่า (เช่นคัดลอกมาจากเครื่องอื่น)
+    table = feather.read_table(path)
+    meta = json.loads(table.schema.metadata[b"hospital_analysis"])
+    meta["cleaning_version"] = an.CLEANING_VERSION - 1
+    feather.write_feather(table.replace_schema_metadata(
+        {**table.schema.metadata, b"hospital_analysis": json.dumps(meta).encode("utf-8")}), path)
+    with pytest.raises(ValueError, match="CLEANING_VERSION"):
+        an.read_snapshot(path)
+    df, _, rebuilt = an.load_clean(source, fingerprint="fp-1")
+    assert rebuilt["snapshot"]["hit"] is False
+    pd.testing.assert_frame_equal(df, full[0])
+    assert an.read_snapshot(path)[0].shape == df.shape  # ไฟล์ถูกเขียนทับด้วยเวอร์ชันปัจจุบัน
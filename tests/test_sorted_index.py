@@ -0,0 +1,37 @@
+"""slice_branch_dates (searchsorted บน frame ที่เรียงแล้ว) ต้องได้แถวเดียวกับ boolean mask — รวมแถวที่ไม่มี Branch"""
+import pandas as pd
+import pytest
+
+import analytics as an
+from synthetic import generate
+
+@pytest.fixture(scope="module")
+def rows(tmp_path_factory):
+    root = tmp_path_factory.mktemp("missing_branch")
+    raw = pd.read_parquet(generate(str(root / "raw.parquet"), 20_000, dup_rate=0, seed=5))
+    raw.loc[raw.sample(frac=0.03, random_state=1).index, "Branch"] = None
+    raw.to_parquet(root / "data.parquet")
+    df, _, _ = an.load_clean(str(root / "data.parquet"))
+    assert df["Branch"].isna().any()
+    return df
+
+def _views(branches):
+    last = branches[-1]
+    return [
+        ([last], "2022-01-01", "2025-01-01"),
+        ([last], "2023-02-10", "2023-09-20"),
+        (branches, "2022-01-01", "2025-01-01"),
+        (branches, "2023-02-10", "2023-09-20"),
+        (branches[::3], "2022-06-15", "2024-03-02"),
+        ([], "2022-01-01", "2025-01-01"),
+    ]
+
+@pytest.mark.parametrize("frame", ["rows", "daily", "product"])
+def test_slice_matches_mask(rows, frame):
+    df, date_col = (rows, "Posting Date") if frame == "rows" else (an.build_cube(rows, frame), an.CUBES[frame][1])
+    offsets = an.branch_offsets(df)
+    for branches, start, end in _views(sorted(offsets)):
+        start, end_excl = pd.Timestamp(start), pd.Timestamp(end)
+        got = an.slice_branch_dates(df, offsets, date_col, start, end_excl, branches)
+        mask = df["Branch"].isin(branches) & (df[date_col] >= start) & (df[date_col] < end_excl)
+        pd.testing.assert_frame_equal(got, df[mask])
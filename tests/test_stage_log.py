@@ -0,0 +1,61 @@
+"""StageLog: แต่ละ stage บันทึก rows_in/rows_out/seconds/mem_delta_mb และ log เป็น JSON หนึ่งบรรทัดต่อ stage"""
+import io, json, logging, time
+
+import numpy as np
+
+import analytics as an
+
+def test_begin_end_records():
+    log = an.StageLog()
+    log.begin("alloc", rows_in=10)
+    block = np.ones(64 * 2**20 // 8)  # 64 MB ที่ถูกเขียนจริง → RSS เพิ่ม
+    time.sleep(0.02)
+    log.end(rows_out=7)
+    with log.stage("ctx", 7) as out:
+        out["rows_out"] = 3
+    log.begin("first")
+    log.begin("second")  # begin ซ้อน → ปิด stage ก่อนหน้าให้เอง
+    log.end()
+    log.add("job (pool job)", 0.5, rows_out=2)
+    del block
+
+    frame = log.frame()
+    assert list(frame.columns) == an.STAGE_COLUMNS
+    assert frame["stage"].tolist() == ["alloc", "ctx", "first", "second", "job (pool job)"]
+    alloc = log.records[0]
+    assert alloc["rows_in"] == 10 and alloc["rows_out"] == 7 and alloc["seconds"] >= 0.02
+    assert alloc["mem_delta_mb"] >= 32
+    assert log.records[1]["rows_in"] == 7 and log.records[1]["rows_out"] == 3
+    assert log.records[4] == {"stage": "job (pool job)", "rows_in": None, "seconds": 0.5, "rows_out": 2, "mem_delta_mb": None}
+    assert not any(k.startswith("_") for rec in log.records for k in rec)
+
+def test_disabled_is_noop():
+    log = an.StageLog(enabled=False)
+    with log.stage("x", 1) as out:
+        out["rows_out"] = 1
+    log.begin("y")
+    log.end(1)
+    log.add("z", 1.0)
+    assert log.records == [] and log.frame().empty
+
+def test_json_log_line():
+    stream = io.StringIO()
+    logger = logging.getLogger("tests.stage_log")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    try:
+        log = an.StageLog(logger=logger, session="abc", source="สาขา.parquet")
+        with log.stage("clean", 100) as out:
+            out["rows_out"] = 90
+    finally:
+        logger.removeHandler(handler)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1 and "สาขา" in lines[0]  # ensure_ascii=False
+    rec = json.loads(lines[0])
+    assert list(rec)[:3] == ["event", "session", "source"]
+    assert rec["event"] == "stage" and rec["session"] == "abc" and rec["stage"] == "clean"
+    assert rec["rows_in"] == 100 and rec["rows_out"] == 90 and rec["seconds"] >= 0
+    assert set(rec) == {"event", "session", "source", *an.STAGE_COLUMNS}
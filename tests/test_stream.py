@@ -0,0 +1,26 @@
+"""stream_aggregates (อ่านทีละ batch + de-dup ผ่าน HashSpill) ต้องได้ cube/sketch เท่ากับ load_clean ทั้งไฟล์"""
+import numpy as np
+import pandas as pd
+
+import analytics as an
+from conftest import assert_same, assert_same_cubes
+
+def test_stream_matches_full_small_batches(source, full):
+    df, cubes, sketch, notes = full
+    # batch เล็กกว่าช่วงที่ synthetic วางแถวซ้ำ (ท้าย chunk คัดลอกจากแถวต้น chunk) → แถวซ้ำข้าม batch
+    s_cubes, s_sketch, s_notes, stats = an.stream_aggregates(source, strict_dedup=True, batch_rows=997)
+    assert stats["stream"]["batches"] > 20 and stats["stream"]["rows_kept"] == len(df)
+    assert s_notes == notes and any("ลบข้อมูลซ้ำ" in m for m in notes)
+    assert_same_cubes(cubes, s_cubes)
+    for kind in ("dtp", "overdue"):
+        assert_same(sketch[kind], s_sketch[kind])
+
+def test_spill_plan_matches_in_memory():
+    rng = np.random.default_rng(0)
+    n = 5_000
+    frame = pd.DataFrame({"a": rng.integers(0, 50, n), "b": rng.integers(0, 20, n), "c": rng.integers(0, 3, n)})
+    batches = lambda: (frame.iloc[i:i + 300] for i in range(0, n, 300))
+    plan = an.spill_dedup_plan(batches, n, 300, keys=[["a", "b", "c"]])
+    ref = an.dedup_plan(list(frame.columns), lambda ks: an.key_hashes(frame, ks), keys=[["a", "b", "c"]])
+    assert plan["counts"] == ref["counts"] and plan["used_key"] == ref["used_key"]
+    np.testing.assert_array_equal(plan["keep"], np.flatnonzero(~ref["keep"]))